@@ -73,6 +73,66 @@ def parse_args_coolpuppy():
                 i.e. final size of the matrix is 2×pad+res, in kb.
                 Ignored with ``--rescale``, use ``--rescale_pad`` instead""",
     )
+    parser.add_argument(
+        "--pads",
+        default=None,
+        type=str,
+        required=False,
+        help="""Comma-separated paddings in kb, e.g. 50,100,200. A separate pileup is
+                saved for each pad, all cropped from windows of the largest pad in one
+                pass over the data. Overrides ``--pad``""",
+    )
+    parser.add_argument(
+        "--norms",
+        default=None,
+        type=str,
+        required=False,
+        help="""Comma-separated normalizations from balanced, unbalanced and
+                coverage (unbalanced with coverage normalization). A separate pileup
+                is saved for each, all from one fetch of the raw data. Overrides
+                ``--unbalanced`` and ``--coverage_norm``""",
+    )
+    parser.add_argument(
+        "--resolutions",
+        default=None,
+        type=str,
+        required=False,
+        help="""Comma-separated resolutions in bp to use from a .mcool file, e.g.
+                5000,10000,25000. The baselist is read once and a separate pileup is
+                saved for each resolution""",
+    )
+    parser.add_argument(
+        "--coarsen",
+        action="store_true",
+        default=False,
+        required=False,
+        help="""With --resolutions, make pileups at resolutions that are odd multiples
+                of the finest one by aggregating the pileup of the finest resolution,
+                instead of loading their data. Windows are then centred on the finest
+                bins of the regions""",
+    )
+    parser.add_argument(
+        "--scool",
+        action="store_true",
+        default=False,
+        required=False,
+        help="""The cooler file is a .scool file with single cells. Pile up each cell
+                with the same coordinates, accumulating windows from the sparse data,
+                and save a table of enrichments of all cells and an aggregate pileup.
+                Use with ``--unbalanced --coverage_norm`` to normalize each cell by
+                its own coverage""",
+    )
+    parser.add_argument(
+        "--pairs",
+        default=None,
+        type=int,
+        required=False,
+        help="""The cooler file is a .pairs file, possibly gzipped. Bin its contacts at
+                this resolution in bp on the fly while streaming the file once,
+                instead of building a cooler first. Chromosome sizes are read from the
+                header of the file. Only for plain pileups with ``--unbalanced``,
+                optionally with ``--coverage_norm``""",
+    )
     ### Control of controls
     parser.add_argument(
         "--minshift",
@@ -173,6 +233,15 @@ def parse_args_coolpuppy():
                 Use as an anchor to create intersections with coordinates in the
                 baselist""",
     )
+    parser.add_argument(
+        "--anchors",
+        default=None,
+        type=str,
+        required=False,
+        help="""A bed file with anchors. Creates a separate pileup for each anchor
+                with coordinates in the baselist, loading data once for all anchors in
+                a chromosome. Saves one output file per anchor""",
+    )
     parser.add_argument(
         "--by_window",
         action="store_true",
@@ -183,14 +252,33 @@ def parse_args_coolpuppy():
                 Will save a master-table with coordinates, their enrichments and
                 corner coefficient of variation, which is reflective of noisiness""",
     )
+    parser.add_argument(
+        "--scan",
+        action="store_true",
+        default=False,
+        required=False,
+        help="""Instead of a pile-up, compute enrichment of every bin of the genome
+                used as an anchor against all regions in the baselist, normalized by
+                expected computed from the data. Will save a bedGraph file""",
+    )
     parser.add_argument(
         "--save_all",
         action="store_true",
         default=False,
         required=False,
-        help="""If ``--by-window``, save all individual pile-ups in a separate json file
+        help="""If ``--by-window``, save all individual pile-ups in a separate json file.
+             Otherwise only the pixels needed for the enrichment table are computed
              """,
     )
+    parser.add_argument(
+        "--save_snippets",
+        action="store_true",
+        default=False,
+        required=False,
+        help="""Save all individual snippets into a memory-mapped .npy file next to the
+                output, with a .tsv table of their coordinates. Not used with
+                ``--by_window``""",
+    )
     parser.add_argument(
         "--local",
         action="store_true",
@@ -198,6 +286,44 @@ def parse_args_coolpuppy():
         required=False,
         help="""Create local pileups, i.e. along the diagonal""",
     )
+    parser.add_argument(
+        "--distance_bins",
+        default=None,
+        type=str,
+        required=False,
+        help="""Comma-separated edges of distance bands in bp, e.g.
+                100000,200000,400000. A separate pileup is saved for each band, all
+                from one pass over the data. If --maxdist is not set, the largest
+                edge is used""",
+    )
+    parser.add_argument(
+        "--groups",
+        action="store_true",
+        default=False,
+        required=False,
+        help="""Use the extra last column of the baselist (4th for bed, 7th for bedpe)
+                as group labels of regions, and save a separate pileup for each group,
+                or for each pair of groups of two bed regions, from one pass over the
+                data""",
+    )
+    parser.add_argument(
+        "--group_quantiles",
+        default=0,
+        type=int,
+        required=False,
+        help="""With --groups, treat the group column as numeric scores and split
+                them into this many quantiles""",
+    )
+    parser.add_argument(
+        "--trans",
+        action="store_true",
+        default=False,
+        required=False,
+        help="""Create inter-chromosomal pileups: of all pairs of regions on different
+                chromosomes from a bed file, or of pairs with sides on different
+                chromosomes from a bedpe file. Distance filters are not used, and
+                pairs are oriented by the order of chromosomes""",
+    )
     parser.add_argument(
         "--unbalanced",
         action="store_true",
@@ -240,6 +366,28 @@ def parse_args_coolpuppy():
                 i.e. it will be size×size. Due to technical limitation in the current
                 implementation, has to be an odd number""",
     )
+    parser.add_argument(
+        "--rescale_resolutions",
+        type=str,
+        default=None,
+        required=False,
+        help="""With ``--rescale`` and a cooler inside an .mcool file, extract each
+                window from the coarsest resolution of the file that still gives at
+                least rescale_size bins across it. Either "auto" to use all
+                resolutions that are multiples of the cooler's, or comma-separated
+                resolutions in bp""",
+    )
+    parser.add_argument(
+        "--banded",
+        action="store_true",
+        default=False,
+        required=False,
+        help="""Only load the diagonal band of each chromosome reachable by the
+                windows and store it densely. Requires ``--local`` or ``--maxdist``.
+                Can save a lot of memory at high resolution. All pixels of each
+                chromosome are still read once, and with ``--coverage_norm`` the
+                coverage of the whole chromosome is summed up from them""",
+    )
     parser.add_argument(
         "--weight_name",
         default="weight",
@@ -257,6 +405,77 @@ def parse_args_coolpuppy():
                 bit more memory, although the data are always stored as sparse matrices
                 """,
     )
+    parser.add_argument(
+        "--executor",
+        default="process",
+        type=str,
+        choices=["process", "thread"],
+        required=False,
+        help="""How to use multiple cores.
+                With "process", each process loads its own chromosome.
+                With "thread", chromosomes are loaded one at a time and shared by all
+                threads, so memory use doesn't grow with ``--n_proc``. Threads only
+                run in parallel without ``--banded``, ``--rescale``, ``--expected``
+                and ``--save_snippets``""",
+    )
+    parser.add_argument(
+        "--prefetch",
+        default=0,
+        type=int,
+        required=False,
+        help="""How many chromosomes to load in advance in a background thread, while
+                the current one is being piled up. Only used with ``--n_proc 1`` or
+                ``--executor thread``. Each prefetched chromosome is kept in memory""",
+    )
+    parser.add_argument(
+        "--window_query_ratio",
+        default=None,
+        type=float,
+        required=False,
+        help="""Load only the rows of the matrix used by the windows, if they contain
+                less than this fraction of all pixels of the chromosome, e.g. 0.1.
+                Speeds up pileups of short lists of regions. By default whole
+                chromosomes are always loaded""",
+    )
+    parser.add_argument(
+        "--max_bad_fraction",
+        default=None,
+        type=float,
+        required=False,
+        help="""Skip windows where more than this fraction of pixels falls into bins
+                with NaN balancing weights, such as centromeres. They are found from
+                the weights without reading the data. Not used with
+                ``--unbalanced``, ``--by_window`` or ``--engine algebraic``""",
+    )
+    parser.add_argument(
+        "--dtype",
+        default="float64",
+        type=str,
+        choices=["float32", "float64"],
+        required=False,
+        help="""Precision of loaded data, extracted snippets and the saved snippet
+                stack. float32 halves their memory use and I/O. Pileups are always
+                summed up in float64""",
+    )
+    parser.add_argument(
+        "--engine",
+        default="dense",
+        type=str,
+        choices=["dense", "numba", "algebraic", "sweep"],
+        required=False,
+        help="""How to sum up the windows.
+                "dense" extracts every window as a dense array.
+                "numba" adds up pixels directly from the sparse matrix in a compiled
+                loop (requires numba, otherwise uses a slower NumPy version).
+                "algebraic" sums up all combinations of regions in a bed file at once
+                with sparse matrix products, without generating the pairs; controls
+                are then piled up with "numba".
+                "sweep" reads the pixels of each chromosome once and adds each of them
+                to all windows that contain it, best when windows overlap a lot, e.g.
+                with ``--by_window``.
+                "numba", "algebraic" and "sweep" are not used with ``--rescale`` or
+                ``--expected``""",
+    )
     # Output
     parser.add_argument(
         "--outdir",
@@ -301,6 +520,16 @@ def parse_args_coolpuppy():
     return parser
 
 
+def _split_outname(outname):
+    """Split an output name into its root and extension, keeping ``.np.txt``
+    together as one extension.
+    """
+    root, ext = os.path.splitext(outname)
+    if root.endswith(".np"):
+        root, ext = root[:-3], ".np" + ext
+    return root, ext
+
+
 def main():
     parser = parse_args_coolpuppy()
     args = parser.parse_args()
@@ -326,7 +555,30 @@ def main():
     else:
         nproc = args.n_proc
 
-    c = cooler.Cooler(args.coolfile)
+    if args.resolutions is not None:
+        resolutions = sorted(int(res) for res in args.resolutions.split(","))
+        clrs = [
+            cooler.Cooler(f"{args.coolfile}::resolutions/{res}") for res in resolutions
+        ]
+        if args.expected is not None and len(clrs) > 1:
+            raise ValueError("Can't use one expected file with several resolutions")
+    elif args.scool:
+        if args.coarsen:
+            raise ValueError("Can only aggregate pileups with several resolutions")
+        cells = cooler.fileops.list_scool_cells(args.coolfile)
+        if len(cells) == 0:
+            raise ValueError("No cells in the .scool file")
+        # Cells share the bins, the first one is used for them
+        clrs = [cooler.Cooler(f"{args.coolfile}::{cells[0]}")]
+    elif args.pairs is not None:
+        if args.coarsen:
+            raise ValueError("Can only aggregate pileups with several resolutions")
+        clrs = [PairsFile(args.coolfile, args.pairs)]
+    else:
+        if args.coarsen:
+            raise ValueError("Can only aggregate pileups with several resolutions")
+        clrs = [cooler.Cooler(args.coolfile)]
+    c = clrs[0]
 
     if not os.path.isfile(args.baselist) and args.baselist != "-":
         raise FileExistsError("Loop(base) coordinate file doesn't exist")
@@ -369,8 +621,29 @@ def main():
     else:
         mindist = args.mindist
 
+    if args.distance_bins is not None:
+        distance_bins = [int(edge) for edge in args.distance_bins.split(",")]
+        if len(distance_bins) < 2:
+            raise ValueError("Please provide at least two edges of distance bins")
+    else:
+        distance_bins = None
+
+    if args.pads is not None:
+        pads = [int(pad) * 1000 for pad in args.pads.split(",")]
+        pad = max(pads)
+    else:
+        pads = None
+        pad = args.pad * 1000
+    if args.norms is not None:
+        norms = args.norms.split(",")
+    else:
+        norms = None
+
     if args.maxdist is None:
-        maxdist = np.inf
+        if distance_bins is not None:
+            maxdist = max(distance_bins)
+        else:
+            maxdist = np.inf
     else:
         maxdist = args.maxdist
 
@@ -395,6 +668,77 @@ def main():
                                   supported"""
         )
 
+    if args.trans and (args.by_window or args.scan or args.expected is not None):
+        raise ValueError("Can't make trans pileups by window, as a scan or with expected")
+
+    if args.scool and (
+        args.resolutions is not None
+        or args.expected is not None
+        or args.by_window
+        or args.scan
+        or args.trans
+        or args.groups
+        or args.anchors is not None
+        or distance_bins is not None
+        or pads is not None
+        or norms is not None
+        or args.save_snippets
+    ):
+        raise ValueError("Can only make plain pileups of single cells")
+
+    if args.pairs is not None:
+        if (
+            args.resolutions is not None
+            or args.scool
+            or args.expected is not None
+            or args.by_window
+            or args.scan
+            or args.trans
+            or args.groups
+            or args.anchors is not None
+            or distance_bins is not None
+            or pads is not None
+            or norms is not None
+            or args.save_snippets
+            or args.rescale
+            or args.rescale_resolutions is not None
+            or args.banded
+        ):
+            raise ValueError("Can only make plain pileups from a .pairs file")
+        if balance:
+            raise ValueError(
+                "Can't balance contacts from a .pairs file, please use --unbalanced"
+            )
+
+    if args.coarsen:
+        if (
+            args.by_window
+            or args.scan
+            or args.rescale
+            or args.trans
+            or args.groups
+            or args.anchors is not None
+            or distance_bins is not None
+            or pads is not None
+            or norms is not None
+        ):
+            raise ValueError("Can only aggregate plain pileups to coarser resolutions")
+        factors = [
+            clr.binsize // c.binsize
+            for clr in clrs
+            if clr.binsize % c.binsize == 0 and (clr.binsize // c.binsize) % 2 == 1
+        ]
+        # Fine windows have to cover the coarse windows around the central fine bin
+        cc_pad = pad + max(factors) // 2 * c.binsize
+    else:
+        factors = []
+        cc_pad = pad
+
+    if args.rescale_resolutions is None or args.rescale_resolutions == "auto":
+        rescale_resolutions = args.rescale_resolutions
+    else:
+        rescale_resolutions = [int(res) for res in args.rescale_resolutions.split(",")]
+
     if args.rescale and args.rescale_size % 2 == 0:
         raise ValueError("Please provide an odd rescale_size")
 
@@ -426,7 +770,8 @@ def main():
         bed2=args.bed2,
         bed2_ordered=args.bed2_ordered,
         anchor=anchor,
-        pad=args.pad * 1000,
+        anchors=args.anchors,
+        pad=cc_pad,
         chroms=fchroms,
         minshift=args.minshift,
         maxshift=args.maxshift,
@@ -436,126 +781,300 @@ def main():
         mindist=mindist,
         maxdist=maxdist,
         local=args.local,
+        trans=args.trans,
+        groups=args.groups,
+        group_quantiles=args.group_quantiles,
         subset=args.subset,
         seed=args.seed,
     )
 
-    PU = PileUpper(
-        clr=c,
-        CC=CC,
-        balance=balance,
-        expected=expected,
-        control=control,
-        coverage_norm=args.coverage_norm,
-        rescale=args.rescale,
-        rescale_pad=args.rescale_pad,
-        rescale_size=args.rescale_size,
-        ignore_diags=args.ignore_diags,
-    )
-
-    if args.outdir == ".":
-        args.outdir = os.getcwd()
-
-    if args.outname == "auto":
-        outname = f"{coolname}-{c.binsize / 1000}K_over_{bedname}"
-        if args.nshifts > 0 and args.expected is None:
-            outname += f"_{args.nshifts}-shifts"
-        if args.expected is not None:
-            outname += "_expected"
-        if args.nshifts <= 0 and args.expected is None:
-            outname += "_noNorm"
-        if anchor:
-            outname += f"_from_{anchor_name}"
-        if args.local:
-            outname += "_local"
-            if minsize > 0 or maxsize < np.inf:
-                outname += f"_len_{minsize}-{maxsize}"
-        elif args.mindist is not None or args.maxdist is not None:
-            outname += f"_dist_{mindist}-{maxdist}"
-        if args.rescale:
-            outname += "_rescaled"
-        if args.unbalanced:
-            outname += "_unbalanced"
-        if args.coverage_norm:
-            outname += "_covnorm"
-        if args.subset > 0:
-            outname += f"_subset-{args.subset}"
-        if args.by_window:
-            outname = f"Enrichment_{outname}.txt"
+    coarsened = {}
+    baseCC = CC
+    for c in clrs:
+        if c is not clrs[0]:
+            CC = baseCC.at_resolution(c.binsize, pad=pad)
+
+        if args.outdir == ".":
+            args.outdir = os.getcwd()
+
+        if args.outname == "auto":
+            outname = f"{coolname}-{c.binsize / 1000}K_over_{bedname}"
+            if args.nshifts > 0 and args.expected is None:
+                outname += f"_{args.nshifts}-shifts"
+            if args.expected is not None:
+                outname += "_expected"
+            if args.nshifts <= 0 and args.expected is None:
+                outname += "_noNorm"
+            if anchor:
+                outname += f"_from_{anchor_name}"
+            elif args.anchors is not None:
+                outname += f"_from_{os.path.splitext(os.path.basename(args.anchors))[0]}"
+            if args.trans:
+                outname += "_trans"
+            elif args.local:
+                outname += "_local"
+                if minsize > 0 or maxsize < np.inf:
+                    outname += f"_len_{minsize}-{maxsize}"
+            elif args.mindist is not None or args.maxdist is not None:
+                outname += f"_dist_{mindist}-{maxdist}"
+            if args.rescale:
+                outname += "_rescaled"
+            if args.unbalanced:
+                outname += "_unbalanced"
+            if args.coverage_norm:
+                outname += "_covnorm"
+            if args.subset > 0:
+                outname += f"_subset-{args.subset}"
+            if args.scan:
+                outname = f"Scan_{outname}.bedGraph"
+            elif args.by_window:
+                outname = f"Enrichment_{outname}.txt"
+            else:
+                outname += ".np.txt"
         else:
-            outname += ".np.txt"
-    else:
-        outname = args.outname
-
-    if args.by_window:
-        if CC.kind != "bed":
-            raise ValueError("Can't make by-window pileups without making combinations")
-        if args.local:
-            raise ValueError("Can't make local by-window pileups")
-        if anchor:
-            raise ValueError("Can't make by-window combinations with an anchor")
-        #        if args.coverage_norm:
-        #            raise NotImplementedError("""Can't make by-window combinations with
-        #                                      coverage normalization - please use
-        #                                      balanced data instead""")
-        finloops = PU.pileupsByWindowWithControl(nproc=nproc)
-
-        p = Pool(nproc)
-        data = p.map(prepare_single, finloops.items())
-        p.close()
-        data = pd.DataFrame(
-            data,
-            columns=[
-                "chr",
-                "start",
-                "end",
-                "N",
-                "Enrichment1",
-                "Enrichment3",
-                "CV3",
-                "CV5",
-            ],
-        )
-        data = data.reindex(
-            index=order_by_index(
-                data.index, index_natsorted(zip(data["chr"], data["start"]))
+            outname = args.outname
+            if len(clrs) > 1:
+                root, ext = _split_outname(outname)
+                outname = f"{root}_{c.binsize}bp{ext}"
+
+        if args.save_snippets:
+            if args.by_window:
+                raise ValueError("Can't save individual snippets of by-window pileups")
+            os.makedirs(args.outdir, exist_ok=True)
+            root = _split_outname(outname)[0]
+            snippets_file = os.path.join(args.outdir, root) + ".snippets.npy"
+        else:
+            snippets_file = None
+
+        if args.pairs is not None:
+            PU = PairsPileUpper(
+                pairs=c,
+                CC=CC,
+                control=control,
+                coverage_norm=args.coverage_norm,
+                ignore_diags=args.ignore_diags,
             )
-        )
-        try:
-            data.to_csv(os.path.join(args.outdir, outname), sep="\t", index=False)
-        except FileNotFoundError:
-            os.mkdir(args.outdir)
-            data.to_csv(os.path.join(args.outdir, outname), sep="\t", index=False)
-        finally:
-            logging.info(
-                f"Saved enrichment table to {os.path.join(args.outdir, outname)}"
+        else:
+            PU = PileUpper(
+                clr=c,
+                CC=CC,
+                balance=balance,
+                expected=expected,
+                control=control,
+                coverage_norm=args.coverage_norm,
+                rescale=args.rescale,
+                rescale_pad=args.rescale_pad,
+                rescale_size=args.rescale_size,
+                ignore_diags=args.ignore_diags,
+                banded=args.banded,
+                executor=args.executor,
+                snippets_file=snippets_file,
+                prefetch=args.prefetch,
+                window_query_ratio=args.window_query_ratio,
+                engine=args.engine,
+                max_bad_fraction=args.max_bad_fraction,
+                dtype=args.dtype,
+                distance_bins=distance_bins,
+                rescale_resolutions=rescale_resolutions,
             )
-
-        if args.save_all:
-            outdict = {
-                "%s:%s-%s" % key: (val[0], val[1].tolist())
-                for key, val in finloops.items()
+        if args.coarsen and c is clrs[0]:
+            coarsened = {
+                c.binsize * factor: pileup
+                for factor, pileup in PU.pileupsCoarsenedWithControl(
+                    factors, pad=pad, nproc=nproc
+                ).items()
             }
-            import json
 
-            json_path = (
-                os.path.join(args.outdir, os.path.splitext(outname)[0]) + ".json"
+        if args.scan:
+            if CC.kind != "bed":
+                raise ValueError("Can only scan anchors against regions from a bed file")
+            if args.local or anchor or args.by_window:
+                raise ValueError("Can't scan anchors with local, anchor or by-window")
+            scan = PU.anchorScanGenome(nproc=nproc)
+            os.makedirs(args.outdir, exist_ok=True)
+            scan = scan.dropna(subset=["Enrichment"])
+            scan[["chr", "start", "end", "Enrichment"]].to_csv(
+                os.path.join(args.outdir, outname), sep="\t", index=False, header=False
             )
-            with open(json_path, "w") as fp:
-                json.dump(outdict, fp)  # , sort_keys=True, indent=4)
-                logging.info(f"Saved individual pileups to {json_path}")
-    else:
-        pup, n = PU.pileupsWithControl(nproc)
-        headerdict = vars(args)
-        headerdict['resolution'] = int(c.binsize)
-        headerdict['n'] = int(n)
-        try:
+            logging.info(f"Saved anchor scan to {os.path.join(args.outdir, outname)}")
+        elif args.scool:
+            table, (n, pup) = pileupsByCell(
+                args.coolfile,
+                CC,
+                cells=cells,
+                nproc=nproc,
+                balance=balance,
+                coverage_norm=args.coverage_norm,
+                control=control,
+                rescale=args.rescale,
+                rescale_pad=args.rescale_pad,
+                rescale_size=args.rescale_size,
+                ignore_diags=args.ignore_diags,
+                dtype=args.dtype,
+            )
+            os.makedirs(args.outdir, exist_ok=True)
+            headerdict = vars(args)
+            headerdict["resolution"] = int(c.binsize)
+            headerdict["n"] = int(n)
+            headerdict["cells"] = len(cells)
             save_array_with_header(pup, headerdict, os.path.join(args.outdir, outname))
-        except FileNotFoundError:
+            root, ext = _split_outname(outname)
+            table_outname = f"{root}_cells.tsv"
+            table.to_csv(
+                os.path.join(args.outdir, table_outname), sep="\t", index=False
+            )
+            logging.info(
+                f"Saved aggregate pileup and table of {len(cells)} cells to"
+                f" {args.outdir}"
+            )
+        elif args.anchors is not None:
+            if anchor or args.by_window or args.local:
+                raise ValueError("Can't use a list of anchors with anchor, by-window or local")
+            loops = PU.pileupsByAnchor(nproc=nproc)
+            os.makedirs(args.outdir, exist_ok=True)
+            root, ext = _split_outname(outname)
+            for (chrom, start, end), (n, pup) in loops.items():
+                headerdict = vars(args)
+                headerdict["resolution"] = int(c.binsize)
+                headerdict["anchor"] = f"{chrom}:{start}-{end}"
+                headerdict["n"] = int(n)
+                anchor_outname = f"{root}_{chrom}:{start}-{end}{ext}"
+                save_array_with_header(
+                    pup, headerdict, os.path.join(args.outdir, anchor_outname)
+                )
+            logging.info(f"Saved {len(loops)} anchor pileups to {args.outdir}")
+        elif args.groups:
+            if args.by_window or distance_bins is not None:
+                raise ValueError("Can't use groups with by-window or distance bins")
+            loops = PU.pileupsByGroupWithControl(nproc=nproc)
+            os.makedirs(args.outdir, exist_ok=True)
+            root, ext = _split_outname(outname)
+            for group, (n, pup) in loops.items():
+                if isinstance(group, tuple):
+                    group = "-".join(group)
+                headerdict = vars(args)
+                headerdict["resolution"] = int(c.binsize)
+                headerdict["group"] = group
+                headerdict["n"] = int(n)
+                group_outname = f"{root}_group_{group}{ext}"
+                save_array_with_header(
+                    pup, headerdict, os.path.join(args.outdir, group_outname)
+                )
+            logging.info(f"Saved {len(loops)} group pileups to {args.outdir}")
+        elif pads is not None or norms is not None:
+            if args.by_window or args.rescale or distance_bins is not None:
+                raise ValueError(
+                    "Can't use several pads or norms with by-window, rescale or distance bins"
+                )
+            if norms is None:
+                if not balance:
+                    norms = ["coverage" if args.coverage_norm else "unbalanced"]
+                else:
+                    norms = ["balanced"]
+            loops = PU.pileupsVariantsWithControl(pads=pads, norms=norms, nproc=nproc)
+            os.makedirs(args.outdir, exist_ok=True)
+            root, ext = _split_outname(outname)
+            for (variant_pad, norm), (n, pup) in loops.items():
+                headerdict = vars(args)
+                headerdict["resolution"] = int(c.binsize)
+                headerdict["pad"] = variant_pad // 1000
+                headerdict["norm"] = norm
+                headerdict["n"] = int(n)
+                variant_outname = f"{root}_pad{variant_pad // 1000}kb_{norm}{ext}"
+                save_array_with_header(
+                    pup, headerdict, os.path.join(args.outdir, variant_outname)
+                )
+            logging.info(f"Saved {len(loops)} pileups to {args.outdir}")
+        elif distance_bins is not None:
+            if anchor or args.by_window or args.local:
+                raise ValueError("Can't use distance bins with anchor, by-window or local")
+            loops = PU.pileupsByDistanceWithControl(nproc=nproc)
+            os.makedirs(args.outdir, exist_ok=True)
+            root, ext = _split_outname(outname)
+            for (start, end), (n, pup) in loops.items():
+                headerdict = vars(args)
+                headerdict["resolution"] = int(c.binsize)
+                headerdict["distance_band"] = f"{start}-{end}"
+                headerdict["n"] = int(n)
+                band_outname = f"{root}_dist_{start}-{end}{ext}"
+                save_array_with_header(
+                    pup, headerdict, os.path.join(args.outdir, band_outname)
+                )
+            logging.info(f"Saved {len(loops)} distance band pileups to {args.outdir}")
+        elif args.by_window:
+            if CC.kind != "bed":
+                raise ValueError("Can't make by-window pileups without making combinations")
+            if args.local:
+                raise ValueError("Can't make local by-window pileups")
+            if anchor:
+                raise ValueError("Can't make by-window combinations with an anchor")
+            #        if args.coverage_norm:
+            #            raise NotImplementedError("""Can't make by-window combinations with
+            #                                      coverage normalization - please use
+            #                                      balanced data instead""")
+            finloops = PU.pileupsByWindowWithControl(
+                nproc=nproc, stats_only=not args.save_all
+            )
+
+            p = Pool(nproc)
+            data = p.map(prepare_single, finloops.items())
+            p.close()
+            data = pd.DataFrame(
+                data,
+                columns=[
+                    "chr",
+                    "start",
+                    "end",
+                    "N",
+                    "Enrichment1",
+                    "Enrichment3",
+                    "CV3",
+                    "CV5",
+                ],
+            )
+            data = data.reindex(
+                index=order_by_index(
+                    data.index, index_natsorted(zip(data["chr"], data["start"]))
+                )
+            )
             try:
+                data.to_csv(os.path.join(args.outdir, outname), sep="\t", index=False)
+            except FileNotFoundError:
                 os.mkdir(args.outdir)
-            except FileExistsError:
-                pass
-            save_array_with_header(pup, headerdict, os.path.join(args.outdir, outname))
-        finally:
-            logging.info(f"Saved output to {os.path.join(args.outdir, outname)}")
+                data.to_csv(os.path.join(args.outdir, outname), sep="\t", index=False)
+            finally:
+                logging.info(
+                    f"Saved enrichment table to {os.path.join(args.outdir, outname)}"
+                )
+
+            if args.save_all:
+                outdict = {
+                    "%s:%s-%s" % key: (val[0], val[1].tolist())
+                    for key, val in finloops.items()
+                }
+                import json
+
+                json_path = (
+                    os.path.join(args.outdir, os.path.splitext(outname)[0]) + ".json"
+                )
+                with open(json_path, "w") as fp:
+                    json.dump(outdict, fp)  # , sort_keys=True, indent=4)
+                    logging.info(f"Saved individual pileups to {json_path}")
+        else:
+            if c.binsize in coarsened:
+                n, pup = coarsened[c.binsize]
+            else:
+                pup, n = PU.pileupsWithControl(nproc)
+            headerdict = vars(args)
+            headerdict['resolution'] = int(c.binsize)
+            headerdict['n'] = int(n)
+            try:
+                save_array_with_header(pup, headerdict, os.path.join(args.outdir, outname))
+            except FileNotFoundError:
+                try:
+                    os.mkdir(args.outdir)
+                except FileExistsError:
+                    pass
+                save_array_with_header(pup, headerdict, os.path.join(args.outdir, outname))
+            finally:
+                logging.info(f"Saved output to {os.path.join(args.outdir, outname)}")
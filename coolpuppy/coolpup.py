@@ -5,15 +5,27 @@ import sys
 import warnings
 import pandas as pd
 import itertools
+import copy
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from functools import partial
 import logging
 from natsort import index_natsorted, order_by_index, natsorted
-from scipy import sparse
+from scipy import sparse, signal
 from scipy.linalg import toeplitz
 from cooltools import numutils, snipping
 import yaml
 import io
+import os
+import queue
+import threading
+import bisect
+import gzip
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 
 def save_array_with_header(array, header, filename):
@@ -208,6 +220,30 @@ def prepare_single(item):
     return list(key) + [n, enr1, enr3, cv3, cv5]
 
 
+def get_stats_mask(size):
+    """Get which pixels of a pileup are used by `prepare_single`
+
+    Parameters
+    ----------
+    size : int
+        Side of the pileup.
+
+    Returns
+    -------
+    mask : 2D array of bool
+        True for pixels used for enrichment or corner CV.
+
+    """
+    mask = np.zeros((size, size), dtype=bool)
+    c = int(np.floor(size / 2))
+    for n in (1, 3):
+        mask[c - n // 2 : c + n // 2 + 1, c - n // 2 : c + n // 2 + 1] = True
+    for i in (3, 5):
+        mask[0:i, 0:i] = True
+        mask[-i:, -i:] = True
+    return mask
+
+
 def norm_coverage(loop, cov_start, cov_end):
     """Normalize a pileup by coverage arrays
 
@@ -233,990 +269,4638 @@ def norm_coverage(loop, cov_start, cov_end):
     return loop
 
 
-class CoordCreator:
+def coarsen_pileup(result, factor, pad_bins):
+    """Aggregate accumulated pileup of a chromosome to a coarser resolution
+
+    Blocks of factor x factor pixels are summed around the central pixel, so the
+    coarse windows are centred on the fine bins of the regions, not on the coarse
+    bins. For unbalanced data this only differs from a pileup of the coarse data by
+    this shift of the grid, balanced data is summed from the balanced fine pixels.
+
+    Parameters
+    ----------
+    result : tuple
+        (pileup, num, cov_start, cov_end, n), as returned by `pileup_chrom`.
+    factor : int
+        Odd ratio of the coarse and fine resolutions.
+    pad_bins : int
+        Padding of the coarse windows, in coarse bins.
+
+    Returns
+    -------
+    result : tuple
+        The same at the coarse resolution. num is the average number of valid fine
+        pixels in the coarse pixels.
+
+    """
+    if factor % 2 == 0:
+        raise ValueError("Can only aggregate pileups by an odd factor")
+    pileup, num, cov_start, cov_end, n = result
+    size = 2 * pad_bins + 1
+    lo = pileup.shape[0] // 2 - pad_bins * factor - factor // 2
+    hi = lo + size * factor
+    if lo < 0:
+        raise ValueError("The pileup is too small to be aggregated with this padding")
+    pileup = pileup[lo:hi, lo:hi].reshape(size, factor, size, factor).sum(axis=(1, 3))
+    num = num[lo:hi, lo:hi].reshape(size, factor, size, factor).sum(axis=(1, 3))
+    cov_start = cov_start[lo:hi].reshape(size, factor).sum(axis=1)
+    cov_end = cov_end[lo:hi].reshape(size, factor).sum(axis=1)
+    return pileup, num / factor ** 2, cov_start, cov_end, n
+
+
+def _accumulate_windows(
+    indptr, indices, values, weights, lo_lefts, lo_rights, flips, size, ignore_diags,
+    local, out, num,
+):
+    """Add windows from a csr matrix into a pileup, one pixel at a time
+
+    This is the loop compiled by numba when it's available, see
+    `accumulate_windows`.
+
+    """
+    window = np.zeros((size, size))
+    for w in range(lo_lefts.shape[0]):
+        r0 = lo_lefts[w]
+        c0 = lo_rights[w]
+        window[:, :] = 0.0
+        for a in range(size):
+            start = indptr[r0 + a]
+            end = indptr[r0 + a + 1]
+            p = start + np.searchsorted(indices[start:end], c0)
+            while p < end and indices[p] < c0 + size:
+                window[a, indices[p] - c0] = (
+                    values[p] * weights[r0 + a] * weights[indices[p]]
+                )
+                p += 1
+        if local:
+            for a in range(size):
+                for b in range(size):
+                    if b - a < ignore_diags:
+                        window[a, b] = 0.0
+            for a in range(size):
+                for b in range(a):
+                    window[a, b] = window[b, a]
+        for a in range(size):
+            for b in range(size):
+                if not local and c0 - r0 + b - a < ignore_diags:
+                    continue
+                v = window[a, b]
+                if not np.isfinite(v):
+                    continue
+                if flips[w] == 1:
+                    i, j = size - 1 - b, size - 1 - a
+                elif flips[w] == 2:
+                    i, j = b, size - 1 - a
+                else:
+                    i, j = a, b
+                out[i, j] += v
+                num[i, j] += 1
+
+
+if numba is not None:
+    _accumulate_windows = numba.njit(nogil=True)(_accumulate_windows)
+
+
+def _accumulate_windows_numpy(
+    data, weights, lo_lefts, lo_rights, flips, size, ignore_diags, local, out, num,
+    batchsize=1000,
+):
+    """Add windows from a csr matrix into a pileup, in vectorized batches
+
+    Pure NumPy equivalent of `_accumulate_windows`, used when numba is not
+    available.
+
+    """
+    offsets = np.arange(size)
+    for start in range(0, len(lo_lefts), batchsize):
+        lo_left = lo_lefts[start : start + batchsize]
+        lo_right = lo_rights[start : start + batchsize]
+        flip = flips[start : start + batchsize]
+        rows = np.broadcast_to(
+            lo_left[:, None, None] + offsets[None, :, None], (len(lo_left), size, size)
+        )
+        cols = np.broadcast_to(
+            lo_right[:, None, None] + offsets[None, None, :], (len(lo_left), size, size)
+        )
+        windows = np.asarray(data[rows.ravel(), cols.ravel()], dtype=float).reshape(
+            -1, size, size
+        )
+        if weights is not None:
+            windows = np.where(
+                windows != 0, windows * weights[rows] * weights[cols], 0
+            )
+        if local:
+            windows = np.triu(windows, ignore_diags)
+            windows += np.swapaxes(np.triu(windows, 1), 1, 2)
+        else:
+            diags = (lo_right - lo_left)[:, None, None] + offsets - offsets[:, None]
+            windows[diags < ignore_diags] = np.nan
+        windows[flip == 1] = np.swapaxes(windows[flip == 1][:, ::-1, ::-1], 1, 2)
+        windows[flip == 2] = np.swapaxes(windows[flip == 2][:, ::-1, :], 1, 2)
+        out += np.nansum(windows, axis=0)
+        num += np.sum(np.isfinite(windows), axis=0)
+
+
+def accumulate_windows(
+    data, lo_lefts, lo_rights, flips, size, ignore_diags=2, local=False, weights=None,
+):
+    """Sum up square windows of a sparse upper triangular matrix
+
+    Uses a numba-compiled loop over the csr arrays if numba is installed, and a
+    vectorized NumPy implementation otherwise.
+
+    Parameters
+    ----------
+    data : csr
+        Upper triangular matrix.
+    lo_lefts, lo_rights : 1D arrays of int
+        First row and column of each window.
+    flips : 1D array of int
+        How to orient each window before adding it: 0 as is, 1 flipped and rotated
+        as a window with swapped ends, 2 rotated as a window with swapped ends next
+        to an anchor.
+    size : int
+        Side of the windows.
+    ignore_diags : int, optional
+        How many diagonals of the matrix to ignore. The default is 2.
+    local : bool, optional
+        Whether the windows are on the diagonal, then they are made symmetric.
+        The default is False.
+    weights : 1D array, optional
+        Balancing weights to apply to the stored pixels of the raw matrix.
+        The default is None.
+
+    Returns
+    -------
+    out : 2D array
+        Sum of the windows, ignoring NaNs.
+    num : 2D array
+        Number of finite values summed in each pixel.
+
+    """
+    out = np.zeros((size, size))
+    num = np.zeros((size, size))
+    lo_lefts = np.asarray(lo_lefts, dtype=np.int64)
+    lo_rights = np.asarray(lo_rights, dtype=np.int64)
+    flips = np.asarray(flips, dtype=np.int64)
+    if numba is not None:
+        data = sparse.csr_matrix(data)
+        data.sort_indices()
+        if weights is None:
+            weights = np.ones(data.shape[0])
+        _accumulate_windows(
+            data.indptr,
+            data.indices,
+            np.asarray(data.data, dtype=float),
+            np.asarray(weights, dtype=float),
+            lo_lefts,
+            lo_rights,
+            flips,
+            size,
+            ignore_diags,
+            local,
+            out,
+            num,
+        )
+    else:
+        _accumulate_windows_numpy(
+            data, weights, lo_lefts, lo_rights, flips, size, ignore_diags, local, out,
+            num,
+        )
+    return out, num
+
+
+def _scatter_windows(
+    indptr, indices, values, weights, lo_lefts, lo_rights, flips, size, ignore_diags,
+    local, out, nans,
+):
+    """Add only the stored pixels of windows from a csr matrix into a pileup
+
+    This is the loop compiled by numba when it's available, see
+    `accumulate_windows_sparse`.
+
+    """
+    last = size - 1
+    for w in range(lo_lefts.shape[0]):
+        r0 = lo_lefts[w]
+        c0 = lo_rights[w]
+        for a in range(size):
+            start = indptr[r0 + a]
+            end = indptr[r0 + a + 1]
+            p = start + np.searchsorted(indices[start:end], c0)
+            while p < end and indices[p] < c0 + size:
+                b = indices[p] - c0
+                v = values[p] * weights[r0 + a] * weights[indices[p]]
+                p += 1
+                if c0 - r0 + b - a < ignore_diags:
+                    continue
+                for mirror in range(2 if local and b > a else 1):
+                    x, y = (b, a) if mirror else (a, b)
+                    if flips[w] == 1:
+                        i, j = last - y, last - x
+                    elif flips[w] == 2:
+                        i, j = y, last - x
+                    else:
+                        i, j = x, y
+                    if np.isfinite(v):
+                        out[i, j] += v
+                    else:
+                        nans[i, j] += 1
+
+
+def _count_stored(indptr, indices, lo_lefts, lo_rights, size):
+    """Count stored pixels of windows of a csr matrix"""
+    nnz = 0
+    for w in range(lo_lefts.shape[0]):
+        c0 = lo_rights[w]
+        for row in range(lo_lefts[w], lo_lefts[w] + size):
+            cols = indices[indptr[row] : indptr[row + 1]]
+            nnz += np.searchsorted(cols, c0 + size) - np.searchsorted(cols, c0)
+    return nnz
+
+
+if numba is not None:
+    _scatter_windows = numba.njit(nogil=True)(_scatter_windows)
+    _count_stored = numba.njit(nogil=True)(_count_stored)
+
+
+def accumulate_windows_sparse(
+    data, lo_lefts, lo_rights, flips, size, ignore_diags=2, local=False, weights=None,
+):
+    """Sum up square windows of a sparse upper triangular matrix, visiting only the
+    stored pixels of each window
+
+    Same as `accumulate_windows`, but the work per window doesn't depend on its
+    area, so it's faster for very sparse data. The number of valid values of each
+    pixel is the number of windows where it's outside the ignored diagonals, minus
+    the stored pixels that are not finite (e.g. of bins with NaN weights). Uses a
+    numba-compiled loop if numba is installed, and a `WindowIndex` otherwise.
+
+    Parameters
+    ----------
+    Same as `accumulate_windows`.
+
+    Returns
+    -------
+    out : 2D array
+        Sum of the windows, ignoring NaNs.
+    num : 2D array
+        Number of finite values summed in each pixel.
+
+    """
+    data = sparse.csr_matrix(data)
+    data.sort_indices()
+    index = WindowIndex(lo_lefts, lo_rights, flips, size, data.shape[0])
+    if numba is not None:
+        out = np.zeros((size, size))
+        nans = np.zeros((size, size))
+        if weights is None:
+            weights = np.ones(data.shape[0])
+        _scatter_windows(
+            data.indptr,
+            data.indices,
+            np.asarray(data.data, dtype=float),
+            np.asarray(weights, dtype=float),
+            np.asarray(lo_lefts, dtype=np.int64),
+            np.asarray(lo_rights, dtype=np.int64),
+            np.asarray(flips, dtype=np.int64),
+            size,
+            ignore_diags,
+            local,
+            out,
+            nans,
+        )
+    else:
+        pixels = data.tocoo()
+        values = pixels.data.astype(float)
+        if weights is not None:
+            values = values * weights[pixels.row] * weights[pixels.col]
+        out, nans = index.accumulate(
+            (pixels.row, pixels.col, values), ignore_diags=ignore_diags, local=local
+        )
+        out, nans = out[0], nans[0]
+    num = index.count_valid(ignore_diags=ignore_diags, local=local)[0] - nans
+    return out, num
+
+
+class WindowIndex:
     def __init__(
-        self,
-        baselist,
-        resolution,
-        basetype='auto',
-        bed2=None,
-        bed2_ordered=True,
-        anchor=False,
-        pad=100000,
-        chroms="all",
-        minshift=10 ** 5,
-        maxshift=10 ** 6,
-        nshifts=10,
-        mindist="auto",
-        maxdist=None,
-        minsize=0,
-        maxsize=None,
-        local=False,
-        subset=0,
-        seed=None,
+        self, lo_lefts, lo_rights, flips, size, n_bins, groups=None, n_groups=1,
     ):
-        """Generator of coordinate pairs for pileups.
+        """Index of square windows of a matrix, to add pixels to all windows that
+        contain them.
+
+        Windows are sorted by their first row and then first column, so the windows
+        that contain a pixel at a given row offset form one contiguous range, found
+        with a binary search.
 
         Parameters
         ----------
-        baselist : str
-            Path to a bed- or bedpe-style file with coordinates.
-        resolution : int
-            Data resolution.
-        basetype : str, optional
-            Format of the baselist. Options:
-                bed: chrom, start, end
-                bedpe: chrom1, start1, end1, chrom2, start2, end2
-                auto (default): determined from the number of columns in the file
-        bed2 : str, optional
-            Path to a second bed-style file with coordinates. If specified,
-            interactions between baselist and bed2 are used.
-            The default is None.
-        bed2_ordered : bool, optional
-            Whether interactions always have coordinates from baselist on the left and
-            from bed2 on the bottom. If False, all interactions will be considered
-            irrespective of order.
-            The default is True.
-        anchor : tuple of (str, int, int), optional
-            Coordinates (chr, start, end) of an anchor region used to create
-            interactions with baselist (in bp). Anchor is on the left of the final pileup.
-            The default is False.
-        pad : int, optional
-            Paddin around the central bin, in bp. For example, with 5000 bp resolution
-            and 100000 pad, final pileup is 205000×205000 bp.
-            The default is 100000.
-        chroms : str or list, optional
-            Which chromosomes to use for pileups. Has to be in a list even for a
-            single chromosome, e.g. ['chr1'].
-            The default is "all"
-        minshift : int, optional
-            Minimal shift applied when generating random controls, in bp.
-            The default is 10 ** 5.
-        maxshift : int, optional
-            Maximal shift applied when generating random controls, in bp.
-            The default is 10 ** 6.
-        nshifts : int, optional
-            How many shifts to generate per region of interest. Does not take chromosome
-            boundaries into account
-            The default is 10.
-        mindist : int, optional
-            Shortest interactions to consider. Uses midpoints of regions of interest.
-            "auto" selects it to avoid the two shortest diagonals of the matrix, i.e.
-            2 * pad + 2 * resolution
-            The default is "auto".
-        maxdist : int, optional
-            Longest interactions to consider.
-            The default is None.
-        minsize : int, optional
-            Shortest regions to consider. Only applies to bed files.
-            The default is 0.
-        maxsize : int, optional
-            Longest regions to consider. Only applies to bed files.
-            The default is None.
+        lo_lefts, lo_rights : 1D arrays of int
+            First row and column of each window.
+        flips : 1D array of int
+            How to orient each window, same as in `accumulate_windows`.
+        size : int
+            Side of the windows.
+        n_bins : int
+            Size of the matrix.
+        groups : 1D array of int, optional
+            Which pileup each window belongs to. The default is None, then all
+            windows belong to the same pileup.
+        n_groups : int, optional
+            Number of pileups. The default is 1.
+
+        """
+        lo_lefts = np.asarray(lo_lefts, dtype=np.int64)
+        lo_rights = np.asarray(lo_rights, dtype=np.int64)
+        if groups is None:
+            groups = np.zeros(len(lo_lefts), dtype=np.int64)
+        keys = lo_lefts * n_bins + lo_rights
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.lo_lefts = lo_lefts[order]
+        self.lo_rights = lo_rights[order]
+        self.flips = np.asarray(flips, dtype=np.int64)[order]
+        self.groups = np.asarray(groups, dtype=np.int64)[order]
+        self.size = size
+        self.n_bins = n_bins
+        self.n_groups = n_groups
+        self.row_mask = self._covered(self.lo_lefts)
+        self.col_mask = self._covered(self.lo_rights)
+
+    def _covered(self, starts):
+        """Which bins are covered by at least one window starting at starts"""
+        edges = np.zeros(self.n_bins + 1, dtype=np.int64)
+        np.add.at(edges, starts, 1)
+        np.add.at(edges, np.minimum(starts + self.size, self.n_bins), -1)
+        return np.cumsum(edges[:-1]) > 0
+
+    def find(self, rows, cols):
+        """Find all windows that contain each pixel
+
+        Parameters
+        ----------
+        rows, cols : 1D arrays of int
+            Coordinates of the pixels.
+
+        Returns
+        -------
+        pixels, windows : 1D arrays of int
+            Indices of pixels and of the (sorted) windows containing them, one
+            element per match.
+
+        """
+        offsets = np.arange(self.size)
+        first_rows = (rows[:, None] - offsets).ravel()
+        first_cols = np.repeat(np.maximum(cols - self.size + 1, 0), self.size)
+        last_cols = np.repeat(cols, self.size)
+        starts = np.searchsorted(self.keys, first_rows * self.n_bins + first_cols)
+        ends = np.searchsorted(
+            self.keys, first_rows * self.n_bins + last_cols, side="right"
+        )
+        counts = ends - starts
+        queries = np.repeat(np.arange(len(counts)), counts)
+        windows = np.arange(np.sum(counts)) + np.repeat(
+            starts - np.cumsum(counts) + counts, counts
+        )
+        return queries // self.size, windows
+
+    def accumulate(self, pixels, ignore_diags=2, local=False):
+        """Add a chunk of pixels to the windows that contain them
+
+        Parameters
+        ----------
+        pixels : tuple of 1D arrays
+            Rows, columns and values of pixels of the upper triangular matrix.
+        ignore_diags : int, optional
+            How many diagonals of the matrix to ignore. The default is 2.
         local : bool, optional
-            Whether to generate local coordinates, i.e. on-diagonal.
+            Whether the windows are on the diagonal, then they are made symmetric.
             The default is False.
-        subset : int, optional
-            What subset of the coordinate files to use. 0 or negative to use all.
-            The default is 0.
-        seed : int, optional
-            Seed for np.random to make it reproducible.
-            The default is None.
 
         Returns
         -------
-        Object that generates coordinates for pileups required for PileUpper.
+        out : 3D array
+            Sum of the pixels for each pileup, ignoring NaNs.
+        nans : 3D array
+            Number of non-finite pixels for each pileup.
 
         """
-        self.baselist = baselist
-        self.stdin = self.baselist == sys.stdin
-        self.resolution = resolution
-        self.basetype = basetype
-        self.bed2 = bed2
-        self.bed2_ordered = bed2_ordered
-        self.anchor = anchor
-        self.pad = pad
-        self.pad_bins = pad // self.resolution
-        self.chroms = chroms
-        self.minshift = minshift
-        self.maxshift = maxshift
-        self.nshifts = nshifts
-        if mindist == "auto":
-            self.mindist = 2 * self.pad + 2 * self.resolution
-        else:
-            self.mindist = mindist
-        if maxdist is None:
-            self.maxdist = np.inf
-        else:
-            self.maxdist = maxdist
-        self.minsize = minsize
-        if maxsize is None:
-            self.maxsize = np.inf
-        else:
-            self.maxsize = maxsize
-        self.local = local
-        self.subset = subset
-        self.seed = seed
-        self.process()
+        rows, cols, values = pixels
+        keep = (cols - rows >= ignore_diags) & self.row_mask[rows] & self.col_mask[cols]
+        rows, cols, values = rows[keep], cols[keep], values[keep]
+        pixels, windows = self.find(rows, cols)
+        a = rows[pixels] - self.lo_lefts[windows]
+        b = cols[pixels] - self.lo_rights[windows]
+        values = values[pixels]
+        flips = self.flips[windows]
+        groups = self.groups[windows]
+        if local:
+            mirror = b > a
+            a, b = np.concatenate([a, b[mirror]]), np.concatenate([b, a[mirror]])
+            values = np.concatenate([values, values[mirror]])
+            flips = np.concatenate([flips, flips[mirror]])
+            groups = np.concatenate([groups, groups[mirror]])
+        last = self.size - 1
+        i = np.where(flips == 1, last - b, np.where(flips == 2, b, a))
+        j = np.where(flips == 0, b, last - a)
+        flat = (groups * self.size + i) * self.size + j
+        shape = (self.n_groups, self.size, self.size)
+        length = self.n_groups * self.size ** 2
+        finite = np.isfinite(values)
+        notnan = ~np.isnan(values)
+        out = np.bincount(flat[notnan], values[notnan], minlength=length)
+        nans = np.bincount(flat[~finite], minlength=length)
+        return out.reshape(shape), nans.reshape(shape)
+
+    def count(self):
+        """Number of windows in each pileup"""
+        return np.bincount(self.groups, minlength=self.n_groups)
+
+    def count_valid(self, ignore_diags=2, local=False):
+        """Number of windows with each pixel outside of the ignored diagonals
 
-    def filter_bed(self, df):
-        length = df["end"] - df["start"]
-        df = df[(length >= self.minsize) & (length <= self.maxsize)]
-        if self.chroms != "all":
-            df = df[df["chr"].isin(self.chroms)]
-        if not np.all(df["end"] >= df["start"]):
-            raise ValueError("Some ends in the file are smaller than starts")
-        return df
+        Parameters
+        ----------
+        ignore_diags : int, optional
+            How many diagonals of the matrix to ignore. The default is 2.
+        local : bool, optional
+            Whether the windows are on the diagonal. The default is False.
 
-    def filter_bedpe(self, df):
-        mid1 = np.mean(df[["start1", "end1"]], axis=1)
-        mid2 = np.mean(df[["start2", "end2"]], axis=1)
-        length = mid2 - mid1
-        df = df[(length >= self.mindist) & (length <= self.maxdist)]
-        if self.chroms != "all":
-            df = df[(df["chr1"].isin(self.chroms)) & (df["chr2"].isin(self.chroms))]
-        return df
+        Returns
+        -------
+        valid : 3D array
+            Count for each pixel of each pileup.
 
-    def auto_read_bed(
-        self, file, kind="auto",
-    ):
-        row1 = None
-        if kind == "auto":  # Guessing whether it's bed or bedpe style file
-            if self.stdin:
-                row1 = file.__next__().split("\t")
-            else:
-                with open(file, "r") as fobject:
-                    row1 = fobject.readline().split("\t")
-            if len(row1) == 6:
-                try:
-                    row1 = [
-                        row1[0],
-                        int(row1[1]),
-                        int(row1[2]),
-                        row1[3],
-                        int(row1[4]),
-                        int(row1[5]),
-                    ]
-                    kind = "bedpe"
-                except:
-                    raise ValueError("Can't determine the type of baselist file,"
-                                     "please specify bed or bedpe")
-            elif len(row1) == 3:
-                try:
-                    row1 = [row1[0], int(row1[1]), int(row1[2])]
-                    kind = "bed"
-                except:
-                    raise ValueError("Can't determine the type of baselist file,"
-                                     "please specify bed or bedpe")
-            else:
-                raise ValueError(
-                    f"""Input bed(pe) file has unexpected number of
-                        columns: got {len(row1)}, expect 3 (bed) or 6 (bedpe)
-                        """
-                )
+        """
+        shape = (self.n_groups, self.size, self.size)
+        if local:
+            return np.broadcast_to(self.count()[:, None, None], shape).astype(float)
+        # Beyond these diagonals, windows are either fully valid or fully ignored
+        diags = np.arange(ignore_diags - self.size, ignore_diags + self.size)
+        shifts = (
+            np.clip(self.lo_rights - self.lo_lefts, diags[0], diags[-1]) - diags[0]
+        )
+        counts = np.bincount(
+            (self.groups * 3 + self.flips) * len(diags) + shifts,
+            minlength=self.n_groups * 3 * len(diags),
+        ).reshape(self.n_groups, 3, len(diags))
+        offsets = np.arange(self.size)
+        masks = (
+            diags[:, None, None] + offsets[None, None, :] - offsets[None, :, None]
+            >= ignore_diags
+        ).astype(float)
+        oriented = np.stack(
+            [
+                masks,
+                np.rot90(np.flip(masks, axis=1), 1, axes=(1, 2)),
+                np.rot90(masks, -1, axes=(1, 2)),
+            ]
+        )
+        return np.einsum("gfd,fdij->gij", counts, oriented)
 
-        if kind == "bed":
-            filter_func = self.filter_bed
-            names = ["chr", "start", "end"]
-            dtype = {"chr": "str", "start": "int", "end": "int"}
-            if row1 is not None:
-                row1 = filter_func(pd.DataFrame([row1], columns=names).astype(dtype=dtype))
-        elif kind == "bedpe":  # bedpe
-            filter_func = self.filter_bedpe
-            names = ["chr1", "start1", "end1", "chr2", "start2", "end2"]
-            dtype = {
-                "chr1": "str",
-                "start1": "int",
-                "end1": "int",
-                "chr2": "str",
-                "start2": "int",
-                "end2": "int",
-            }
-            if row1 is not None:
-                row1 = filter_func(pd.DataFrame([row1], columns=names).astype(dtype=dtype))
-        else:
-            raise ValueError(
-                f"""Unsupported input kind: {kind}.
-                             Expect auto, bed or bedpe"""
-            )
-        bases = []
-        
-        if self.stdin:
-            if row1 is not None:
-                if row1.shape[0] == 1:
-                    bases.append(row1)
 
-        for chunk in pd.read_csv(
-            file,
-            sep="\t",
-            names=names,
-            index_col=False,
-            chunksize=10 ** 4,
-            dtype=dtype,
-        ):
-            bases.append(filter_func(chunk))
-        bases = pd.concat(bases)
-        if not self.stdin:  # Would mean we read it twice when checking and in the first chunk
-            bases = bases.iloc[1:]
+class BandedMatrix:
+    def __init__(self, n, mindiag, maxdiag, dtype=float):
+        """Dense storage of a diagonal band of a square upper triangular matrix.
 
-            # bases["chr"] = bases["chr"].astype(str)
-            # bases[["start", "end"]] = bases[["start", "end"]].astype(np.uint64)
+        Element (i, j) of the matrix is stored in ``band[i, j - i - mindiag]``, so
+        that any window fully inside the band can be returned as a strided view of
+        the underlying array without copying.
 
-            # bases[["chr1", "chr2"]] = bases[["chr1", "chr2"]].astype(str)
-            # bases[["start1", "end1", "start2", "end2"]] = bases[
-            # ["start1", "end1", "start2", "end2"]
-            # ].astype(np.uint64)
-        return bases, kind
+        Parameters
+        ----------
+        n : int
+            Size of the matrix.
+        mindiag : int
+            Lowest diagonal to store. Can be negative, then diagonals below the main
+            one are stored as zeros so that windows crossing the main diagonal can
+            still be extracted.
+        maxdiag : int
+            Highest diagonal to store.
+        dtype : dtype, optional
+            Type of stored values.
+            The default is float.
 
-    def subset(self, df):
-        if self.seed is not None:
-            np.random.seed(self.seed)
-        if self.subset > 0 and self.subset < len(df):
-            return df.sample(self.subset)
-        else:
-            return df
+        Returns
+        -------
+        Object that stores the band and returns windows from it.
 
-    def bedpe2bed(self, df, ends=True, how="center"):
-        # If ends==True, will combine all coordinates from both loop ends into one bed-style df
-        # Else, will convert to long intervals covering the whole loop, for e.g. rescaled averaging
-        # how: center - take center of loop bases; inner or outer
-        if ends:
-            df1 = df[["chr1", "start1", "end1"]]
-            df1.columns = ["chr", "start", "end"]
-            df2 = df[["chr2", "start2", "end2"]]
-            df2.columns = ["chr", "start", "end"]
-            return (
-                pd.concat([df1, df2])
-                .sort_values(["chr", "start", "end"])
-                .reset_index(drop=True)
-            )
+        """
+        if maxdiag < mindiag:
+            raise ValueError("maxdiag has to be larger than or equal to mindiag")
+        self.shape = (n, n)
+        self.mindiag = mindiag
+        self.maxdiag = maxdiag
+        self.width = maxdiag - mindiag + 1
+        self.band = np.zeros((n, self.width), dtype=dtype)
+        # Coverage of the whole matrix, if it was counted when loading the band
+        self.full_coverage = None
+
+    def add_pixels(self, rows, cols, values):
+        """Store pixels of the matrix, ignoring those outside of the band
 
-        if how == "center":
-            df["start"] = np.mean(df["start1"], df["end1"], axis=0)
-            df["end"] = np.mean(df["start2"], df["end2"], axis=0)
-        elif how == "outer":
-            df = df[["chr1", "start1", "end2"]]
-            df.columns = ["chr", "start", "end"]
-        elif how == "inner":
-            df = df[["chr1", "end1", "start2"]]
-            df.columns = ["chr", "start", "end"]
-        return df
+        Parameters
+        ----------
+        rows : 1D array
+            Row indices.
+        cols : 1D array
+            Column indices.
+        values : 1D array
+            Values of the pixels.
 
-    def _get_mids(self, intervals):
-        if self.kind == "bed":
-            intervals = intervals.sort_values(["chr", "start"])
-            mids = np.round((intervals["end"] + intervals["start"]) / 2).astype(int)
-            widths = np.round((intervals["end"] - intervals["start"])).astype(int)
-            mids = pd.DataFrame(
-                {
-                    "chr": intervals["chr"],
-                    "Mids": mids,
-                    "Bin": mids // self.resolution,
-                    "Pad": widths / 2,
-                }
-            ).drop_duplicates(
-                ["chr", "Bin"]
-            )  # .drop('Bin', axis=1)
-        elif self.kind == "bedpe":
-            intervals = intervals.sort_values(["chr1", "chr2", "start1", "start2"])
-            mids1 = np.round((intervals["end1"] + intervals["start1"]) / 2).astype(int)
-            widths1 = np.round((intervals["end1"] - intervals["start1"])).astype(int)
-            mids2 = np.round((intervals["end2"] + intervals["start2"]) / 2).astype(int)
-            widths2 = np.round((intervals["end2"] - intervals["start2"])).astype(int)
-            mids = pd.DataFrame(
-                {
-                    "chr1": intervals["chr1"],
-                    "Mids1": mids1,
-                    "Bin1": mids1 // self.resolution,
-                    "Pad1": widths1 / 2,
-                    "chr2": intervals["chr2"],
-                    "Mids2": mids2,
-                    "Bin2": mids2 // self.resolution,
-                    "Pad2": widths2 / 2,
-                },
-            ).drop_duplicates(
-                ["chr1", "chr2", "Bin1", "Bin2"]
-            )  # .drop(['Bin1', 'Bin2'], axis=1)
-        else:
-            raise ValueError(
-                """
-                kind can only be "bed" or "bedpe"
-                """
-            )
-        return mids
+        """
+        diags = cols - rows
+        keep = (diags >= max(self.mindiag, 0)) & (diags <= self.maxdiag)
+        self.band[rows[keep], diags[keep] - self.mindiag] = values[keep]
 
-    def filter_func_all(self, mids):
-        return mids
+    def __getitem__(self, key):
+        """Get a window of the matrix as a read-only view of the band
 
-    def _filter_func_chrom(self, mids, chrom):
-        return mids[mids["chr"] == chrom]
+        Parameters
+        ----------
+        key : tuple of slices
+            Rows and columns of the window, e.g. ``matrix[lo_left:hi_left,
+            lo_right:hi_right]``. Steps are not supported.
 
-    def _filter_func_pairs_chrom(self, mids, chrom):
-        return mids[(mids["chr1"] == chrom) & (mids["chr2"] == chrom)]
+        Returns
+        -------
+        window : 2D array
+            Strided view of the band with the requested window.
 
-    def filter_func_chrom(self, chrom):
-        if self.kind == "bed":
-            return partial(self._filter_func_chrom, chrom=chrom)
-        else:
-            return partial(self._filter_func_pairs_chrom, chrom=chrom)
+        """
+        rows, cols = key
+        lo_row, hi_row, _ = rows.indices(self.shape[0])
+        lo_col, hi_col, _ = cols.indices(self.shape[1])
+        height = max(hi_row - lo_row, 0)
+        width = max(hi_col - lo_col, 0)
+        if height == 0 or width == 0:
+            return np.zeros((height, width), dtype=self.band.dtype)
+        if (
+            lo_col - (hi_row - 1) < self.mindiag
+            or (hi_col - 1) - lo_row > self.maxdiag
+        ):
+            raise IndexError("Requested window is not fully inside the stored band")
+        itemsize = self.band.itemsize
+        offset = lo_row * self.width + lo_col - lo_row - self.mindiag
+        return np.lib.stride_tricks.as_strided(
+            self.band.ravel()[offset:],
+            shape=(height, width),
+            strides=((self.width - 1) * itemsize, itemsize),
+            writeable=False,
+        )
 
-    def _filter_func_region(self, mids, region):
-        chrom, start, end = region
-        start /= self.resolution
-        end /= self.resolution
-        return mids[
-            (mids["chr"] == chrom) & (mids["Bin"] >= start) & (mids["Bin"] < end)
-        ]
+    def get_pixels(self, rows, cols):
+        """Get values of individual pixels
 
-    def _filter_func_pairs_region(self, mids, region):
-        chrom, start, end = region
-        start /= self.resolution
-        end /= self.resolution
-        return mids[
-            (mids["chr1"] == chrom)
-            & (mids["chr2"] == chrom)
-            & (mids["Bin1"] >= start)
-            & (mids["Bin1"] < end)
-            & (mids["Bin2"] >= start)
-            & (mids["Bin2"] < end)
-        ]
+        Parameters
+        ----------
+        rows, cols : 1D arrays of int
+            Coordinates of the pixels, all inside the stored band.
 
-    def filter_func_region(self, region):
-        if self.kind == "bed":
-            return partial(self._filter_func_region, region)
-        else:
-            return partial(self._filter_func_pairs_region, region)
+        Returns
+        -------
+        values : 1D array
+            Values of the pixels.
 
-    def _get_combinations(self, filter_func, mids=None, mids2=None, anchor=None):
-        if anchor is None:
-            anchor = self.anchor
+        """
+        diags = cols - rows - self.mindiag
+        if np.any(diags < 0) or np.any(diags >= self.width):
+            raise IndexError("Requested pixels are not inside the stored band")
+        return self.band[rows, diags]
 
-        if (self.local and anchor) or (self.local and (self.mids2 is not None)):
-            raise ValueError(
-                """Can't have a local pileup with an anchor or with two bed files"""
-            )
-        if mids is None:
-            mids = self.mids
-        mids = filter_func(self.mids)
-        if not len(mids) >= 1:
-            logging.debug("Empty selection")
-            yield None, None, None, None
-        m = mids["Bin"].values.astype(int)
-        p = (mids["Pad"] // self.resolution).values.astype(int)
+    def coverage(self):
+        """Get total coverage profile of the stored upper triangular data
 
-        if mids2 is None:
-            mids2 = self.mids2
-        if mids2 is not None:
-            mids2 = filter_func(mids2)
-            m2 = mids2["Bin"].values.astype(int)
-            p2 = (mids2["Pad"] // self.resolution).values.astype(int)
-        if self.local:
-            for i, pi in zip(m, p):
-                yield i, i, pi, pi
-        elif anchor:
-            anchor_bin = int((anchor[1] + anchor[2]) / 2 // self.resolution)
-            anchor_pad = int(round((anchor[2] - anchor[1]) / 2)) // self.resolution
-            for i, pi in zip(m, p):
-                yield anchor_bin, i, anchor_pad, pi
-        elif mids2 is None:
-            for i, j in zip(itertools.combinations(m, 2), itertools.combinations(p, 2)):
-                yield list(i) + list(j)
-        elif (mids2 is not None) and self.bed2_ordered:
-            for i, j in zip(itertools.product(m, m2), itertools.product(p, p2)):
-                if i[1] > i[0]:
-                    yield list(i) + list(j)
-        elif (mids2 is not None) and (not self.bed2_ordered):
-            for i, j in itertools.chain(
-                zip(itertools.product(m, m2), itertools.product(p, p2)),
-                zip(itertools.product(m2, m), itertools.product(p2, p)),
-            ):
-                yield list(i) + list(j)
+        Returns
+        -------
+        coverage : array
+            1D array of coverage.
 
-    def get_combinations(self, filter_func, mids=None, mids2=None, anchor=None):
-        stream = self._get_combinations(filter_func, mids, mids2, anchor)
-        if not self.local:
-            stream = self.filter_pos_stream_distance(stream)
-        return stream
+        """
+        n = self.shape[0]
+        colsums = np.zeros(n)
+        for diag in range(max(self.mindiag, 0), min(self.maxdiag, n - 1) + 1):
+            colsums[diag:] += self.band[: n - diag, diag - self.mindiag]
+        rowsums = np.sum(self.band, axis=1)
+        return np.nan_to_num(colsums) + np.nan_to_num(rowsums)
 
-    def get_positions_stream(self, filter_func, mids=None):
-        if mids is None:
-            mids = self.mids
-        mids = filter_func(mids)
-        if not len(mids) >= 1:
-            logging.debug("Empty selection")
-            yield None, None
-        m = mids["Bin"].astype(int).values
-        p = (mids["Pad"] // self.resolution).astype(int).values
-        for posdata in zip(m, p):
-            yield posdata
 
-    def _get_position_pairs_stream(self, filter_func, mids=None):
-        if mids is None:
-            mids = self.mids
-        mids = filter_func(mids)
-        if not len(mids) >= 1:
-            logging.debug("Empty selection")
-            yield None, None, None, None
-        m1 = mids["Bin1"].astype(int).values
-        m2 = mids["Bin2"].astype(int).values
-        p1 = (mids["Pad1"] // self.resolution).astype(int).values
-        p2 = (mids["Pad2"] // self.resolution).astype(int).values
-        for posdata in zip(m1, m2, p1, p2):
-            yield posdata
+class BalancedMatrix:
+    def __init__(self, raw, weights, dtype=float, col_weights=None):
+        """Raw counts of an upper triangular matrix with balancing weights, which are
+        only applied to the pixels that are requested.
 
-    def get_position_pairs_stream(self, filter_func, mids=None):
-        stream = self._get_position_pairs_stream(filter_func, mids)
-        if not self.local:
-            stream = self.filter_pos_stream_distance(stream)
-        return stream
+        As with balancing by cooler, stored pixels of bins with NaN weights are NaN,
+        and pixels that are not stored stay 0.
 
-    def control_regions(self, filter_func, pos_pairs=None):
-        if self.seed is not None:
-            np.random.seed(self.seed)
-        minbin = self.minshift // self.resolution
-        maxbin = self.maxshift // self.resolution
-        if pos_pairs is None:
-            source = self.pos_stream(filter_func)
-        else:
-            source = pos_pairs
-        # try:
-        #     row1 = next(source)
-        # except StopIteration:
-        #     logging.debug("Empty selection")
-        #     raise StopIteration
-        # else:
-        #     source = itertools.chain([row1], source)
-        for start, end, p1, p2 in source:
-            for i in range(self.nshifts):
-                shift = np.random.randint(minbin, maxbin)
-                sign = np.sign(np.random.random() - 0.5).astype(int)
-                shift *= sign
-                yield start + shift, end + shift, p1, p2
+        Parameters
+        ----------
+        raw : csr, BandedMatrix or RowBlockMatrix
+            Raw counts.
+        weights : 1D array
+            Balancing weights of all bins.
+        dtype : dtype, optional
+            Type of returned windows and pixels.
+            The default is float.
+        col_weights : 1D array, optional
+            Balancing weights of the columns, if they are different bins from the
+            rows, e.g. in a block of two chromosomes. Then weights are only used for
+            the rows. The default is None.
 
-    def get_combinations_by_window(self, chrom, ctrl=False, mids=None):
-        assert self.kind == "bed"
-        if mids is None:
-            chrmids = self.filter_func_chrom(chrom)(self.mids)
+        Returns
+        -------
+        Object that returns balanced windows and pixels.
+
+        """
+        self.raw = raw
+        self.dtype = dtype
+        self.weights = np.asarray(weights, dtype=dtype)
+        if col_weights is None:
+            self.col_weights = self.weights
         else:
-            chrmids = self.filter_func_chrom(chrom)(mids)
-        for i, (b, m, p) in chrmids[["Bin", "Mids", "Pad"]].astype(int).iterrows():
-            out_stream = self.get_combinations(
-                self.filter_func_all, mids=chrmids, anchor=(chrom, m, m)
-            )
-            if ctrl:
-                out_stream = self.control_regions(self.filter_func_all, out_stream)
-            yield (m - p, m + p), out_stream
+            self.col_weights = np.asarray(col_weights, dtype=dtype)
+        self.shape = raw.shape
 
-    def filter_pos_stream_distance(self, stream):
-        for (m1, m2, p1, p2) in stream:
-            if self.mindist <= abs(m2 - m1) * self.resolution <= self.maxdist:
-                yield (m1, m2, p1, p2)
+    def __getitem__(self, key):
+        """Get a balanced window of the matrix
 
-    def empty_stream(self, *args, **kwargs):
-        yield from ()
+        Parameters
+        ----------
+        key : tuple of slices
+            Rows and columns of the window.
 
-    def process(self):
-        self.bases, self.kind = self.auto_read_bed(self.baselist, kind=self.basetype)
-        if self.bases.shape[0] == 0:
-            warnings.warn("No regions in baselist, returning empty output")
-            self.pos_stream = self.empty_stream
-            self.final_chroms = []
-            return
-        if self.bed2 is not None:
-            self.bed2, self.bed2kind = self.auto_read_bed(self.bed2, kind='bed')
-        if self.kind == "bed":
-            basechroms = set(self.bases["chr"])
-            if self.anchor:
-                if self.anchor[0] not in basechroms:
-                    raise ValueError(
-                        """The anchor chromosome is not found in the baselist.
-                           Are they in the same format, e.g. starting with "chr"?
-                           Alternatively, all regions in that chromosome might have
-                           been filtered by some filters."""
-                    )
-                else:
-                    basechroms = [self.anchor[0]]
-        else:
-            if self.anchor:
-                raise ValueError("Can't use anchor with both sides of loops defined")
-            elif self.local:
-                raise ValueError("Can't make local with both sides of loops defined")
-            basechroms = set(self.bases["chr1"]) & set(self.bases["chr2"])
-        if self.bed2 is not None:
-            bed2chroms = set(self.bases["chr"])
-            basechroms = basechroms & bed2chroms
-        self.basechroms = natsorted(list(basechroms))
-        if self.chroms == "all":
-            self.final_chroms = natsorted(list(basechroms))
+        Returns
+        -------
+        window : 2D array
+            Balanced dense window.
+
+        """
+        rows, cols = key
+        window = self.raw[rows, cols]
+        row_weights = self.weights[rows]
+        col_weights = self.col_weights[cols]
+        if sparse.issparse(window):
+            window = window.toarray()
+        balanced = np.multiply(
+            window, np.outer(row_weights, col_weights), dtype=self.dtype
+        )
+        return np.where(window != 0, balanced, 0)
+
+    def get_pixels(self, rows, cols):
+        """Get balanced values of individual pixels
+
+        Parameters
+        ----------
+        rows, cols : 1D arrays of int
+            Coordinates of the pixels.
+
+        Returns
+        -------
+        values : 1D array
+            Values of the pixels.
+
+        """
+        if isinstance(self.raw, BandedMatrix):
+            values = self.raw.get_pixels(rows, cols)
         else:
-            self.final_chroms = natsorted(list(set(self.chroms) & set(self.basechroms)))
-        if len(self.final_chroms) == 0:
-            raise ValueError(
-                """No chromosomes are in common between the coordinate
-                   file/anchor and the cooler file. Are they in the same
-                   format, e.g. starting with "chr"?
-                   Alternatively, all regions in overlapping chromosomes
-                   might have been filtered by distance/size filters."""
+            values = np.asarray(self.raw[rows, cols], dtype=self.dtype).ravel()
+        return np.where(
+            values != 0, values * self.weights[rows] * self.col_weights[cols], 0
+        )
+
+    def coverage(self):
+        """Get total coverage profile of the balanced upper triangular data
+
+        Returns
+        -------
+        coverage : array
+            1D array of coverage.
+
+        """
+        n = self.shape[0]
+        if isinstance(self.raw, BandedMatrix):
+            raw = self.raw
+            cols = np.clip(
+                np.arange(n)[:, None] + raw.mindiag + np.arange(raw.width), 0, n - 1
+            )
+            balanced = copy.copy(raw)
+            balanced.band = np.where(
+                raw.band != 0,
+                raw.band * self.weights[:, None] * self.col_weights[cols],
+                0,
             )
+            return balanced.coverage()
+        data = self.to_coo()
+        return np.nan_to_num(
+            np.bincount(data.col, data.data, minlength=n)
+        ) + np.nan_to_num(np.bincount(data.row, data.data, minlength=n))
 
-        self.mids = self._get_mids(self.bases)
-        if self.bed2 is not None:
-            self.mids2 = self._get_mids(self.bed2)
-        else:
-            self.mids2 = None
-        if self.subset > 0:
-            self.mids = self.mids.sample(self.subset)
-            if self.mids2 is not None:
-                self.mids2 = self.mids2.sample(self.subset)
+    def to_coo(self):
+        """Get all stored pixels of a sparse raw matrix, balanced
 
-        if self.kind == "bed":
-            self.pos_stream = self.get_combinations
-        else:
-            self.pos_stream = self.get_position_pairs_stream
+        Returns
+        -------
+        data : coo
+            Balanced upper triangular matrix.
 
-    def _chrom_mids(self, chroms, mids):
-        for chrom in chroms:
-            if self.kind == "bed":
-                yield chrom, mids[mids["chr"] == chrom]
-            else:
-                yield chrom, mids[(mids["chr1"] == chrom) & (mids["chr2"] == chrom)]
+        """
+        data = sparse.coo_matrix(self.raw)
+        return sparse.coo_matrix(
+            (
+                data.data * self.weights[data.row] * self.col_weights[data.col],
+                (data.row, data.col),
+            ),
+            shape=data.shape,
+        )
 
-    def chrom_mids(self):
-        chrommids = self._chrom_mids(self.final_chroms, self.mids)
-        if self.mids2 is not None:
-            chrommids2 = self._chrom_mids(self.final_chroms, self.mids2)
-        else:
-            chrommids2 = zip(itertools.cycle([None]), itertools.cycle([None]))
-        chrommids = zip(chrommids, chrommids2)
-        for i in chrommids:
-            yield i
 
+class RowBlockMatrix:
+    def __init__(self, n, starts, blocks):
+        """Sparse upper triangular matrix where only some blocks of rows are loaded.
 
-class PileUpper:
+        Parameters
+        ----------
+        n : int
+            Size of the matrix.
+        starts : list of int
+            First row of each block, in increasing order.
+        blocks : list of csr
+            Loaded rows of each block, with all n columns.
+
+        Returns
+        -------
+        Object that returns windows from the loaded rows.
+
+        """
+        self.shape = (n, n)
+        self.starts = list(starts)
+        self.ends = [start + block.shape[0] for start, block in zip(starts, blocks)]
+        self.blocks = blocks
+
+    def __getitem__(self, key):
+        """Get a window of the matrix from one of the loaded blocks
+
+        Parameters
+        ----------
+        key : tuple of slices
+            Rows and columns of the window. All rows have to be in one loaded block.
+
+        Returns
+        -------
+        window : csr
+            Sparse window.
+
+        """
+        rows, cols = key
+        lo_row, hi_row, _ = rows.indices(self.shape[0])
+        i = bisect.bisect_right(self.starts, lo_row) - 1
+        if i < 0 or hi_row > self.ends[i]:
+            raise IndexError("Requested rows are not loaded")
+        start = self.starts[i]
+        return self.blocks[i][lo_row - start : hi_row - start, cols]
+
+
+class SnippetWriter:
+    def __init__(self, filename, start, chunksize=1000):
+        """Writer of snippets into consecutive rows of a preallocated .npy stack.
+
+        Snippets are kept in memory until *chunksize* of them are collected, and then
+        written into the memory-mapped file, so memory use doesn't depend on the
+        total number of snippets. Writers with non-overlapping rows can be used
+        from different processes at the same time.
+
+        Parameters
+        ----------
+        filename : str
+            Path to an existing .npy file, e.g. created with `create_snippet_stack`.
+        start : int
+            First row to write into.
+        chunksize : int, optional
+            How many snippets to collect before writing them.
+            The default is 1000.
+
+        Returns
+        -------
+        Object that writes snippets into the stack.
+
+        """
+        self.filename = filename
+        self.position = start
+        self.chunksize = chunksize
+        self.buffer = []
+
+    def add(self, snippet):
+        """Add a snippet to the stack
+
+        Parameters
+        ----------
+        snippet : 2D array
+            Snippet to write.
+
+        """
+        self.buffer.append(snippet)
+        if len(self.buffer) >= self.chunksize:
+            self.flush()
+
+    def flush(self):
+        """Write all collected snippets into the file"""
+        if len(self.buffer) == 0:
+            return
+        stack = np.load(self.filename, mmap_mode="r+")
+        stack[self.position : self.position + len(self.buffer)] = self.buffer
+        stack.flush()
+        del stack
+        self.position += len(self.buffer)
+        self.buffer = []
+
+
+def create_snippet_stack(filename, n, shape, dtype=float):
+    """Preallocate a .npy file for a stack of snippets
+
+    Parameters
+    ----------
+    filename : str
+        Name of the .npy file to create.
+    n : int
+        Number of snippets.
+    shape : tuple
+        Shape of each snippet.
+    dtype : dtype, optional
+        Type of stored values.
+        The default is float.
+
+    """
+    stack = np.lib.format.open_memmap(
+        filename, mode="w+", dtype=dtype, shape=(n,) + tuple(shape)
+    )
+    del stack
+
+
+class PairsFile:
+    def __init__(self, filename, binsize, chromsizes=None):
+        """A .pairs file, possibly gzipped, with contacts binned on the fly
+
+        Has the attributes of a cooler that PileUpper needs to set itself up, and
+        streams the binned cis contacts of the file in chunks, so the whole file is
+        never loaded at once.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the .pairs file. Files ending with .gz are decompressed on the
+            fly.
+        binsize : int
+            Resolution to bin the contacts at, in bp.
+        chromsizes : Series, optional
+            Lengths of the chromosomes. The default is None, then they are read from
+            the #chromsize lines of the header.
+
+        """
+        self.filename = filename
+        self.binsize = int(binsize)
+        columns = ["readID", "chrom1", "pos1", "chrom2", "pos2"]
+        header_sizes = {}
+        opener = gzip.open if filename.endswith(".gz") else open
+        with opener(filename, "rt") as f:
+            for line in f:
+                if not line.startswith("#"):
+                    break
+                if line.startswith("#columns:"):
+                    columns = line.split()[1:]
+                elif line.startswith("#chromsize:"):
+                    _, chrom, length = line.split()
+                    header_sizes[chrom] = int(length)
+        if chromsizes is None:
+            if len(header_sizes) == 0:
+                raise ValueError(
+                    f"No chromosome sizes in the header of {filename}, please provide"
+                    " them"
+                )
+            chromsizes = pd.Series(header_sizes)
+        self.chromsizes = pd.Series(chromsizes).astype(int)
+        self.chromnames = list(self.chromsizes.index)
+        self.usecols = [
+            columns.index(col) for col in ("chrom1", "pos1", "chrom2", "pos2")
+        ]
+
+    def pixel_chunks(self, chroms, chunksize=1000000):
+        """Stream binned cis contacts of chromosomes
+
+        Pairs are assumed to have 1-based positions, as in the pairs format and by
+        default in ``cooler cload pairs``. Repeated pixels are summed up within
+        each chunk of the file.
+
+        Parameters
+        ----------
+        chroms : list of str
+            Chromosomes to keep.
+        chunksize : int, optional
+            How many lines of the file to read at once. The default is 1000000.
+
+        Yields
+        ------
+        chrom : str
+            Chromosome name.
+        rows, cols, values : 1D arrays
+            Coordinates within the chromosome, with rows <= cols, and counts of the
+            pixels.
+
+        """
+        chroms = set(chroms)
+        reader = pd.read_csv(
+            self.filename,
+            sep="\t",
+            comment="#",
+            header=None,
+            usecols=self.usecols,
+            chunksize=chunksize,
+            dtype={self.usecols[0]: str, self.usecols[2]: str},
+        )
+        chrom1, pos1, chrom2, pos2 = self.usecols
+        for chunk in reader:
+            chunk = chunk[(chunk[chrom1] == chunk[chrom2]) & chunk[chrom1].isin(chroms)]
+            for chrom, pairs in chunk.groupby(chrom1, sort=False):
+                n_bins = -(-self.chromsizes[chrom] // self.binsize)
+                bins1 = (pairs[pos1].values.astype(np.int64) - 1) // self.binsize
+                bins2 = (pairs[pos2].values.astype(np.int64) - 1) // self.binsize
+                rows = np.minimum(bins1, bins2)
+                cols = np.maximum(bins1, bins2)
+                keep = (rows >= 0) & (cols < n_bins)
+                keys, counts = np.unique(
+                    rows[keep] * n_bins + cols[keep], return_counts=True
+                )
+                yield chrom, keys // n_bins, keys % n_bins, counts.astype(float)
+
+
+class CoordCreator:
     def __init__(
         self,
-        clr,
-        CC,
-        balance="weight",
-        expected=False,
-        control=False,
-        coverage_norm=False,
-        rescale=False,
-        rescale_pad=1,
-        rescale_size=99,
-        ignore_diags=2,
+        baselist,
+        resolution,
+        basetype='auto',
+        bed2=None,
+        bed2_ordered=True,
+        anchor=False,
+        anchors=None,
+        pad=100000,
+        chroms="all",
+        minshift=10 ** 5,
+        maxshift=10 ** 6,
+        nshifts=10,
+        mindist="auto",
+        maxdist=None,
+        minsize=0,
+        maxsize=None,
+        local=False,
+        trans=False,
+        groups=False,
+        group_quantiles=0,
+        subset=0,
+        seed=None,
     ):
-        """Creates pileups
-
+        """Generator of coordinate pairs for pileups.
 
         Parameters
         ----------
-        clr : cool
-            Cool file with Hi-C data.
-        CC : CoordCreator
-            CoordCreator object with correct settings.
-        balance : bool or str, optional
-            Whether to use balanced data, and which column to use as weights.
-            The default is "weight".
-        expected : DataFrame, optional
-            If using expected, pandas DataFrame with chromosome-wide expected.
-            The default is False.
-        control : bool, optional
-            Whether to use randomly shifted controls.
-            The default is False.
-        coverage_norm : bool, optional
-            Whether to normalize final the final pileup by accumulated coverage as an
-            alternative to balancing. Useful for single-cell hi-C data.
-            The default is False.
-        rescale : bool, optional
-            Whether to use real sizes of all ROIs and rescale them to the same shape
-            The default is False.
-        rescale_pad : float, optional
-            Fraction of ROI size added on each end when extracting snippets, if rescale.
+        baselist : str
+            Path to a bed- or bedpe-style file with coordinates.
+        resolution : int
+            Data resolution.
+        basetype : str, optional
+            Format of the baselist. Options:
+                bed: chrom, start, end
+                bedpe: chrom1, start1, end1, chrom2, start2, end2
+                auto (default): determined from the number of columns in the file
+        bed2 : str, optional
+            Path to a second bed-style file with coordinates. If specified,
+            interactions between baselist and bed2 are used.
+            The default is None.
+        bed2_ordered : bool, optional
+            Whether interactions always have coordinates from baselist on the left and
+            from bed2 on the bottom. If False, all interactions will be considered
+            irrespective of order.
+            The default is True.
+        anchor : tuple of (str, int, int), optional
+            Coordinates (chr, start, end) of an anchor region used to create
+            interactions with baselist (in bp). Anchor is on the left of the final pileup.
+            The default is False.
+        anchors : list or str, optional
+            List of (chr, start, end) anchor regions, or path to a bed file with
+            them, to make a separate anchor pileup for each of them in one run with
+            `PileUpper.pileupsByAnchor`.
+            The default is None.
+        pad : int, optional
+            Paddin around the central bin, in bp. For example, with 5000 bp resolution
+            and 100000 pad, final pileup is 205000×205000 bp.
+            The default is 100000.
+        chroms : str or list, optional
+            Which chromosomes to use for pileups. Has to be in a list even for a
+            single chromosome, e.g. ['chr1'].
+            The default is "all"
+        minshift : int, optional
+            Minimal shift applied when generating random controls, in bp.
+            The default is 10 ** 5.
+        maxshift : int, optional
+            Maximal shift applied when generating random controls, in bp.
+            The default is 10 ** 6.
+        nshifts : int, optional
+            How many shifts to generate per region of interest. Does not take chromosome
+            boundaries into account
+            The default is 10.
+        mindist : int, optional
+            Shortest interactions to consider. Uses midpoints of regions of interest.
+            "auto" selects it to avoid the two shortest diagonals of the matrix, i.e.
+            2 * pad + 2 * resolution
+            The default is "auto".
+        maxdist : int, optional
+            Longest interactions to consider.
+            The default is None.
+        minsize : int, optional
+            Shortest regions to consider. Only applies to bed files.
+            The default is 0.
+        maxsize : int, optional
+            Longest regions to consider. Only applies to bed files.
+            The default is None.
+        local : bool, optional
+            Whether to generate local coordinates, i.e. on-diagonal.
+            The default is False.
+        trans : bool, optional
+            Whether to generate inter-chromosomal pairs instead of cis pairs: all
+            pairs of regions on different chromosomes from a bed file, or pairs from a
+            bedpe file with sides on different chromosomes. Pairs are oriented by the
+            order of chromosomes, and distance filters are not used. Can't be used
+            with local, anchors or bed2.
+            The default is False.
+        groups : bool, optional
+            Whether the baselist has an extra last column (4th for bed, 7th for
+            bedpe) with a group label of each region, to make a separate pileup for
+            each group, or for each pair of groups of a pair of bed regions, with
+            `PileUpper.pileupsByGroupWithControl`. Can't be used with bed2 and trans.
+            The default is False.
+        group_quantiles : int, optional
+            If groups, treat the group column as numeric scores and split them into
+            this many quantiles, labelled from 1 to group_quantiles. 0 to use labels
+            as they are.
+            The default is 0.
+        subset : int, optional
+            What subset of the coordinate files to use. 0 or negative to use all.
+            The default is 0.
+        seed : int, optional
+            Seed for np.random to make it reproducible.
+            The default is None.
+
+        Returns
+        -------
+        Object that generates coordinates for pileups required for PileUpper.
+
+        """
+        self.baselist = baselist
+        self.stdin = self.baselist == sys.stdin
+        self.resolution = resolution
+        self.basetype = basetype
+        self.bed2 = bed2
+        self.bed2_ordered = bed2_ordered
+        self.anchor = anchor
+        self.anchors = anchors
+        self.pad = pad
+        self.pad_bins = pad // self.resolution
+        self.chroms = chroms
+        self.minshift = minshift
+        self.maxshift = maxshift
+        self.nshifts = nshifts
+        self.mindist_auto = mindist == "auto"
+        if self.mindist_auto:
+            self.mindist = 2 * self.pad + 2 * self.resolution
+        else:
+            self.mindist = mindist
+        if maxdist is None:
+            self.maxdist = np.inf
+        else:
+            self.maxdist = maxdist
+        self.minsize = minsize
+        if maxsize is None:
+            self.maxsize = np.inf
+        else:
+            self.maxsize = maxsize
+        self.local = local
+        self.trans = trans
+        self.groups = groups
+        self.group_quantiles = group_quantiles
+        self.subset = subset
+        self.seed = seed
+        self.process()
+
+    def filter_bed(self, df):
+        length = df["end"] - df["start"]
+        df = df[(length >= self.minsize) & (length <= self.maxsize)]
+        if self.chroms != "all":
+            df = df[df["chr"].isin(self.chroms)]
+        if not np.all(df["end"] >= df["start"]):
+            raise ValueError("Some ends in the file are smaller than starts")
+        return df
+
+    def filter_bedpe(self, df):
+        if self.trans:
+            df = df[df["chr1"] != df["chr2"]]
+        else:
+            mid1 = np.mean(df[["start1", "end1"]], axis=1)
+            mid2 = np.mean(df[["start2", "end2"]], axis=1)
+            length = mid2 - mid1
+            df = df[(length >= self.mindist) & (length <= self.maxdist)]
+        if self.chroms != "all":
+            df = df[(df["chr1"].isin(self.chroms)) & (df["chr2"].isin(self.chroms))]
+        return df
+
+    def auto_read_bed(
+        self, file, kind="auto",
+    ):
+        row1 = None
+        if kind == "auto":  # Guessing whether it's bed or bedpe style file
+            if self.stdin:
+                row1 = file.__next__().split("\t")
+            else:
+                with open(file, "r") as fobject:
+                    row1 = fobject.readline().split("\t")
+            if self.groups:
+                row1, group = row1[:-1], row1[-1].rstrip("\n")
+            ncols = len(row1)
+            if ncols == 6:
+                try:
+                    row1 = [
+                        row1[0],
+                        int(row1[1]),
+                        int(row1[2]),
+                        row1[3],
+                        int(row1[4]),
+                        int(row1[5]),
+                    ]
+                    kind = "bedpe"
+                except:
+                    raise ValueError("Can't determine the type of baselist file,"
+                                     "please specify bed or bedpe")
+            elif ncols == 3:
+                try:
+                    row1 = [row1[0], int(row1[1]), int(row1[2])]
+                    kind = "bed"
+                except:
+                    raise ValueError("Can't determine the type of baselist file,"
+                                     "please specify bed or bedpe")
+            else:
+                raise ValueError(
+                    f"""Input bed(pe) file has unexpected number of
+                        columns: got {ncols + int(self.groups)}, expect 3 (bed) or 6
+                        (bedpe), and one more with groups
+                        """
+                )
+            if self.groups:
+                row1.append(group)
+
+        if kind == "bed":
+            filter_func = self.filter_bed
+            names = ["chr", "start", "end"]
+            dtype = {"chr": "str", "start": "int", "end": "int"}
+        elif kind == "bedpe":  # bedpe
+            filter_func = self.filter_bedpe
+            names = ["chr1", "start1", "end1", "chr2", "start2", "end2"]
+            dtype = {
+                "chr1": "str",
+                "start1": "int",
+                "end1": "int",
+                "chr2": "str",
+                "start2": "int",
+                "end2": "int",
+            }
+        else:
+            raise ValueError(
+                f"""Unsupported input kind: {kind}.
+                             Expect auto, bed or bedpe"""
+            )
+        if self.groups:
+            names = names + ["Group"]
+            dtype["Group"] = "str"
+        if row1 is not None:
+            row1 = filter_func(pd.DataFrame([row1], columns=names).astype(dtype=dtype))
+        bases = []
+        
+        if self.stdin:
+            if row1 is not None:
+                if row1.shape[0] == 1:
+                    bases.append(row1)
+
+        for chunk in pd.read_csv(
+            file,
+            sep="\t",
+            names=names,
+            index_col=False,
+            chunksize=10 ** 4,
+            dtype=dtype,
+        ):
+            bases.append(filter_func(chunk))
+        bases = pd.concat(bases)
+        if not self.stdin:  # Would mean we read it twice when checking and in the first chunk
+            bases = bases.iloc[1:]
+
+            # bases["chr"] = bases["chr"].astype(str)
+            # bases[["start", "end"]] = bases[["start", "end"]].astype(np.uint64)
+
+            # bases[["chr1", "chr2"]] = bases[["chr1", "chr2"]].astype(str)
+            # bases[["start1", "end1", "start2", "end2"]] = bases[
+            # ["start1", "end1", "start2", "end2"]
+            # ].astype(np.uint64)
+        return bases, kind
+
+    def subset(self, df):
+        if self.seed is not None:
+            np.random.seed(self.seed)
+        if self.subset > 0 and self.subset < len(df):
+            return df.sample(self.subset)
+        else:
+            return df
+
+    def bedpe2bed(self, df, ends=True, how="center"):
+        # If ends==True, will combine all coordinates from both loop ends into one bed-style df
+        # Else, will convert to long intervals covering the whole loop, for e.g. rescaled averaging
+        # how: center - take center of loop bases; inner or outer
+        if ends:
+            df1 = df[["chr1", "start1", "end1"]]
+            df1.columns = ["chr", "start", "end"]
+            df2 = df[["chr2", "start2", "end2"]]
+            df2.columns = ["chr", "start", "end"]
+            return (
+                pd.concat([df1, df2])
+                .sort_values(["chr", "start", "end"])
+                .reset_index(drop=True)
+            )
+
+        if how == "center":
+            df["start"] = np.mean(df["start1"], df["end1"], axis=0)
+            df["end"] = np.mean(df["start2"], df["end2"], axis=0)
+        elif how == "outer":
+            df = df[["chr1", "start1", "end2"]]
+            df.columns = ["chr", "start", "end"]
+        elif how == "inner":
+            df = df[["chr1", "end1", "start2"]]
+            df.columns = ["chr", "start", "end"]
+        return df
+
+    def _get_mids(self, intervals):
+        if self.kind == "bed":
+            intervals = intervals.sort_values(["chr", "start"])
+            mids = np.round((intervals["end"] + intervals["start"]) / 2).astype(int)
+            widths = np.round((intervals["end"] - intervals["start"])).astype(int)
+            mids = pd.DataFrame(
+                {
+                    "chr": intervals["chr"],
+                    "Mids": mids,
+                    "Bin": mids // self.resolution,
+                    "Pad": widths / 2,
+                }
+            )
+            if self.groups:
+                mids["Group"] = intervals["Group"]
+            # Regions of different groups in the same bin are all kept
+            mids = mids.drop_duplicates(
+                ["chr", "Bin"] + ["Group"] * self.groups
+            )  # .drop('Bin', axis=1)
+        elif self.kind == "bedpe":
+            intervals = intervals.sort_values(["chr1", "chr2", "start1", "start2"])
+            mids1 = np.round((intervals["end1"] + intervals["start1"]) / 2).astype(int)
+            widths1 = np.round((intervals["end1"] - intervals["start1"])).astype(int)
+            mids2 = np.round((intervals["end2"] + intervals["start2"]) / 2).astype(int)
+            widths2 = np.round((intervals["end2"] - intervals["start2"])).astype(int)
+            mids = pd.DataFrame(
+                {
+                    "chr1": intervals["chr1"],
+                    "Mids1": mids1,
+                    "Bin1": mids1 // self.resolution,
+                    "Pad1": widths1 / 2,
+                    "chr2": intervals["chr2"],
+                    "Mids2": mids2,
+                    "Bin2": mids2 // self.resolution,
+                    "Pad2": widths2 / 2,
+                },
+            )
+            if self.groups:
+                mids["Group"] = intervals["Group"]
+            mids = mids.drop_duplicates(
+                ["chr1", "chr2", "Bin1", "Bin2"] + ["Group"] * self.groups
+            )  # .drop(['Bin1', 'Bin2'], axis=1)
+        else:
+            raise ValueError(
+                """
+                kind can only be "bed" or "bedpe"
+                """
+            )
+        return mids
+
+    def filter_func_all(self, mids):
+        return mids
+
+    def _filter_func_chrom(self, mids, chrom):
+        return mids[mids["chr"] == chrom]
+
+    def _filter_func_pairs_chrom(self, mids, chrom):
+        return mids[(mids["chr1"] == chrom) & (mids["chr2"] == chrom)]
+
+    def filter_func_chrom(self, chrom):
+        if self.kind == "bed":
+            return partial(self._filter_func_chrom, chrom=chrom)
+        else:
+            return partial(self._filter_func_pairs_chrom, chrom=chrom)
+
+    def _filter_func_region(self, mids, region):
+        chrom, start, end = region
+        start /= self.resolution
+        end /= self.resolution
+        return mids[
+            (mids["chr"] == chrom) & (mids["Bin"] >= start) & (mids["Bin"] < end)
+        ]
+
+    def _filter_func_pairs_region(self, mids, region):
+        chrom, start, end = region
+        start /= self.resolution
+        end /= self.resolution
+        return mids[
+            (mids["chr1"] == chrom)
+            & (mids["chr2"] == chrom)
+            & (mids["Bin1"] >= start)
+            & (mids["Bin1"] < end)
+            & (mids["Bin2"] >= start)
+            & (mids["Bin2"] < end)
+        ]
+
+    def filter_func_region(self, region):
+        if self.kind == "bed":
+            return partial(self._filter_func_region, region)
+        else:
+            return partial(self._filter_func_pairs_region, region)
+
+    def _get_combinations(
+        self, filter_func, mids=None, mids2=None, anchor=None, with_groups=False
+    ):
+        if anchor is None:
+            anchor = self.anchor
+
+        if (self.local and anchor) or (self.local and (self.mids2 is not None)):
+            raise ValueError(
+                """Can't have a local pileup with an anchor or with two bed files"""
+            )
+        if mids is None:
+            mids = self.mids
+        mids = filter_func(self.mids)
+        if not len(mids) >= 1:
+            logging.debug("Empty selection")
+            yield (None,) * (4 + with_groups)
+        m = mids["Bin"].values.astype(int)
+        p = (mids["Pad"] // self.resolution).values.astype(int)
+        if with_groups:
+            # Group of each region is appended to the coordinates of its windows
+            g = mids["Group"].values
+            if self.local:
+                for i, pi, gi in zip(m, p, g):
+                    yield i, i, pi, pi, gi
+            elif anchor:
+                anchor_bin = int((anchor[1] + anchor[2]) / 2 // self.resolution)
+                anchor_pad = int(round((anchor[2] - anchor[1]) / 2)) // self.resolution
+                for i, pi, gi in zip(m, p, g):
+                    yield anchor_bin, i, anchor_pad, pi, gi
+            else:
+                for i, j, k in zip(
+                    itertools.combinations(m, 2),
+                    itertools.combinations(p, 2),
+                    itertools.combinations(g, 2),
+                ):
+                    yield list(i) + list(j) + [k]
+            return
+
+        if mids2 is None:
+            mids2 = self.mids2
+        if mids2 is not None:
+            mids2 = filter_func(mids2)
+            m2 = mids2["Bin"].values.astype(int)
+            p2 = (mids2["Pad"] // self.resolution).values.astype(int)
+        if self.local:
+            for i, pi in zip(m, p):
+                yield i, i, pi, pi
+        elif anchor:
+            anchor_bin = int((anchor[1] + anchor[2]) / 2 // self.resolution)
+            anchor_pad = int(round((anchor[2] - anchor[1]) / 2)) // self.resolution
+            for i, pi in zip(m, p):
+                yield anchor_bin, i, anchor_pad, pi
+        elif mids2 is None:
+            for i, j in zip(itertools.combinations(m, 2), itertools.combinations(p, 2)):
+                yield list(i) + list(j)
+        elif (mids2 is not None) and self.bed2_ordered:
+            for i, j in zip(itertools.product(m, m2), itertools.product(p, p2)):
+                if i[1] > i[0]:
+                    yield list(i) + list(j)
+        elif (mids2 is not None) and (not self.bed2_ordered):
+            for i, j in itertools.chain(
+                zip(itertools.product(m, m2), itertools.product(p, p2)),
+                zip(itertools.product(m2, m), itertools.product(p2, p)),
+            ):
+                yield list(i) + list(j)
+
+    def get_combinations(
+        self, filter_func, mids=None, mids2=None, anchor=None, with_groups=False
+    ):
+        stream = self._get_combinations(filter_func, mids, mids2, anchor, with_groups)
+        if not self.local:
+            stream = self.filter_pos_stream_distance(stream)
+        return stream
+
+    def get_positions_stream(self, filter_func, mids=None):
+        if mids is None:
+            mids = self.mids
+        mids = filter_func(mids)
+        if not len(mids) >= 1:
+            logging.debug("Empty selection")
+            yield None, None
+        m = mids["Bin"].astype(int).values
+        p = (mids["Pad"] // self.resolution).astype(int).values
+        for posdata in zip(m, p):
+            yield posdata
+
+    def _get_position_pairs_stream(self, filter_func, mids=None, with_groups=False):
+        if mids is None:
+            mids = self.mids
+        mids = filter_func(mids)
+        if not len(mids) >= 1:
+            logging.debug("Empty selection")
+            yield (None,) * (4 + with_groups)
+        m1 = mids["Bin1"].astype(int).values
+        m2 = mids["Bin2"].astype(int).values
+        p1 = (mids["Pad1"] // self.resolution).astype(int).values
+        p2 = (mids["Pad2"] // self.resolution).astype(int).values
+        columns = [m1, m2, p1, p2]
+        if with_groups:
+            columns.append(mids["Group"].values)
+        for posdata in zip(*columns):
+            yield posdata
+
+    def get_position_pairs_stream(self, filter_func, mids=None, with_groups=False):
+        stream = self._get_position_pairs_stream(filter_func, mids, with_groups)
+        if not self.local:
+            stream = self.filter_pos_stream_distance(stream)
+        return stream
+
+    def control_regions(self, filter_func, pos_pairs=None):
+        # A separate generator for each stream, so that streams consumed by
+        # different threads don't change each other's shifts
+        if self.seed is not None:
+            rng = np.random.RandomState(self.seed)
+        else:
+            rng = np.random
+        minbin = self.minshift // self.resolution
+        maxbin = self.maxshift // self.resolution
+        if pos_pairs is None:
+            source = self.pos_stream(filter_func)
+        else:
+            source = pos_pairs
+        # try:
+        #     row1 = next(source)
+        # except StopIteration:
+        #     logging.debug("Empty selection")
+        #     raise StopIteration
+        # else:
+        #     source = itertools.chain([row1], source)
+        for start, end, p1, p2 in source:
+            for i in range(self.nshifts):
+                shift = rng.randint(minbin, maxbin)
+                sign = np.sign(rng.random_sample() - 0.5).astype(int)
+                shift *= sign
+                yield start + shift, end + shift, p1, p2
+
+    def get_combinations_by_window(self, chrom, ctrl=False, mids=None):
+        assert self.kind == "bed"
+        if mids is None:
+            chrmids = self.filter_func_chrom(chrom)(self.mids)
+        else:
+            chrmids = self.filter_func_chrom(chrom)(mids)
+        for i, (b, m, p) in chrmids[["Bin", "Mids", "Pad"]].astype(int).iterrows():
+            out_stream = self.get_combinations(
+                self.filter_func_all, mids=chrmids, anchor=(chrom, m, m)
+            )
+            if ctrl:
+                out_stream = self.control_regions(self.filter_func_all, out_stream)
+            yield (m - p, m + p), out_stream
+
+    def get_trans_combinations(self, chrom1, chrom2, mids=None):
+        """Generate pairs of regions between two chromosomes
+
+        Parameters
+        ----------
+        chrom1, chrom2 : str
+            Chromosomes of the left and bottom sides of the windows.
+        mids : DataFrame, optional
+            Regions to use instead of all regions.
+
+        Yields
+        ------
+        (bin1, bin2, pad1, pad2) of each pair, with bin1 in chrom1 and bin2 in chrom2.
+
+        """
+        if mids is None:
+            mids = self.mids
+        if self.kind == "bed":
+            mids1 = self._filter_func_chrom(mids, chrom1)
+            mids2 = self._filter_func_chrom(mids, chrom2)
+            m1 = mids1["Bin"].values.astype(int)
+            p1 = (mids1["Pad"] // self.resolution).values.astype(int)
+            m2 = mids2["Bin"].values.astype(int)
+            p2 = (mids2["Pad"] // self.resolution).values.astype(int)
+            for i, j in zip(itertools.product(m1, m2), itertools.product(p1, p2)):
+                yield i + j
+        else:
+            mids = mids[(mids["chr1"] == chrom1) & (mids["chr2"] == chrom2)]
+            yield from self._get_position_pairs_stream(self.filter_func_all, mids)
+
+    def filter_pos_stream_distance(self, stream):
+        for pos in stream:
+            m1, m2 = pos[:2]
+            if self.mindist <= abs(m2 - m1) * self.resolution <= self.maxdist:
+                yield tuple(pos)
+
+    def empty_stream(self, *args, **kwargs):
+        yield from ()
+
+    def process(self):
+        self.bases, self.kind = self.auto_read_bed(self.baselist, kind=self.basetype)
+        if self.bases.shape[0] == 0:
+            warnings.warn("No regions in baselist, returning empty output")
+            self.pos_stream = self.empty_stream
+            self.final_chroms = []
+            return
+        if self.bed2 is not None:
+            self.bed2, self.bed2kind = self.auto_read_bed(self.bed2, kind='bed')
+        if self.trans:
+            if self.local or self.anchor or self.anchors is not None:
+                raise ValueError("Can't make trans pileups with local or anchors")
+            if self.bed2 is not None:
+                raise ValueError("Can't make trans pileups with a second bed file")
+        if self.groups:
+            if self.bed2 is not None or self.trans:
+                raise ValueError("Can't use groups with a second bed file or trans")
+            if self.group_quantiles > 0:
+                scores = self.bases["Group"].astype(float)
+                quantiles = pd.qcut(
+                    scores, self.group_quantiles, labels=False, duplicates="drop"
+                )
+                self.bases["Group"] = (quantiles + 1).astype(str)
+        if self.kind == "bed":
+            basechroms = set(self.bases["chr"])
+            if self.anchor:
+                if self.anchor[0] not in basechroms:
+                    raise ValueError(
+                        """The anchor chromosome is not found in the baselist.
+                           Are they in the same format, e.g. starting with "chr"?
+                           Alternatively, all regions in that chromosome might have
+                           been filtered by some filters."""
+                    )
+                else:
+                    basechroms = [self.anchor[0]]
+            if self.anchors is not None:
+                if self.anchor:
+                    raise ValueError("Can't use both anchor and a list of anchors")
+                if isinstance(self.anchors, str):
+                    self.anchors = pd.read_csv(
+                        self.anchors,
+                        sep="\t",
+                        names=["chr", "start", "end"],
+                        usecols=[0, 1, 2],
+                        dtype={"chr": "str", "start": "int", "end": "int"},
+                    )
+                    self.anchors = list(self.anchors.itertuples(index=False, name=None))
+                basechroms = basechroms & set(anchor[0] for anchor in self.anchors)
+        else:
+            if self.anchor or self.anchors is not None:
+                raise ValueError("Can't use anchor with both sides of loops defined")
+            elif self.local:
+                raise ValueError("Can't make local with both sides of loops defined")
+            if self.trans:
+                basechroms = set(self.bases["chr1"]) | set(self.bases["chr2"])
+                # Orient all pairs by the order of chromosomes
+                order = {
+                    chrom: i for i, chrom in enumerate(natsorted(list(basechroms)))
+                }
+                swap = (
+                    self.bases["chr1"].map(order) > self.bases["chr2"].map(order)
+                ).values
+                for col in ["chr", "start", "end"]:
+                    cols = [col + "1", col + "2"]
+                    self.bases.loc[swap, cols] = self.bases.loc[swap, cols[::-1]].values
+            else:
+                basechroms = set(self.bases["chr1"]) & set(self.bases["chr2"])
+        if self.bed2 is not None:
+            bed2chroms = set(self.bases["chr"])
+            basechroms = basechroms & bed2chroms
+        self.basechroms = natsorted(list(basechroms))
+        if self.chroms == "all":
+            self.final_chroms = natsorted(list(basechroms))
+        else:
+            self.final_chroms = natsorted(list(set(self.chroms) & set(self.basechroms)))
+        if len(self.final_chroms) == 0:
+            raise ValueError(
+                """No chromosomes are in common between the coordinate
+                   file/anchor and the cooler file. Are they in the same
+                   format, e.g. starting with "chr"?
+                   Alternatively, all regions in overlapping chromosomes
+                   might have been filtered by distance/size filters."""
+            )
+
+        self.mids = self._get_mids(self.bases)
+        if self.bed2 is not None:
+            self.mids2 = self._get_mids(self.bed2)
+        else:
+            self.mids2 = None
+        if self.subset > 0:
+            self.mids = self.mids.sample(self.subset)
+            if self.mids2 is not None:
+                self.mids2 = self.mids2.sample(self.subset)
+
+        self._set_streams()
+
+    def _set_streams(self):
+        if self.kind == "bed":
+            self.pos_stream = self.get_combinations
+        else:
+            self.pos_stream = self.get_position_pairs_stream
+
+        if self.trans:
+            if self.kind == "bed":
+                self.chrom_pairs = list(itertools.combinations(self.final_chroms, 2))
+            else:
+                pairs = self.mids[["chr1", "chr2"]].drop_duplicates()
+                pairs = pairs[
+                    pairs["chr1"].isin(self.final_chroms)
+                    & pairs["chr2"].isin(self.final_chroms)
+                ]
+                self.chrom_pairs = natsorted(pairs.itertuples(index=False, name=None))
+
+    def at_resolution(self, resolution, pad=None):
+        """Get coordinates for another resolution, reusing the regions already read
+        from the baselist
+
+        Parameters
+        ----------
+        resolution : int
+            New data resolution.
+        pad : int, optional
+            New padding in bp. The default is None, to keep the same padding.
+
+        Returns
+        -------
+        CC : CoordCreator
+            Copy of this CoordCreator with the windows at the new resolution. The
+            same subset of regions is used, if subset.
+
+        """
+        CC = copy.copy(self)
+        CC.resolution = resolution
+        if pad is not None:
+            CC.pad = pad
+        CC.pad_bins = CC.pad // resolution
+        if self.mindist_auto:
+            CC.mindist = 2 * CC.pad + 2 * resolution
+        if len(self.final_chroms) == 0:
+            return CC
+        bases = self.bases
+        if self.kind == "bedpe" and not self.trans and CC.mindist != self.mindist:
+            if CC.mindist < self.mindist:
+                raise ValueError(
+                    "Regions filtered by the automatic mindist can't be reused with a"
+                    " smaller mindist, start from the finest resolution"
+                )
+            bases = CC.filter_bedpe(bases)
+        if self.subset > 0:
+            bases = bases[bases.index.isin(self.mids.index)]
+        CC.mids = CC._get_mids(bases)
+        if self.mids2 is not None:
+            bed2 = self.bed2
+            if self.subset > 0:
+                bed2 = bed2[bed2.index.isin(self.mids2.index)]
+            CC.mids2 = CC._get_mids(bed2)
+        CC._set_streams()
+        return CC
+
+    def _chrom_mids(self, chroms, mids):
+        for chrom in chroms:
+            if self.kind == "bed":
+                yield chrom, mids[mids["chr"] == chrom]
+            else:
+                yield chrom, mids[(mids["chr1"] == chrom) & (mids["chr2"] == chrom)]
+
+    def chrom_mids(self):
+        chrommids = self._chrom_mids(self.final_chroms, self.mids)
+        if self.mids2 is not None:
+            chrommids2 = self._chrom_mids(self.final_chroms, self.mids2)
+        else:
+            chrommids2 = zip(itertools.cycle([None]), itertools.cycle([None]))
+        chrommids = zip(chrommids, chrommids2)
+        for i in chrommids:
+            yield i
+
+
+class PileUpper:
+    def __init__(
+        self,
+        clr,
+        CC,
+        balance="weight",
+        expected=False,
+        control=False,
+        coverage_norm=False,
+        rescale=False,
+        rescale_pad=1,
+        rescale_size=99,
+        ignore_diags=2,
+        banded=False,
+        executor="process",
+        snippets_file=None,
+        prefetch=0,
+        window_query_ratio=None,
+        engine="dense",
+        max_bad_fraction=None,
+        dtype=float,
+        distance_bins=None,
+        rescale_resolutions=None,
+        sparse_threshold=None,
+    ):
+        """Creates pileups
+
+
+        Parameters
+        ----------
+        clr : cool
+            Cool file with Hi-C data.
+        CC : CoordCreator
+            CoordCreator object with correct settings.
+        balance : bool or str, optional
+            Whether to use balanced data, and which column to use as weights.
+            The default is "weight".
+        expected : DataFrame, optional
+            If using expected, pandas DataFrame with chromosome-wide expected.
+            The default is False.
+        control : bool, optional
+            Whether to use randomly shifted controls.
+            The default is False.
+        coverage_norm : bool, optional
+            Whether to normalize final the final pileup by accumulated coverage as an
+            alternative to balancing. Useful for single-cell hi-C data.
+            The default is False.
+        rescale : bool, optional
+            Whether to use real sizes of all ROIs and rescale them to the same shape
+            The default is False.
+        rescale_pad : float, optional
+            Fraction of ROI size added on each end when extracting snippets, if rescale.
+            The default is 1.
+        rescale_size : int, optional
+            Final shape of rescaled pileups. E.g. if 99, pileups will be squares of
+            99×99 pixels.
+            The default is 99.
+        ignore_diags : int, optional
+            How many diagonals to ignore to avoid short-distance artefacts.
+            The default is 2.
+        banded : bool, optional
+            Whether to only load the diagonal band of each chromosome that can be
+            reached by the windows, and store it densely as a BandedMatrix. Only
+            possible with local pileups or with a finite maxdist.
+            The default is False.
+        executor : str, optional
+            How to use multiple cores. Options:
+                process (default): each process works on a separate chromosome and
+                loads its own copy of the data
+                thread: chromosomes are loaded one by one, and the windows of each
+                chromosome are piled up by threads sharing the same loaded data,
+                with the compiled loop of `accumulate_windows`. Banded storage,
+                rescaling, expected and snippets need the Python loop over windows,
+                which threads can't run in parallel
+        snippets_file : str, optional
+            Path to a .npy file to save all individual snippets into, as a
+            memory-mapped stack. A table with coordinates of each snippet is saved next
+            to it with a .tsv extension. Only used by `pileupsWithControl`.
+            The default is None.
+        prefetch : int, optional
+            When chromosomes are processed one by one in this process (single core or
+            the thread executor), how many chromosomes to load in advance in a
+            background thread while the current one is being piled up. 0 to disable.
+            The default is 0.
+        window_query_ratio : float, optional
+            If the rows of the matrix touched by the windows of a chromosome contain
+            fewer than this fraction of all pixels of the chromosome, only these rows
+            are loaded instead of the whole chromosome. Useful for short lists of
+            regions, e.g. with 0.1. Not used with coverage normalization, banded
+            storage, or when data is loaded in advance.
+            The default is None, to always load whole chromosomes.
+        engine : str, optional
+            How to sum up the windows. Options:
+                dense (default): extract each window as a dense array and add it up
+                numba: add windows pixel by pixel directly from the sparse matrix in a
+                compiled loop (or in vectorized batches, if numba is not installed).
+                Only used for sparse data without rescaling and expected, otherwise
+                falls back to dense
+                algebraic: for all combinations of regions from a bed file (or of two
+                bed files with bed2_ordered), sum up all pairs at once with sparse
+                matrix products, without generating the pairs. Pairs are always
+                oriented by the genomic positions of their centres. Controls and
+                other modes are piled up with numba
+                sweep: stream the pixels of each chromosome once and add each pixel
+                to all windows that contain it. Faster than the other engines when
+                windows overlap a lot, as in by-window pileups. Not used with
+                rescaling, expected, banded storage or when saving snippets
+        max_bad_fraction : float, optional
+            If balancing, skip windows where more than this fraction of pixels falls
+            into bins with NaN weights (e.g. centromeres and unmappable regions). Such
+            windows are found from the weights alone, before any data is read. Not
+            used by the algebraic engine and in by-window pileups.
+            The default is None, to use all windows.
+        dtype : dtype, optional
+            Type of loaded data, extracted windows, saved snippets and by-window
+            pileups. float32 halves their memory use and I/O. Pileups are always
+            summed up in float64.
+            The default is float.
+        distance_bins : list of int, optional
+            Edges of distance bands in bp, e.g. [100000, 200000, 400000], for
+            `pileupsByDistanceWithControl`. Each pair of regions is assigned to a band
+            by the distance between their centres, and a separate pileup is made for
+            each band from the same loaded data. Bands include their start, and the
+            last band also includes its end, like maxdist. The algebraic engine falls back to
+            numba. Can't be used with local or trans pileups.
+            The default is None.
+        rescale_resolutions : list of int or "auto", optional
+            Coarser resolutions in the same .mcool file as clr to extract large ROIs
+            from, if rescale. Each window is extracted from the coarsest resolution
+            that still gives at least rescale_size bins across the padded ROIs, so
+            the work per window is bounded by about rescale_size² pixels. Coarse
+            pixels are scaled to averages of the pixels of clr. "auto" uses all
+            resolutions of the file that are multiples of the resolution of clr.
+            Can't be used with expected.
+            The default is None.
+        sparse_threshold : float, optional
+            With the dense or numba engines and sparse data, if the average fraction
+            of stored pixels in a sample of windows of a chromosome is below this
+            value, only the stored pixels of the windows are added to the pileup with
+            `accumulate_windows_sparse`, e.g. 0.1 for single-cell or low coverage
+            data. None to never do it.
+            The default is None.
+
+        Returns
+        -------
+        Object that generates pileups.
+
+        """
+        self.clr = clr
+        self.resolution = self.clr.binsize
+        self.CC = CC
+        assert self.resolution == self.CC.resolution
+        self.__dict__.update(self.CC.__dict__)
+        self.balance = balance
+        self.expected = expected
+        self.control = control
+        self.pad_bins = self.pad // self.resolution
+        self.coverage_norm = coverage_norm
+        self.rescale = rescale
+        self.rescale_pad = rescale_pad
+        self.rescale_size = rescale_size
+        self.ignore_diags = ignore_diags
+        self.banded = banded
+        if executor not in ("process", "thread"):
+            raise ValueError(f"Unsupported executor: {executor}, expect process or thread")
+        self.executor = executor
+        self.snippets_file = snippets_file
+        if executor == "thread" and (
+            banded or rescale or expected is not False or snippets_file is not None
+        ):
+            warnings.warn(
+                "Windows are piled up in a Python loop with banded storage, rescaling,"
+                " expected or snippets, so threads give little speedup"
+            )
+        self.prefetch = prefetch
+        self.window_query_ratio = window_query_ratio
+        if engine not in ("dense", "numba", "algebraic", "sweep"):
+            raise ValueError(
+                f"Unsupported engine: {engine}, expect dense, numba, algebraic or sweep"
+            )
+        self.engine = engine
+        self.max_bad_fraction = max_bad_fraction
+        self.dtype = np.dtype(dtype)
+        if distance_bins is not None:
+            if self.local or self.trans:
+                raise ValueError("Can't use distance bins with local or trans pileups")
+            distance_bins = sorted(distance_bins)
+        self.distance_bins = distance_bins
+        self.sparse_threshold = sparse_threshold
+        self.rescale_clrs = {}
+        if rescale_resolutions is not None:
+            if not self.rescale:
+                raise ValueError("Coarser resolutions are only used with rescaling")
+            if self.expected is not False or self.trans:
+                raise ValueError(
+                    "Can't use coarser resolutions with expected or trans pileups"
+                )
+            if rescale_resolutions == "auto":
+                rescale_resolutions = [
+                    int(path.rsplit("/", 1)[-1])
+                    for path in cooler.fileops.list_coolers(self.clr.filename)
+                    if path.startswith("/resolutions/")
+                ]
+                rescale_resolutions = [
+                    res for res in rescale_resolutions if res % self.resolution == 0
+                ]
+            for res in rescale_resolutions:
+                if res % self.resolution != 0:
+                    raise ValueError(
+                        f"Resolution {res} is not a multiple of {self.resolution}"
+                    )
+                if res > self.resolution:
+                    self.rescale_clrs[res // self.resolution] = cooler.Cooler(
+                        f"{self.clr.filename}::resolutions/{res}"
+                    )
+        # self.CoolSnipper = snipping.CoolerSnipper(
+        #     self.clr, cooler_opts=dict(balance=self.balance)
+        # )
+        self.matsizes = np.ceil(self.clr.chromsizes / self.resolution).astype(int)
+
+        self.chroms = natsorted(
+            list(set(self.CC.final_chroms) & set(self.clr.chromnames))
+        )
+        self.regions = {
+            chrom: cooler.util.parse_region_string(chrom) for chrom in self.chroms
+        }
+        if self.trans:
+            if self.expected is not False or self.banded:
+                raise ValueError("Can't use expected or banded data with trans pileups")
+            if self.snippets_file is not None:
+                raise ValueError("Can't save snippets of trans pileups")
+            self.chrom_pairs = [
+                (chrom1, chrom2)
+                for chrom1, chrom2 in self.CC.chrom_pairs
+                if chrom1 in self.chroms and chrom2 in self.chroms
+            ]
+        if self.expected is not False:
+            if self.control:
+                warnings.warn(
+                    "Can't do both expected and control shifts; defaulting to expected"
+                )
+                self.control = False
+            assert isinstance(self.expected, pd.DataFrame)
+            self.ExpSnipper = snipping.ExpectedSnipper(self.clr, self.expected)
+            self.expected_selections = {
+                chrom: self.ExpSnipper.select(region, region)
+                for chrom, region in self.regions.items()
+            }
+            self.expected = True
+        if self.banded and len(self.chroms) > 0:
+            self.band_limits = self.get_band_limits()
+
+    # def get_matrix(self, matrix, chrom, left_interval, right_interval):
+    #     lo_left, hi_left = left_interval
+    #     lo_right, hi_right = right_interval
+    #     lo_left *= self.resolution
+    #     hi_left *= self.resolution
+    #     lo_right *= self.resolution
+    #     hi_right *= self.resolution
+    #     matrix = self.CoolSnipper.snip(
+    #         matrix,
+    #         self.regions[chrom],
+    #         self.regions[chrom],
+    #         (lo_left, hi_left, lo_right, hi_right),
+    #     )
+    #     return matrix
+
+    def get_expected_matrix(self, chrom, left_interval, right_interval):
+        """Generate expected matrix for a region
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+        left_interval : tuple
+            Tuple of (lo_left, hi_left) bin IDs in the chromosome.
+        right_interval : tuple
+            Tuple of (lo_right, hi_right) bin IDs in the chromosome.
+
+        Returns
+        -------
+        exp_matrix : array
+            Array of expected values for the selected coordinates.
+
+        """
+        lo_left, hi_left = left_interval
+        lo_right, hi_right = right_interval
+        lo_left *= self.resolution
+        hi_left *= self.resolution
+        lo_right *= self.resolution
+        hi_right *= self.resolution
+        exp_matrix = self.ExpSnipper.snip(
+            self.expected_selections[chrom],
+            self.regions[chrom],
+            self.regions[chrom],
+            (lo_left, hi_left, lo_right, hi_right),
+        )
+        return exp_matrix
+
+    def make_outmap(self,):
+        """Generate zero-filled array of the right shape
+
+        Returns
+        -------
+        outmap: array
+            Array of zeros of correct shape.
+
+        """
+        if self.rescale:
+            outmap = np.zeros((self.rescale_size, self.rescale_size))
+        else:
+            outmap = np.zeros((2 * self.pad_bins + 1, 2 * self.pad_bins + 1))
+        return outmap
+
+    def get_data(self, region):
+        """Get sparse data for a region
+
+        Parameters
+        ----------
+        region : tuple or str
+            Region for which to load the data. Either tuple of (chr, start, end), or
+            string with chromosome name.
+
+        Returns
+        -------
+        data : csr or BalancedMatrix
+            Sparse csr matrix of raw counts for the corresponding region, wrapped to
+            apply balancing weights if balancing.
+
+        """
+        logging.debug("Loading data")
+        data = self.clr.matrix(sparse=True, balance=False).fetch(region)
+        data = sparse.triu(data).tocsr()
+        return self.balanced(data, region)
+
+    def get_weights(self, region):
+        """Get balancing weights of all bins of a region
+
+        Parameters
+        ----------
+        region : tuple or str
+            Either tuple of (chr, start, end), or string with chromosome name.
+
+        Returns
+        -------
+        weights : 1D array or None
+            Weights, or None if not balancing.
+
+        """
+        if not self.balance:
+            return None
+        name = "weight" if self.balance is True else self.balance
+        return self.clr.bins()[name].fetch(region).values
+
+    def balanced(self, data, region):
+        """Wrap raw data of a region to apply balancing weights on request
+
+        Parameters
+        ----------
+        data : csr, BandedMatrix or RowBlockMatrix
+            Raw data for the region.
+        region : tuple or str
+            Either tuple of (chr, start, end), or string with chromosome name.
+
+        Returns
+        -------
+        data : BalancedMatrix
+            The same data, if not balancing. Sparse data is then converted to dtype.
+
+        """
+        if not self.balance:
+            if sparse.issparse(data):
+                data = data.astype(self.dtype)
+            return data
+        return BalancedMatrix(data, self.get_weights(region), dtype=self.dtype)
+
+    def get_rescale_data(self, chrom):
+        """Load data for a chromosome at the coarser resolutions used for large
+        rescaled windows
+
+        Coarse raw counts are balanced with the average weights of the fine bins they
+        contain, divided by the ratio of resolutions, so that coarse pixels are
+        averages of the fine pixels. Without balancing all fine weights are 1.
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+
+        Returns
+        -------
+        rescale_data : dict
+            Ratios of resolutions as keys, and tuples of (data, coverage) as values.
+            data : BalancedMatrix
+            Upper triangular coarse data.
+            coverage : 1D array or None
+            Coverage of the coarse bins per fine bin, if coverage_norm.
+
+        """
+        n = self.matsizes[chrom]
+        weights = self.get_weights(chrom)
+        if weights is None:
+            weights = np.ones(n)
+        rescale_data = {}
+        for factor, clr in self.rescale_clrs.items():
+            logging.debug(f"Loading data at {clr.binsize} bp")
+            raw = clr.matrix(sparse=True, balance=False).fetch(chrom)
+            raw = sparse.triu(raw).tocsr()
+            fine_weights = np.full(raw.shape[0] * factor, np.nan)
+            fine_weights[:n] = weights
+            with warnings.catch_warnings():
+                # Coarse bins with only bad fine bins get NaN weights
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                coarse_weights = np.nanmean(fine_weights.reshape(-1, factor), axis=1)
+            coverage = None
+            if self.coverage_norm:
+                coverage = self.get_coverage(raw) / factor
+            rescale_data[factor] = (
+                BalancedMatrix(raw, coarse_weights / factor, dtype=self.dtype),
+                coverage,
+            )
+        return rescale_data
+
+    def _get_rescale_factor(self, *sizes):
+        """Find the coarsest resolution that gives at least rescale_size bins across
+        a window
+
+        Parameters
+        ----------
+        sizes : int
+            Sizes of the window in bins.
+
+        Returns
+        -------
+        factor : int
+            Ratio of the selected and the data resolutions, 1 to use the data itself.
+
+        """
+        size = min(sizes)
+        for factor in sorted(self.rescale_clrs, reverse=True):
+            if size // factor >= self.rescale_size:
+                return factor
+        return 1
+
+    def get_max_pad(self):
+        """Find the largest padding of any window, in bins
+
+        Returns
+        -------
+        maxpad : int
+            Largest distance from the centre to the edge of a window.
+
+        """
+        if self.rescale:
+            if self.kind == "bed":
+                pads = [self.CC.mids["Pad"]]
+            else:
+                pads = [self.CC.mids["Pad1"], self.CC.mids["Pad2"]]
+            if self.CC.mids2 is not None:
+                pads.append(self.CC.mids2["Pad"])
+            maxpad = int(max(np.max(p // self.resolution) for p in pads))
+            if self.anchor:
+                anchor_pad = (
+                    int(round((self.anchor[2] - self.anchor[1]) / 2)) // self.resolution
+                )
+                maxpad = max(maxpad, anchor_pad)
+            maxpad = maxpad + int(round(self.rescale_pad * 2 * maxpad))
+        else:
+            maxpad = self.pad_bins
+        return maxpad
+
+    def get_band_limits(self):
+        """Find the range of diagonals that can be touched by any window
+
+        Returns
+        -------
+        mindiag, maxdiag : int
+            Lowest and highest diagonals that need to be stored.
+
+        """
+        maxpad = self.get_max_pad()
+        if self.local:
+            return -2 * maxpad, 2 * maxpad
+        if not np.isfinite(self.maxdist):
+            raise ValueError(
+                "Banded storage is only possible with local pileups or finite maxdist"
+            )
+        mindist = max(int(np.ceil(self.mindist / self.resolution)), 0)
+        maxdist = int(self.maxdist // self.resolution)
+        return mindist - 2 * maxpad, maxdist + 2 * maxpad
+
+    def get_banded_data(self, chrom, chunksize=100000):
+        """Get data for the diagonal band of a chromosome used by the windows
+
+        Pixels of the chromosome are streamed from the cooler once. With
+        coverage_norm, coverage of the whole chromosome is summed up from the same
+        pixels and kept as full_coverage of the band, since the band doesn't store
+        pixels far from the diagonal.
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+        chunksize : int, optional
+            How many pixels to read at once.
+            The default is 100000.
+
+        Returns
+        -------
+        data : BandedMatrix
+            Band of the upper triangular matrix of the chromosome.
+
+        """
+        logging.debug("Loading banded data")
+        mindiag, maxdiag = self.band_limits
+        lo, hi = self.clr.extent(chrom)
+        n = hi - lo
+        with self.clr.open("r") as h5:
+            nnz = (
+                h5["indexes"]["bin1_offset"][hi] - h5["indexes"]["bin1_offset"][lo]
+            )
+        if n * (maxdiag - mindiag + 1) > 2 * nnz:
+            # A csr matrix stores a value and a column index for each pixel
+            warnings.warn(
+                f"Banded storage of {chrom} is larger than its sparse matrix, "
+                "consider not using it"
+            )
+        data = BandedMatrix(n, mindiag, maxdiag, dtype=self.dtype)
+        coverage = np.zeros(n) if self.coverage_norm else None
+        weights = self.get_weights(chrom)
+        for rows, cols, values in self.get_pixel_chunks(
+            chrom, chunksize=chunksize, raw=True
+        ):
+            data.add_pixels(rows, cols, values)
+            if coverage is not None:
+                if weights is not None:
+                    values = values * weights[rows] * weights[cols]
+                coverage += np.bincount(rows, values, minlength=n)
+                coverage += np.bincount(cols, values, minlength=n)
+        if coverage is not None:
+            data.full_coverage = np.nan_to_num(coverage)
+        return self.balanced(data, chrom)
+
+    def get_coverage(self, data, chrom=None):
+        """Get total coverage profile for upper triangular data
+
+        Parameters
+        ----------
+        data : array_like
+            2D array with upper triangular data.
+        chrom : str, optional
+            Chromosome of the data. If the data is only a band of the matrix, the
+            coverage is taken from full_coverage of the band, or computed from all
+            pixels of the chromosome streamed from the cooler, since the band
+            doesn't store pixels far from the diagonal. The default is None.
+
+        Returns
+        -------
+        coverage : array
+            1D array of coverage.
+
+        """
+        if chrom is not None and isinstance(getattr(data, "raw", data), BandedMatrix):
+            full_coverage = getattr(data, "raw", data).full_coverage
+            if full_coverage is not None:
+                return full_coverage
+            n = data.shape[0]
+            coverage = np.zeros(n)
+            for rows, cols, values in self.get_pixel_chunks(chrom):
+                coverage += np.bincount(rows, values, minlength=n)
+                coverage += np.bincount(cols, values, minlength=n)
+            return np.nan_to_num(coverage)
+        if isinstance(data, (BandedMatrix, BalancedMatrix)):
+            return data.coverage()
+        coverage = np.nan_to_num(np.ravel(np.sum(data, axis=0))) + np.nan_to_num(
+            np.ravel(np.sum(data, axis=1))
+        )
+        return coverage
+
+    def _get_window(self, stBin, endBin, stPad, endPad, max_right):
+        """Get coordinates of the window around a pair of bins
+
+        Parameters
+        ----------
+        stBin, endBin : int
+            Bins of the left and bottom sides of the window.
+        stPad, endPad : int
+            Padding of the ROIs in bins, only used if rescale.
+        max_right : int
+            Size of the chromosome in bins.
+
+        Returns
+        -------
+        window : tuple or None
+            (lo_left, hi_left, lo_right, hi_right, stPad, rot_flip, rot), or None if
+            the window doesn't fit into the chromosome.
+
+        """
+        rot_flip = False
+        rot = False
+        if stBin >= endBin:
+            stBin, stPad, endBin, endPad = endBin, endPad, stBin, stPad
+            if self.anchor is None:
+                rot_flip = True
+            else:
+                rot = True
+        if self.rescale:
+            stPad = stPad + int(round(self.rescale_pad * 2 * stPad))
+            endPad = endPad + int(round(self.rescale_pad * 2 * endPad))
+        else:
+            stPad, endPad = self.pad_bins, self.pad_bins
+        lo_left = stBin - stPad
+        hi_left = stBin + stPad + 1
+        lo_right = endBin - endPad
+        hi_right = endBin + endPad + 1
+        if lo_left < 0 or hi_right > max_right:
+            return None
+        return lo_left, hi_left, lo_right, hi_right, stPad, rot_flip, rot
+
+    def get_bad_bins(self, chrom):
+        """Get prefix counts of bins with NaN balancing weights in a chromosome
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+
+        Returns
+        -------
+        bad_counts : 1D array of int or None
+            Number of bad bins before each bin, with the total at the end, so that
+            bad_counts[hi] - bad_counts[lo] is the number of bad bins in [lo, hi).
+            None if not balancing.
+
+        """
+        weights = self.get_weights(chrom)
+        if weights is None:
+            return None
+        return np.concatenate([[0], np.cumsum(~np.isfinite(weights))])
+
+    def filter_bad_windows(self, mids, chrom):
+        """Skip windows with too many pixels in bad bins, if max_bad_fraction is set
+
+        Parameters
+        ----------
+        mids : iterator
+            Stream of (stBin, endBin, stPad, endPad) coordinates.
+        chrom : str
+            Chromosome name.
+
+        Yields
+        ------
+        Coordinates from mids of windows that are kept.
+
+        """
+        bad_counts = None
+        if self.max_bad_fraction is not None:
+            bad_counts = self.get_bad_bins(chrom)
+        if bad_counts is None:
+            yield from mids
+            return
+        max_right = self.matsizes[chrom]
+        skipped = 0
+        for pos in mids:
+            window = self._get_window(*pos, max_right)
+            if window is not None:
+                lo_left, hi_left, lo_right, hi_right = window[:4]
+                height = hi_left - lo_left
+                width = hi_right - lo_right
+                good_rows = height - (bad_counts[hi_left] - bad_counts[lo_left])
+                good_cols = width - (bad_counts[hi_right] - bad_counts[lo_right])
+                if 1 - good_rows * good_cols / (height * width) > self.max_bad_fraction:
+                    skipped += 1
+                    continue
+            yield pos
+        logging.info(f"{chrom}: skipped {skipped} windows with too many bad bins")
+
+    def get_row_nnz(self, chrom):
+        """Get the number of stored pixels in each row of a chromosome
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+
+        Returns
+        -------
+        row_nnz : array
+            1D array with number of pixels per row, including trans pixels.
+
+        """
+        lo, hi = self.clr.extent(chrom)
+        with self.clr.open("r") as h5:
+            offsets = h5["indexes"]["bin1_offset"][lo : hi + 1]
+        return np.diff(offsets)
+
+    def get_row_block_data(self, chrom, row_mask):
+        """Get sparse data only for the rows that are needed
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+        row_mask : 1D array of bool
+            Which rows of the chromosome to load.
+
+        Returns
+        -------
+        data : RowBlockMatrix
+            Upper triangular data for the blocks of consecutive selected rows.
+
+        """
+        logging.debug("Loading blocks of rows")
+        lo, hi = self.clr.extent(chrom)
+        n = hi - lo
+        edges = np.flatnonzero(np.diff(np.r_[0, row_mask.astype(int), 0]))
+        starts, ends = edges[::2], edges[1::2]
+        matrix = self.clr.matrix(sparse=True, balance=False)
+        blocks = []
+        for start, end in zip(starts, ends):
+            block = sparse.coo_matrix(matrix[lo + start : lo + end, lo + start : hi])
+            upper = block.col >= block.row
+            blocks.append(
+                sparse.csr_matrix(
+                    (block.data[upper], (block.row[upper], block.col[upper] + start)),
+                    shape=(end - start, n),
+                )
+            )
+        return self.balanced(RowBlockMatrix(n, starts, blocks), chrom)
+
+    def get_anchor_data(self, chrom, anchors=None):
+        """Get sparse data only for the rows and columns reachable by windows with the
+        anchor
+
+        Windows with a region after the anchor use the rows of the anchor, and with
+        a region before the anchor use its columns. With controls, the band around
+        the anchor is extended by maxshift. The other side of the windows is limited
+        by maxdist, so the amount of data doesn't depend on the chromosome length.
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name, has to be the chromosome of the anchors.
+        anchors : list, optional
+            Anchors as (chr, start, end) tuples. Overlapping bands are loaded once.
+            The default is None, then the anchor of this PileUpper is used.
+
+        Returns
+        -------
+        data : csr
+            Upper triangular data for the chromosome, with only the pixels in the
+            bands of the anchors stored. If the bands cover more rows than the
+            chromosome has, the whole chromosome is loaded.
+
+        """
+        logging.debug("Loading data around the anchor")
+        if anchors is None:
+            anchors = [self.anchor]
+        lo, hi = self.clr.extent(chrom)
+        n = hi - lo
+        maxpad = self.get_max_pad()
+        if self.rescale:
+            for anchor in anchors:
+                anchor_pad = int(round((anchor[2] - anchor[1]) / 2)) // self.resolution
+                anchor_pad = anchor_pad + int(round(self.rescale_pad * 2 * anchor_pad))
+                maxpad = max(maxpad, anchor_pad)
+        shift = self.maxshift // self.resolution if self.control else 0
+        if np.isfinite(self.maxdist):
+            reach = int(self.maxdist // self.resolution) + shift + maxpad
+        else:
+            reach = n
+        # Merge overlapping bands of anchors into (band_start, band_end, first, last)
+        bands = []
+        for anchor_bin in sorted(
+            int((anchor[1] + anchor[2]) / 2 // self.resolution) for anchor in anchors
+        ):
+            band_start = min(max(anchor_bin - maxpad - shift, 0), n)
+            band_end = min(max(anchor_bin + maxpad + shift + 1, 0), n)
+            if bands and band_start <= bands[-1][1]:
+                bands[-1][1] = max(bands[-1][1], band_end)
+                bands[-1][3] = anchor_bin
+            else:
+                bands.append([band_start, band_end, anchor_bin, anchor_bin])
+        blocks = []
+        for band_start, band_end, first, last in bands:
+            start = max(first - reach, 0)
+            end = max(min(last + reach + 1, n), band_end)
+            # Rows of the anchor band, on and above the diagonal, then columns of the
+            # anchor band, above the rows of the anchor band
+            blocks.append((band_start, band_end, band_start, end))
+            blocks.append((start, band_start, band_start, band_end))
+        if sum(row_end - row_start for row_start, row_end, _, _ in blocks) >= n:
+            return self.get_data(chrom)
+        matrix = self.clr.matrix(sparse=True, balance=False)
+        rows, cols, values = [], [], []
+        for row_start, row_end, col_start, col_end in blocks:
+            block = sparse.coo_matrix(
+                matrix[lo + row_start : lo + row_end, lo + col_start : lo + col_end]
+            )
+            upper = block.col + col_start >= block.row + row_start
+            rows.append(block.row[upper] + row_start)
+            cols.append(block.col[upper] + col_start)
+            values.append(block.data[upper])
+        rows, cols, values = map(np.concatenate, (rows, cols, values))
+        if len(bands) > 1:
+            # Bands of different anchors can reach the same pixels
+            _, unique = np.unique(rows * n + cols, return_index=True)
+            rows, cols, values = rows[unique], cols[unique], values[unique]
+        return self.balanced(
+            sparse.csr_matrix((values, (rows, cols)), shape=(n, n)), chrom
+        )
+
+    def get_adaptive_data(self, mids, chrom):
+        """Load either the whole chromosome, or only the rows used by the windows,
+        whichever requires reading fewer pixels
+
+        Parameters
+        ----------
+        mids : iterator
+            Stream of (stBin, endBin, stPad, endPad) coordinates.
+        chrom : str
+            Chromosome name.
+
+        Returns
+        -------
+        data : csr or RowBlockMatrix
+            Upper triangular data for the chromosome.
+        mids : iterator
+            The same stream of coordinates.
+
+        """
+        row_nnz = self.get_row_nnz(chrom)
+        budget = self.window_query_ratio * np.sum(row_nnz)
+        max_right = self.matsizes[chrom]
+        touched = np.zeros(len(row_nnz), dtype=bool)
+        cost = 0
+        peeked = []
+        for pos in mids:
+            peeked.append(pos)
+            window = self._get_window(*pos, max_right)
+            if window is None:
+                continue
+            lo_left, hi_left = window[:2]
+            new_rows = ~touched[lo_left:hi_left]
+            cost += np.sum(row_nnz[lo_left:hi_left][new_rows])
+            touched[lo_left:hi_left] = True
+            if cost > budget:
+                return self.load_data(chrom), itertools.chain(peeked, mids)
+        logging.debug(
+            f"{chrom}: loading {np.sum(touched)} rows with {cost} pixels instead of"
+            " the whole chromosome"
+        )
+        return self.get_row_block_data(chrom, touched), iter(peeked)
+
+    def _use_adaptive_data(self):
+        """Check whether only the rows used by the windows can be loaded"""
+        return (
+            self.window_query_ratio is not None
+            and self.window_query_ratio > 0
+            and not self.banded
+            and not self.coverage_norm
+            and not self.anchor
+        )
+
+    def load_data(self, chrom):
+        """Load data for a chromosome in the selected storage format
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+
+        Returns
+        -------
+        data : csr or BandedMatrix
+            Upper triangular data for the chromosome. With an anchor, only the band
+            around the anchor is loaded, unless coverage is needed.
+
+        """
+        if self.anchor and not self.coverage_norm:
+            return self.get_anchor_data(chrom)
+        elif self.banded:
+            return self.get_banded_data(chrom)
+        else:
+            return self.get_data(
+                chrom
+            )  # self.CoolSnipper.select(self.regions[chrom], self.regions[chrom])
+
+    def _do_pileups(
+        self, mids, chrom, expected=False, data=None, coverage=None, snippets=None,
+        rescale_data=None,
+    ):
+        mymap = self.make_outmap()
+        cov_start = np.zeros(mymap.shape[0])
+        cov_end = np.zeros(mymap.shape[1])
+        num = np.zeros_like(mymap)
+        n = 0
+        try:
+            mids_row1 = next(mids)
+        except StopIteration:
+            logging.info(f"Nothing to sum up in chromosome {chrom}")
+            return mymap, mymap, cov_start, cov_end, n
+        else:
+            mids = itertools.chain([mids_row1], mids)
+
+        if expected:
+            data = None
+            logging.debug("Doing expected")
+        elif data is None:
+            if self._use_adaptive_data():
+                data, mids = self.get_adaptive_data(mids, chrom)
+            else:
+                data = self.load_data(chrom)
+        max_right = self.matsizes[chrom]
+
+        if self.coverage_norm and coverage is None:
+            coverage = self.get_coverage(data, chrom)
+        if self.rescale_clrs and not expected and rescale_data is None:
+            rescale_data = self.get_rescale_data(chrom)
+
+        if (
+            not expected
+            and not self.rescale
+            and snippets is None
+            and sparse.issparse(getattr(data, "raw", data))
+        ):
+            if self.engine in ("numba", "algebraic"):
+                return self._do_pileups_compiled(mids, chrom, data, coverage)
+            if self.sparse_threshold is not None:
+                mids = list(mids)
+                windows = self._get_window_arrays(iter(mids), chrom)
+                if self._use_sparse_windows(data, windows[0], windows[1]):
+                    return self._do_pileups_compiled(
+                        None, chrom, data, coverage, windows=windows, use_sparse=True
+                    )
+                mids = iter(mids)
+
+        for stBin, endBin, stPad, endPad in mids:
+            window = self._get_window(stBin, endBin, stPad, endPad, max_right)
+            if window is None:
+                continue
+            lo_left, hi_left, lo_right, hi_right, stPad, rot_flip, rot = window
+            window_data, window_coverage = data, coverage
+            ignore_diags = self.ignore_diags
+            if rescale_data:
+                factor = self._get_rescale_factor(
+                    hi_left - lo_left, hi_right - lo_right
+                )
+                if factor > 1:
+                    # Coarse bins that cover the window
+                    window_data, window_coverage = rescale_data[factor]
+                    lo_left, lo_right = lo_left // factor, lo_right // factor
+                    hi_left, hi_right = -(-hi_left // factor), -(-hi_right // factor)
+                    ignore_diags = -(-ignore_diags // factor)
+            diag = hi_left - lo_right
+            if not expected:
+                try:
+                    newmap = window_data[lo_left:hi_left, lo_right:hi_right]
+                    if sparse.issparse(newmap):
+                        newmap = newmap.toarray()
+                except (IndexError, ValueError):
+                    if snippets is not None:
+                        # Every window in the index of snippets gets its row
+                        snippets.add(np.full(mymap.shape, np.nan, dtype=self.dtype))
+                    continue
+            else:
+                newmap = self.get_expected_matrix(
+                    chrom, (lo_left, hi_left), (lo_right, hi_right)
+                )
+            #                if (
+            #                    newmap.shape != mymap.shape and not self.rescale
+            #                ):  # AFAIK only happens at ends of chroms
+            #                    height, width = newmap.shape
+            #                    h, w = mymap.shape
+            #                    x = w - width
+            #                    y = h - height
+            #                    newmap = np.pad(
+            #                        newmap, [(y, 0), (0, x)], "constant"
+            #                    )  # Padding to adjust to the right shape
+            newmap = newmap.astype(self.dtype)
+            if not self.local:
+                ignore_indices = np.tril_indices_from(
+                    newmap, diag - (hi_left - lo_left) - 1 + ignore_diags
+                )
+                newmap[ignore_indices] = np.nan
+            else:
+                newmap = np.triu(newmap, ignore_diags)
+                newmap += np.triu(newmap, 1).T
+            if self.rescale:
+                if newmap.size == 0 or np.all(np.isnan(newmap)):
+                    newmap = np.zeros((self.rescale_size, self.rescale_size))
+                else:
+                    newmap = numutils.zoom_array(
+                        newmap, (self.rescale_size, self.rescale_size)
+                    ).astype(self.dtype)
+            if rot_flip:
+                newmap = np.rot90(np.flipud(newmap), 1)
+            elif rot:
+                newmap = np.rot90(newmap, -1)
+
+            if snippets is not None:
+                snippets.add(newmap)
+            mymap = np.nansum([mymap, newmap], axis=0)
+            if self.coverage_norm and not expected and (self.balance is False):
+                new_cov_start = window_coverage[lo_left:hi_left]
+                new_cov_end = window_coverage[lo_right:hi_right]
+                if self.rescale:
+                    if len(new_cov_start) == 0:
+                        new_cov_start = np.zeros(self.rescale_size)
+                    if len(new_cov_end) == 0:
+                        new_cov_end = np.zeros(self.rescale_size)
+                    new_cov_start = numutils.zoom_array(
+                        new_cov_start, (self.rescale_size,)
+                    )
+                    new_cov_end = numutils.zoom_array(new_cov_end, (self.rescale_size,))
+                else:
+                    l = len(new_cov_start)
+                    r = len(new_cov_end)
+                    new_cov_start = np.pad(
+                        new_cov_start, (mymap.shape[0] - l, 0), "constant"
+                    )
+                    new_cov_end = np.pad(
+                        new_cov_end, (0, mymap.shape[1] - r), "constant"
+                    )
+                cov_start += np.nan_to_num(new_cov_start)
+                cov_end += +np.nan_to_num(new_cov_end)
+            num += np.isfinite(newmap).astype(int)
+            n += 1
+        if snippets is not None:
+            snippets.flush()
+        return mymap, num, cov_start, cov_end, n
+
+    def _prefetch_data(self, chroms):
+        """Load data for chromosomes one by one in a background thread
+
+        At most `self.prefetch` loaded chromosomes wait in the queue, so memory use
+        stays bounded.
+
+        Parameters
+        ----------
+        chroms : list
+            Chromosome names.
+
+        Yields
+        ------
+        chrom, data
+            Chromosome name and its data, in the same order as chroms.
+
+        """
+        loaded = queue.Queue(maxsize=self.prefetch)
+
+        def load():
+            try:
+                for chrom in chroms:
+                    loaded.put((chrom, self.load_data(chrom)))
+            except Exception as e:
+                loaded.put(e)
+            loaded.put(None)
+
+        loader = threading.Thread(target=load, daemon=True)
+        loader.start()
+        while True:
+            item = loaded.get()
+            if item is None:
+                break
+            elif isinstance(item, Exception):
+                raise item
+            yield item
+        loader.join()
+
+    def _map_prefetched(self, f, chroms):
+        """Apply f to each chromosome, with the data loaded in advance"""
+        return [f(chrom, data=data) for chrom, data in self._prefetch_data(chroms)]
+
+    def _do_pileups_threaded(
+        self, mids, chrom, pool, expected=False, snippets=None, data=None,
+        chunksize=1000,
+    ):
+        """Pile up windows of one chromosome in threads sharing the loaded data
+
+        Parameters
+        ----------
+        mids : iterator
+            Stream of (stBin, endBin, stPad, endPad) coordinates.
+        chrom : str
+            Chromosome name.
+        pool : ThreadPool
+            Pool of threads to use.
+        expected : bool, optional
+            Whether to create pileup of expected values. The default is False.
+        snippets : SnippetWriter, optional
+            Writer to save individual snippets with. The default is None.
+        data : csr or BandedMatrix, optional
+            Already loaded data for the chromosome. The default is None.
+        chunksize : int, optional
+            How many windows to send to a thread at once. The default is 1000.
+
+        Returns
+        -------
+        Same as _do_pileups.
+
+        """
+        chunks = iter(lambda: list(itertools.islice(mids, chunksize)), [])
+        try:
+            chunk1 = next(chunks)
+        except StopIteration:
+            mymap = self.make_outmap()
+            cov_start = np.zeros(mymap.shape[0])
+            cov_end = np.zeros(mymap.shape[1])
+            return mymap, np.zeros_like(mymap), cov_start, cov_end, 0
+        chunks = itertools.chain([chunk1], chunks)
+        if expected:
+            data, coverage = None, None
+        else:
+            if data is None:
+                data = self.load_data(chrom)
+            coverage = self.get_coverage(data, chrom) if self.coverage_norm else None
+        if (
+            not expected
+            and not self.rescale
+            and snippets is None
+            and sparse.issparse(getattr(data, "raw", data))
+        ):
+            # The compiled loop releases the GIL, so the threads run in parallel
+            f = partial(
+                self._do_pileups_compiled, chrom=chrom, data=data, coverage=coverage
+            )
+            results = list(pool.imap(lambda chunk: f(iter(chunk)), chunks))
+            return self._sum_chunks(results)
+        rescale_data = None
+        if self.rescale_clrs and not expected:
+            rescale_data = self.get_rescale_data(chrom)
+        f = partial(
+            self._do_pileups,
+            chrom=chrom,
+            expected=expected,
+            data=data,
+            coverage=coverage,
+            rescale_data=rescale_data,
+        )
+        max_right = self.matsizes[chrom]
+
+        def tasks():
+            position = None if snippets is None else snippets.position
+            for chunk in chunks:
+                if snippets is None:
+                    yield chunk, None
+                else:
+                    # Each chunk writes into its own rows of the stack
+                    yield chunk, SnippetWriter(
+                        snippets.filename, position, snippets.chunksize
+                    )
+                    position += sum(
+                        self._get_window(*pos, max_right) is not None for pos in chunk
+                    )
+
+        results = list(
+            pool.imap(lambda task: f(iter(task[0]), snippets=task[1]), tasks())
+        )
+        return self._sum_chunks(results)
+
+    def _sum_chunks(self, results):
+        """Sum up pileups of chunks of windows, as returned by `_do_pileups`"""
+        mymap, num, cov_start, cov_end, n = list(zip(*results))
+        return (
+            np.sum(mymap, axis=0),
+            np.sum(num, axis=0),
+            np.sum(cov_start, axis=0),
+            np.sum(cov_end, axis=0),
+            np.sum(n),
+        )
+
+    def prepare_snippet_stack(self):
+        """Create the file for individual snippets and the table of their coordinates
+
+        Goes through all windows once without loading any data to find how many
+        snippets will be saved, and where each chromosome starts in the stack. Each
+        window that fits into the chromosome gets a row, which is left NaN if the
+        window can't be extracted from the loaded data.
+
+        Returns
+        -------
+        index : DataFrame
+            Coordinates of each snippet in the stack, in the same order.
+
+        """
+        index = []
+        self.snippet_offsets = {}
+        for chrom in self.chroms:
+            self.snippet_offsets[chrom] = len(index)
+            filter_func = self.CC.filter_func_chrom(chrom=chrom)
+            max_right = self.matsizes[chrom]
+            mids = self.filter_bad_windows(self.CC.pos_stream(filter_func), chrom)
+            for stBin, endBin, stPad, endPad in mids:
+                if stBin is None:
+                    continue
+                window = self._get_window(stBin, endBin, stPad, endPad, max_right)
+                if window is None:
+                    continue
+                lo_left, hi_left, lo_right, hi_right, _, rot_flip, rot = window
+                index.append(
+                    (
+                        chrom,
+                        stBin,
+                        endBin,
+                        lo_left * self.resolution,
+                        hi_left * self.resolution,
+                        lo_right * self.resolution,
+                        hi_right * self.resolution,
+                        rot_flip or rot,
+                    )
+                )
+        index = pd.DataFrame(
+            index,
+            columns=[
+                "chr",
+                "Bin1",
+                "Bin2",
+                "start1",
+                "end1",
+                "start2",
+                "end2",
+                "flipped",
+            ],
+        )
+        create_snippet_stack(
+            self.snippets_file,
+            index.shape[0],
+            self.make_outmap().shape,
+            dtype=self.dtype,
+        )
+        index_file = os.path.splitext(self.snippets_file)[0] + ".tsv"
+        index.to_csv(index_file, sep="\t", index=False)
+        logging.info(
+            f"Saving {index.shape[0]} snippets to {self.snippets_file}, "
+            f"coordinates in {index_file}"
+        )
+        return index
+
+    def _do_pileups_compiled(
+        self, mids, chrom, data, coverage=None, windows=None, use_sparse=None
+    ):
+        """Pile up windows directly from the csr arrays with `accumulate_windows`
+
+        Parameters
+        ----------
+        mids : iterator
+            Stream of (stBin, endBin, stPad, endPad) coordinates. Ignored if windows
+            are provided.
+        chrom : str
+            Chromosome name.
+        data : csr or BalancedMatrix
+            Upper triangular data for the chromosome.
+        coverage : array, optional
+            Coverage of the chromosome, if coverage_norm. The default is None.
+        windows : tuple of 1D arrays, optional
+            Already computed (lo_lefts, lo_rights, flips), as returned by
+            `_get_window_arrays`. The default is None.
+        use_sparse : bool, optional
+            Already made decision of `_use_sparse_windows` for these windows.
+            The default is None, to check it.
+
+        Returns
+        -------
+        Same as _do_pileups.
+
+        """
+        size = 2 * self.pad_bins + 1
+        if windows is None:
+            windows = self._get_window_arrays(mids, chrom)
+        lo_lefts, lo_rights, flips = windows
+        n = len(lo_lefts)
+        if n == 0:
+            mymap = self.make_outmap()
+            return mymap, mymap, np.zeros(size), np.zeros(size), 0
+        weights = None
+        if isinstance(data, BalancedMatrix):
+            data, weights = data.raw, data.weights
+        if use_sparse is None:
+            use_sparse = self._use_sparse_windows(data, lo_lefts, lo_rights)
+        if use_sparse:
+            accumulate = accumulate_windows_sparse
+        else:
+            accumulate = accumulate_windows
+        mymap, num = accumulate(
+            data,
+            lo_lefts,
+            lo_rights,
+            flips,
+            size,
+            ignore_diags=self.ignore_diags,
+            local=self.local,
+            weights=weights,
+        )
+        cov_start, cov_end = self._get_window_coverage(coverage, lo_lefts, lo_rights)
+        return mymap, num, cov_start, cov_end, n
+
+    def _get_window_arrays(self, mids, chrom):
+        """Get first rows, first columns and orientations of all windows that fit
+        into the chromosome, as arrays
+
+        Parameters
+        ----------
+        mids : iterator
+            Stream of (stBin, endBin, stPad, endPad) coordinates.
+        chrom : str
+            Chromosome name.
+
+        Returns
+        -------
+        lo_lefts, lo_rights, flips : 1D arrays of int
+            Flips as used by `accumulate_windows`.
+
+        """
+        max_right = self.matsizes[chrom]
+        windows = [
+            window
+            for window in (self._get_window(*pos, max_right) for pos in mids)
+            if window is not None
+        ]
+        if len(windows) == 0:
+            return np.zeros((3, 0), dtype=np.int64)
+        lo_lefts, _, lo_rights, _, _, rot_flips, rots = map(np.array, zip(*windows))
+        flips = np.where(rot_flips, 1, np.where(rots, 2, 0))
+        return lo_lefts, lo_rights, flips
+
+    def _use_sparse_windows(self, data, lo_lefts, lo_rights, sample=100):
+        """Check whether windows are sparse enough to only add their stored pixels
+
+        Parameters
+        ----------
+        data : csr or BalancedMatrix
+            Upper triangular data for the chromosome.
+        lo_lefts, lo_rights : 1D arrays of int
+            First row and column of each window.
+        sample : int, optional
+            Approximate number of windows to count stored pixels in.
+            The default is 100.
+
+        Returns
+        -------
+        bool
+            Whether the average fraction of stored pixels in the sampled windows is
+            below sparse_threshold.
+
+        """
+        if self.sparse_threshold is None or len(lo_lefts) == 0:
+            return False
+        data = getattr(data, "raw", data)
+        if not data.has_sorted_indices:
+            data.sort_indices()
+        size = 2 * self.pad_bins + 1
+        step = max(len(lo_lefts) // sample, 1)
+        lo_lefts = np.asarray(lo_lefts[::step], dtype=np.int64)
+        lo_rights = np.asarray(lo_rights[::step], dtype=np.int64)
+        nnz = _count_stored(data.indptr, data.indices, lo_lefts, lo_rights, size)
+        return nnz / (len(lo_lefts) * size ** 2) < self.sparse_threshold
+
+    def _get_window_coverage(self, coverage, lo_lefts, lo_rights):
+        """Sum up coverage of the left and bottom sides of windows, if coverage_norm
+
+        Returns
+        -------
+        cov_start, cov_end : 1D arrays
+            Zeros if not used.
+
+        """
+        size = 2 * self.pad_bins + 1
+        cov_start = np.zeros(size)
+        cov_end = np.zeros(size)
+        if self.coverage_norm and (self.balance is False):
+            coverage = np.nan_to_num(coverage).astype(float)
+            offsets = np.arange(size)
+            cov_start = np.sum(coverage[lo_lefts[:, None] + offsets], axis=0)
+            cov_end = np.sum(coverage[lo_rights[:, None] + offsets], axis=0)
+        return cov_start, cov_end
+
+    def _do_pileups_positions(self, mids, chrom, data, positions):
+        """Pile up only some pixels of the windows, reading them one by one
+
+        The work per window depends only on the number of positions, and not on the
+        size of the windows. Sums of blocks of pixels, e.g. from summed-area tables,
+        can't be used instead, since the statistics of `prepare_single` need each
+        pixel divided by its control, and the corner CV needs single pixel values.
+
+        Parameters
+        ----------
+        mids : iterator
+            Stream of (stBin, endBin, stPad, endPad) coordinates.
+        chrom : str
+            Chromosome name.
+        data : csr or BandedMatrix
+            Upper triangular data for the chromosome.
+        positions : 2D array of bool
+            Which pixels of the pileup to sum up. Other pixels are left empty.
+
+        Returns
+        -------
+        Same as _do_pileups.
+
+        """
+        size = 2 * self.pad_bins + 1
+        mymap = self.make_outmap()
+        num = np.zeros_like(mymap)
+        cov_start = np.zeros(size)
+        cov_end = np.zeros(size)
+        lo_lefts, lo_rights, flips = self._get_window_arrays(mids, chrom)
+        n = len(lo_lefts)
+        if n == 0:
+            return mymap, num, cov_start, cov_end, n
+        i, j = np.nonzero(positions)
+        last = size - 1
+        # Pixel of the window that ends up in each position, for each orientation
+        a = np.stack([i, last - j, last - j])[flips]
+        b = np.stack([j, last - i, i])[flips]
+        rows = lo_lefts[:, None] + a
+        cols = lo_rights[:, None] + b
+        if self.local:
+            rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+        valid = cols - rows >= self.ignore_diags
+        values = np.zeros(rows.shape)
+        if not self.local:
+            values[~valid] = np.nan
+        if isinstance(data, (BandedMatrix, BalancedMatrix)):
+            values[valid] = data.get_pixels(rows[valid], cols[valid])
+        else:
+            values[valid] = np.asarray(data[rows[valid], cols[valid]]).ravel()
+        mymap[i, j] = np.nansum(values, axis=0)
+        num[i, j] = np.sum(np.isfinite(values), axis=0)
+        return mymap, num, cov_start, cov_end, n
+
+    def _use_sweep(self, expected):
+        """Check whether the sweep engine can be used for a pileup"""
+        return (
+            self.engine == "sweep"
+            and not expected
+            and not self.rescale
+            and not self.banded
+            and self.snippets_file is None
+        )
+
+    def get_pixel_chunks(self, chrom, data=None, chunksize=100000, raw=False):
+        """Stream pixels of the upper triangular matrix of a chromosome in chunks
+
+        Pixels are read in the order they are stored in the cooler, and balancing
+        weights are applied to each pixel unless raw.
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+        data : csr, optional
+            Already loaded data for the chromosome, used instead of reading the
+            cooler. The default is None.
+        chunksize : int, optional
+            How many pixels to read at once. The default is 100000.
+        raw : bool, optional
+            Whether to stream raw counts from the cooler even when balancing.
+            The default is False.
+
+        Yields
+        ------
+        rows, cols, values : 1D arrays
+            Coordinates within the chromosome and values of the pixels.
+
+        """
+        if data is not None:
+            if isinstance(data, BalancedMatrix):
+                data = data.to_coo()
+            else:
+                data = sparse.coo_matrix(data)
+            for start in range(0, data.nnz, chunksize):
+                end = start + chunksize
+                yield (
+                    data.row[start:end].astype(np.int64),
+                    data.col[start:end].astype(np.int64),
+                    data.data[start:end].astype(float),
+                )
+            return
+        lo, hi = self.clr.extent(chrom)
+        with self.clr.open("r") as h5:
+            first = h5["indexes"]["bin1_offset"][lo]
+            last = h5["indexes"]["bin1_offset"][hi]
+        weights = self.get_weights(chrom)
+        pixels = self.clr.pixels()
+        for start in range(first, last, chunksize):
+            chunk = pixels[start : min(start + chunksize, last)]
+            chunk = chunk[chunk["bin2_id"] < hi]
+            rows = chunk["bin1_id"].values.astype(np.int64) - lo
+            cols = chunk["bin2_id"].values.astype(np.int64) - lo
+            values = chunk["count"].values.astype(float)
+            if self.balance and not raw:
+                values = values * weights[rows] * weights[cols]
+            yield rows, cols, values
+
+    def _sweep_pixels(
+        self, chrom, lo_lefts, lo_rights, flips, groups=None, n_groups=1, data=None,
+        pool=None,
+    ):
+        """Add each pixel of a chromosome to all windows that contain it
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+        lo_lefts, lo_rights, flips : 1D arrays of int
+            Windows, as returned by `_get_window_arrays`.
+        groups : 1D array of int, optional
+            Which pileup each window belongs to. The default is None.
+        n_groups : int, optional
+            Number of pileups. The default is 1.
+        data : csr, optional
+            Already loaded data for the chromosome. The default is None, then pixels
+            are streamed from the cooler.
+        pool : ThreadPool, optional
+            If provided, chunks of pixels are processed by the threads of the pool.
+            The default is None.
+
+        Returns
+        -------
+        out, num : 3D arrays
+            Sum and number of finite values for each pileup.
+        coverage : 1D array or None
+            Coverage of the chromosome, if coverage_norm.
+
+        """
+        n_bins = self.matsizes[chrom]
+        index = WindowIndex(
+            lo_lefts,
+            lo_rights,
+            flips,
+            2 * self.pad_bins + 1,
+            n_bins,
+            groups=groups,
+            n_groups=n_groups,
+        )
+        cov_rows = np.zeros(n_bins)
+        cov_cols = np.zeros(n_bins)
+
+        def chunks():
+            for rows, cols, values in self.get_pixel_chunks(chrom, data):
+                if self.coverage_norm:
+                    cov_rows[:] += np.bincount(rows, values, minlength=n_bins)
+                    cov_cols[:] += np.bincount(cols, values, minlength=n_bins)
+                yield rows, cols, values
+
+        f = partial(index.accumulate, ignore_diags=self.ignore_diags, local=self.local)
+        mapper = map if pool is None else pool.imap
+        out = np.zeros((n_groups, index.size, index.size))
+        nans = np.zeros_like(out)
+        for chunk_out, chunk_nans in mapper(f, chunks()):
+            out += chunk_out
+            nans += chunk_nans
+        num = index.count_valid(self.ignore_diags, self.local) - nans
+        if self.coverage_norm:
+            coverage = np.nan_to_num(cov_rows) + np.nan_to_num(cov_cols)
+        else:
+            coverage = None
+        return out, num, coverage
+
+    def _do_pileups_sweep(self, mids, chrom, data=None, pool=None):
+        """Pile up windows by streaming the pixels of the chromosome once
+
+        Each pixel is added to every window that contains it, so the cost depends
+        on the number of pixels and on how much the windows overlap, rather than
+        on the number of windows.
+
+        Parameters
+        ----------
+        mids : iterator
+            Stream of (stBin, endBin, stPad, endPad) coordinates.
+        chrom : str
+            Chromosome name.
+        data : csr, optional
+            Already loaded data for the chromosome. The default is None.
+        pool : ThreadPool, optional
+            Pool of threads to process chunks of pixels. The default is None.
+
+        Returns
+        -------
+        Same as _do_pileups.
+
+        """
+        size = 2 * self.pad_bins + 1
+        lo_lefts, lo_rights, flips = self._get_window_arrays(mids, chrom)
+        n = len(lo_lefts)
+        if n == 0:
+            logging.info(f"Nothing to sum up in chromosome {chrom}")
+            mymap = self.make_outmap()
+            return mymap, mymap, np.zeros(size), np.zeros(size), 0
+        out, num, coverage = self._sweep_pixels(
+            chrom, lo_lefts, lo_rights, flips, data=data, pool=pool
+        )
+        cov_start, cov_end = self._get_window_coverage(coverage, lo_lefts, lo_rights)
+        return out[0], num[0], cov_start, cov_end, n
+
+    def _do_pileups_sweep_groups(self, mids_list, chrom, data=None, pool=None):
+        """Pile up several groups of windows in one sweep over the pixels, e.g.
+        windows and their controls
+
+        Parameters
+        ----------
+        mids_list : list of iterators
+            Streams of (stBin, endBin, stPad, endPad) coordinates for each group.
+        chrom : str
+            Chromosome name.
+        data : csr, optional
+            Already loaded data for the chromosome. The default is None.
+        pool : ThreadPool, optional
+            Pool of threads to process chunks of pixels. The default is None.
+
+        Returns
+        -------
+        results : list of tuples
+            Same as _do_pileups, for each group.
+
+        """
+        size = 2 * self.pad_bins + 1
+        windows = [self._get_window_arrays(mids, chrom) for mids in mids_list]
+        ns = [len(lo_lefts) for lo_lefts, _, _ in windows]
+        if sum(ns) == 0:
+            logging.info(f"Nothing to sum up in chromosome {chrom}")
+            mymap = self.make_outmap()
+            return [(mymap, mymap, np.zeros(size), np.zeros(size), 0)] * len(ns)
+        lo_lefts, lo_rights, flips = map(np.concatenate, zip(*windows))
+        groups = np.repeat(np.arange(len(ns)), ns)
+        out, num, coverage = self._sweep_pixels(
+            chrom, lo_lefts, lo_rights, flips, groups, len(ns), data=data, pool=pool
+        )
+        results = []
+        for group, n in enumerate(ns):
+            cov_start, cov_end = self._get_window_coverage(
+                coverage, lo_lefts[groups == group], lo_rights[groups == group]
+            )
+            results.append((out[group], num[group], cov_start, cov_end, n))
+        return results
+
+    def _do_pileups_sweep_by_window(self, windows, chrom, data=None, pool=None):
+        """Make all by-window pileups of a chromosome in one sweep over its pixels
+
+        Parameters
+        ----------
+        windows : iterator
+            Pairs of ((start, end), stream of coordinates), as generated by
+            `CoordCreator.get_combinations_by_window`.
+        chrom : str
+            Chromosome name.
+        data : csr, optional
+            Already loaded data for the chromosome. The default is None.
+        pool : ThreadPool, optional
+            Pool of threads to process chunks of pixels. The default is None.
+
+        Returns
+        -------
+        results : list
+            Pairs of ((start, end), result), with results in the same format as
+            returned by _do_pileups.
+
+        """
+        size = 2 * self.pad_bins + 1
+        positions = []
+        arrays = []
+        for pos, stream in windows:
+            positions.append(pos)
+            arrays.append(self._get_window_arrays(stream, chrom))
+        if len(positions) == 0:
+            return []
+        lo_lefts, lo_rights, flips = map(np.concatenate, zip(*arrays))
+        groups = np.repeat(np.arange(len(positions)), [len(a[0]) for a in arrays])
+        out, num, _ = self._sweep_pixels(
+            chrom,
+            lo_lefts,
+            lo_rights,
+            flips,
+            groups=groups,
+            n_groups=len(positions),
+            data=data,
+            pool=pool,
+        )
+        ns = np.bincount(groups, minlength=len(positions))
+        return [
+            (pos, (out[k], num[k], np.zeros(size), np.zeros(size), ns[k]))
+            for k, pos in enumerate(positions)
+        ]
+
+    def _use_algebraic(self, ctrl, expected):
+        """Check whether the algebraic engine can be used for a pileup"""
+        return (
+            self.engine == "algebraic"
+            and not ctrl
+            and not expected
+            and self.kind == "bed"
+            and not self.local
+            and not self.anchor
+            and not self.rescale
+            and not self.banded
+            and self.snippets_file is None
+            and self.distance_bins is None
+            and (self.CC.mids2 is None or self.bed2_ordered)
+        )
+
+    def _do_pileups_algebraic(self, chrom, data, coverage=None):
+        """Pile up all combinations of regions in a chromosome without enumerating them
+
+        The pileup at offset (di, dj) from the centre is x_di^T M y_dj, where x_di and
+        y_dj are indicator vectors of the left and right regions shifted by di and
+        dj, and M is the matrix restricted to the diagonals corresponding to the
+        allowed distances between the regions. Counts of finite values are
+        derived from the number of pairs at each distance, minus the same product
+        computed with the matrix of NaN pixels.
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+        data : csr
+            Upper triangular data for the chromosome.
+        coverage : array, optional
+            Coverage of the chromosome, if coverage_norm. The default is None.
+
+        Returns
+        -------
+        Same as _do_pileups.
+
+        """
+        n_bins = self.matsizes[chrom]
+        pad = self.pad_bins
+        size = 2 * pad + 1
+        filter_func = self.CC.filter_func_chrom(chrom=chrom)
+
+        def indicator(mids):
+            vector = np.zeros(n_bins)
+            bins = filter_func(mids)["Bin"].values.astype(int)
+            vector[bins[(bins >= pad) & (bins < n_bins - pad)]] = 1
+            return vector
+
+        left = indicator(self.CC.mids)
+        if self.CC.mids2 is None:
+            right = left
+        else:
+            right = indicator(self.CC.mids2)
+        lo = max(int(np.ceil(self.mindist / self.resolution)), 1)
+        if np.isfinite(self.maxdist):
+            hi = int(min(self.maxdist // self.resolution, n_bins))
+        else:
+            hi = n_bins
+        positions = np.arange(n_bins)
+        cum_left = np.r_[0, np.cumsum(left)]
+        cum_right = np.r_[0, np.cumsum(right)]
+
+        def partners(cumsum, lo_dist, hi_dist):
+            starts = np.clip(positions + lo_dist, 0, n_bins)
+            ends = np.clip(positions + hi_dist + 1, 0, n_bins)
+            return cumsum[ends] - cumsum[np.minimum(starts, ends)]
+
+        deg_left = left * partners(cum_right, lo, hi)
+        n = int(np.sum(deg_left))
+        mymap = self.make_outmap()
+        cov_start = np.zeros(size)
+        cov_end = np.zeros(size)
+        if n == 0:
+            return mymap, np.zeros_like(mymap), cov_start, cov_end, 0
+
+        offsets = np.arange(-pad, pad + 1)
+        near_left = np.convolve(left, np.ones(size), "same") > 0
+        near_right = np.convolve(right, np.ones(size), "same") > 0
+        if isinstance(data, BalancedMatrix):
+            data = data.to_coo()
+        else:
+            data = sparse.coo_matrix(data)
+        diags = data.col - data.row
+        keep = (
+            near_left[data.row]
+            & near_right[data.col]
+            & (diags >= max(lo - 2 * pad, self.ignore_diags))
+            & (diags <= hi + 2 * pad)
+        )
+        rows, cols, diags = data.row[keep], data.col[keep], diags[keep]
+        values = data.data[keep].astype(float)
+        nans = np.isnan(values)
+        values[nans] = 0
+
+        def shifted(vector):
+            bins = np.flatnonzero(vector)
+            return sparse.csr_matrix(
+                (
+                    np.repeat(vector[bins], size),
+                    (
+                        np.repeat(bins, size) + np.tile(offsets, len(bins)),
+                        np.tile(np.arange(size), len(bins)),
+                    ),
+                ),
+                shape=(n_bins, size),
+            )
+
+        X = shifted(left).T.tocsr()
+        Y = shifted(right)
+
+        def product(vals, in_band):
+            matrix = sparse.csr_matrix(
+                (vals[in_band], (rows[in_band], cols[in_band])), shape=(n_bins, n_bins)
+            )
+            return (X @ matrix @ Y).toarray()
+
+        num = np.zeros_like(mymap)
+        for delta in range(-2 * pad, 2 * pad + 1):
+            # Pixels with dj - di == delta
+            idx = np.arange(max(0, -delta), min(size, size - delta))
+            in_band = (diags - delta >= lo) & (diags - delta <= hi)
+            mymap[idx, idx + delta] = product(values, in_band)[idx, idx + delta]
+            n_nans = product(nans.astype(float), in_band)[idx, idx + delta]
+            n_pairs = np.sum(
+                left * partners(cum_right, max(lo, self.ignore_diags - delta), hi)
+            )
+            num[idx, idx + delta] = n_pairs - n_nans
+
+        if self.coverage_norm and (self.balance is False):
+            coverage = np.nan_to_num(coverage).astype(float)
+            deg_right = right * partners(cum_left, -hi, -lo)
+            for k, offset in enumerate(offsets):
+                bins = np.flatnonzero(deg_left)
+                cov_start[k] = np.dot(deg_left[bins], coverage[bins + offset])
+                bins = np.flatnonzero(deg_right)
+                cov_end[k] = np.dot(deg_right[bins], coverage[bins + offset])
+        return mymap, num, cov_start, cov_end, n
+
+    def get_mids_stream(self, chrom, ctrl=False):
+        """Get coordinates of all windows, or of their controls, in a chromosome
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+        ctrl : bool, optional
+            Whether to generate randomly shifted control regions.
+            The default is False.
+
+        Returns
+        -------
+        mids : iterator
+            Stream of (stBin, endBin, stPad, endPad) coordinates.
+
+        """
+        filter_func = self.CC.filter_func_chrom(chrom=chrom)
+        if ctrl:
+            mids = self.CC.control_regions(filter_func)
+        else:
+            mids = self.CC.pos_stream(filter_func)
+        return self.filter_bad_windows(mids, chrom)
+
+    def pileup_chrom(
+        self, chrom, expected=False, ctrl=False, pool=None, data=None, mids=None,
+    ):
+        """
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+        expected : bool, optional
+            Whether to create pileup of expected values. The default is False.
+        ctrl : bool, optional
+            Whether to pileup randomly shifted control regions. The default is False.
+        pool : ThreadPool, optional
+            If provided, the chromosome is loaded once and its windows are piled up
+            by the threads of the pool. The default is None.
+        data : csr or BandedMatrix, optional
+            Already loaded data for the chromosome. The default is None.
+        mids : iterator, optional
+            Already generated stream of window coordinates, as returned by
+            `get_mids_stream`. The default is None.
+
+
+        Returns
+        -------
+        pileup : 2D array
+            Pileup for the specified chromosome.
+        n : int
+            How many ROIs were piled up.
+        cov_start : 1D array
+            Accumulated coverage of the left side of the pileup.
+        cov_end : 1D array
+            Accumulated coverage of the bottom side of the pileup.
+
+        """
+
+        mymap = self.make_outmap()
+        cov_start = np.zeros(mymap.shape[0])
+        cov_end = np.zeros(mymap.shape[1])
+
+        if self.anchor:
+            assert chrom == self.anchor[0]
+            logging.info(f"Anchor: {chrom}:{self.anchor[1]}-{self.anchor[2]}")
+
+        if mids is None:
+            mids = self.get_mids_stream(chrom, ctrl)
+        if self.snippets_file is not None and not ctrl and not expected:
+            snippets = SnippetWriter(self.snippets_file, self.snippet_offsets[chrom])
+        else:
+            snippets = None
+        if self._use_algebraic(ctrl, expected):
+            if data is None:
+                data = self.load_data(chrom)
+            if self.coverage_norm:
+                coverage = self.get_coverage(data, chrom)
+            else:
+                coverage = None
+            mymap, num, cov_start, cov_end, n = self._do_pileups_algebraic(
+                chrom, data, coverage
+            )
+        elif self._use_sweep(expected):
+            mymap, num, cov_start, cov_end, n = self._do_pileups_sweep(
+                mids=mids, chrom=chrom, data=data, pool=pool
+            )
+        elif pool is None:
+            mymap, num, cov_start, cov_end, n = self._do_pileups(
+                mids=mids, chrom=chrom, expected=expected, snippets=snippets, data=data,
+            )
+        else:
+            mymap, num, cov_start, cov_end, n = self._do_pileups_threaded(
+                mids=mids,
+                chrom=chrom,
+                pool=pool,
+                expected=expected,
+                snippets=snippets,
+                data=data,
+            )
+        logging.info(f"{chrom}: {n}")
+        return mymap, num, cov_start, cov_end, n
+
+    def pileup_chrom_with_control(
+        self, chrom, pool=None, data=None, mids=None, ctrl_mids=None
+    ):
+        """Pile up windows of a chromosome together with their controls or expected,
+        loading the data only once
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+        pool : ThreadPool, optional
+            If provided, windows are piled up by the threads of the pool.
+            The default is None.
+        data : csr or BandedMatrix, optional
+            Already loaded data for the chromosome. The default is None.
+        mids : iterator, optional
+            Already generated stream of window coordinates, as returned by
+            `get_mids_stream`. The default is None.
+        ctrl_mids : iterator, optional
+            The same for the controls. The default is None.
+
+        Returns
+        -------
+        loop : tuple
+            (pileup, num, cov_start, cov_end, n), as returned by `pileup_chrom`.
+        ctrl : tuple or None
+            The same for expected or controls, or None if not using either.
+
+        """
+        if self.expected is not False:
+            # Expected doesn't use the data
+            loop = self.pileup_chrom(chrom, pool=pool, data=data)
+            return loop, self.pileup_chrom(chrom, expected=True, pool=pool)
+        if mids is None:
+            mids = self.get_mids_stream(chrom)
+        if not self.control:
+            return self.pileup_chrom(chrom, pool=pool, data=data, mids=mids), None
+        if ctrl_mids is None:
+            ctrl_mids = self.get_mids_stream(chrom, ctrl=True)
+        if self._use_sweep(False):
+            loop, ctrl = self._do_pileups_sweep_groups(
+                [mids, ctrl_mids], chrom, data=data, pool=pool
+            )
+            logging.info(f"{chrom}: {loop[4]}")
+            logging.info(f"{chrom}: {ctrl[4]}")
+            return loop, ctrl
+        if data is None:
+            if self._use_adaptive_data() and not self._use_algebraic(False, False):
+                data, mids = self.get_adaptive_data(mids, chrom)
+                loop = self.pileup_chrom(chrom, pool=pool, data=data, mids=mids)
+                if isinstance(getattr(data, "raw", data), RowBlockMatrix):
+                    # Controls need other rows, which are also only a few
+                    data = None
+                ctrl = self.pileup_chrom(
+                    chrom, ctrl=True, pool=pool, data=data, mids=ctrl_mids
+                )
+                return loop, ctrl
+            data = self.load_data(chrom)
+        loop = self.pileup_chrom(chrom, pool=pool, data=data, mids=mids)
+        ctrl = self.pileup_chrom(chrom, ctrl=True, pool=pool, data=data, mids=ctrl_mids)
+        return loop, ctrl
+
+    def pileupsWithControl(self, nproc=1, data=None):
+        """Perform pileups across all chromosomes and applies required
+        normalization
+
+        Parameters
+        ----------
+        nproc : int, optional
+            How many cores to use. Sends a whole chromosome per process, or, with the
+            thread executor, chunks of windows of one chromosome per thread.
+            The default is 1.
+        data : dict, optional
+            Already loaded data for each chromosome. The default is None.
+
+        Returns
+        -------
+        loop : 2D array
+            Normalized pileup.
+
+        """
+        if self.trans:
+            return self.pileupsTransWithControl(nproc)
+        if len(self.chroms) == 0:
+            return self.make_outmap(), 0
+
+        if self.snippets_file is not None:
+            self.prepare_snippet_stack()
+
+        pool = None
+        if nproc > 1 and self.executor == "thread":
+            p = ThreadPool(nproc)
+            pool = p
+            mymap = map
+        elif nproc > 1:
+            p = Pool(nproc)
+            mymap = p.map
+        else:
+            mymap = map
+        if data is not None:
+            datamap = lambda f, chroms: [f(chrom, data=data[chrom]) for chrom in chroms]
+        elif self.prefetch > 0 and (nproc <= 1 or self.executor == "thread"):
+            datamap = self._map_prefetched
+        else:
+            datamap = mymap
+        # Loops are piled up together with their controls or expected, so that each
+        # chromosome is loaded once
+        f = partial(self.pileup_chrom_with_control, pool=pool)
+        results = list(datamap(f, self.chroms))
+        loops, nums, cov_starts, cov_ends, ns = list(zip(*[lp for lp, _ in results]))
+        loop = np.sum(loops, axis=0)
+        n = np.sum(ns)
+        n_return = n
+        num = np.sum(nums, axis=0)
+        if self.coverage_norm:
+            cov_start = np.sum(cov_starts, axis=0)
+            cov_end = np.sum(cov_ends, axis=0)
+            loop = norm_coverage(loop, cov_start, cov_end)
+        loop /= num
+        logging.info(f"Total number of piled up windows: {n}")
+        # Controls
+        if self.expected is not False:
+            exps, nums, cov_starts, cov_ends, ns = list(zip(*[c for _, c in results]))
+            exp = np.sum(exps, axis=0)
+            num = np.sum(nums, axis=0)
+            exp /= num
+            loop /= exp
+        elif self.control:
+            ctrls, nums, cov_starts, cov_ends, ns = list(zip(*[c for _, c in results]))
+            ctrl = np.sum(ctrls, axis=0)
+            num = np.sum(nums, axis=0)
+            n = np.sum(ns)
+            if self.coverage_norm:
+                cov_start = np.sum(cov_starts, axis=0)
+                cov_end = np.sum(cov_ends, axis=0)
+                ctrl = norm_coverage(ctrl, cov_start, cov_end)
+            ctrl /= num
+            logging.info(f"Total number of piled up control windows: {n}")
+            loop /= ctrl
+        if nproc > 1:
+            p.close()
+        loop[~np.isfinite(loop)] = 0
+        return loop, n_return
+
+    def get_trans_data(self, chrom1, chrom2):
+        """Get sparse data for the block of a pair of chromosomes
+
+        Parameters
+        ----------
+        chrom1, chrom2 : str
+            Chromosomes of the rows and the columns.
+
+        Returns
+        -------
+        data : csr or BalancedMatrix
+            Sparse matrix of raw counts of the block, wrapped to apply balancing
+            weights of both chromosomes if balancing.
+
+        """
+        logging.debug(f"Loading {chrom1}-{chrom2}")
+        data = self.clr.matrix(sparse=True, balance=False).fetch(chrom1, chrom2)
+        data = data.tocsr()
+        if not self.balance:
+            return data.astype(self.dtype)
+        return BalancedMatrix(
+            data,
+            self.get_weights(chrom1),
+            dtype=self.dtype,
+            col_weights=self.get_weights(chrom2),
+        )
+
+    def get_trans_nnz(self, chunksize=10 ** 7):
+        """Count stored pixels in the block of each pair of chromosomes
+
+        Only the bin2_id column of the pixel table is read, once for each
+        chromosome on the upper side of the blocks.
+
+        Parameters
+        ----------
+        chunksize : int, optional
+            How many pixels to read at once.
+            The default is 10 ** 7.
+
+        Returns
+        -------
+        nnz : dict
+            Number of stored pixels for each pair in chrom_pairs.
+
+        """
+        chromnames = self.clr.chromnames
+        # Blocks are stored in rows of the chromosome that comes first in the cooler
+        pairs = {
+            pair: tuple(sorted(pair, key=chromnames.index)) for pair in self.chrom_pairs
+        }
+        nnz = {}
+        with self.clr.open("r") as h5:
+            chrom_offsets = h5["indexes"]["chrom_offset"][:]
+            bin1_offsets = h5["indexes"]["bin1_offset"]
+            for upper in natsorted(set(first for first, _ in pairs.values())):
+                lo, hi = self.clr.extent(upper)
+                first, last = bin1_offsets[lo], bin1_offsets[hi]
+                counts = np.zeros(len(chromnames), dtype=np.int64)
+                for start in range(first, last, chunksize):
+                    bin2 = h5["pixels"]["bin2_id"][start : min(start + chunksize, last)]
+                    chrom_ids = np.searchsorted(chrom_offsets, bin2, side="right") - 1
+                    counts += np.bincount(chrom_ids, minlength=len(chromnames))
+                for pair, (first_chrom, second_chrom) in pairs.items():
+                    if first_chrom == upper:
+                        nnz[pair] = counts[chromnames.index(second_chrom)]
+        return nnz
+
+    def _do_pileups_trans(self, mids, data, coverage=None):
+        """Pile up windows from the block of a pair of chromosomes
+
+        Parameters
+        ----------
+        mids : iterator
+            Stream of (bin1, bin2, pad1, pad2) coordinates.
+        data : csr
+            Data for the block.
+        coverage : tuple of 1D arrays, optional
+            Coverage of the rows and of the columns of the block, if coverage_norm.
+            The default is None.
+
+        Returns
+        -------
+        Same as _do_pileups.
+
+        """
+        mymap = self.make_outmap()
+        cov_start = np.zeros(mymap.shape[0])
+        cov_end = np.zeros(mymap.shape[1])
+        num = np.zeros_like(mymap)
+        n = 0
+        max_left, max_right = data.shape
+        for stBin, endBin, stPad, endPad in mids:
+            if self.rescale:
+                stPad = stPad + int(round(self.rescale_pad * 2 * stPad))
+                endPad = endPad + int(round(self.rescale_pad * 2 * endPad))
+            else:
+                stPad, endPad = self.pad_bins, self.pad_bins
+            lo_left, hi_left = stBin - stPad, stBin + stPad + 1
+            lo_right, hi_right = endBin - endPad, endBin + endPad + 1
+            if lo_left < 0 or lo_right < 0 or hi_left > max_left or hi_right > max_right:
+                continue
+            newmap = data[lo_left:hi_left, lo_right:hi_right]
+            if sparse.issparse(newmap):
+                newmap = newmap.toarray()
+            new_cov_start = new_cov_end = None
+            if coverage is not None:
+                new_cov_start = coverage[0][lo_left:hi_left]
+                new_cov_end = coverage[1][lo_right:hi_right]
+            if self.rescale:
+                newmap = numutils.zoom_array(
+                    newmap, (self.rescale_size, self.rescale_size)
+                ).astype(self.dtype)
+                if coverage is not None:
+                    new_cov_start = numutils.zoom_array(
+                        new_cov_start, (self.rescale_size,)
+                    )
+                    new_cov_end = numutils.zoom_array(new_cov_end, (self.rescale_size,))
+            mymap = np.nansum([mymap, newmap], axis=0)
+            if coverage is not None:
+                cov_start += np.nan_to_num(new_cov_start)
+                cov_end += np.nan_to_num(new_cov_end)
+            num += np.isfinite(newmap).astype(int)
+            n += 1
+        return mymap, num, cov_start, cov_end, n
+
+    def pileup_trans(self, pair):
+        """Pile up windows and their controls between a pair of chromosomes
+
+        The block of the pair is loaded once and used for both.
+
+        Parameters
+        ----------
+        pair : tuple
+            (chrom1, chrom2) chromosomes of the left and bottom sides of windows.
+
+        Returns
+        -------
+        pair : tuple
+            The same pair.
+        loop : tuple
+            (pileup, num, cov_start, cov_end, n), as returned by `pileup_chrom`.
+        ctrl : tuple or None
+            The same for controls, or None if not using controls.
+
+        """
+        data = self.get_trans_data(*pair)
+        if self.coverage_norm and (self.balance is False):
+            coverage = (
+                np.nan_to_num(np.ravel(np.sum(data, axis=1))),
+                np.nan_to_num(np.ravel(np.sum(data, axis=0))),
+            )
+        else:
+            coverage = None
+        mids = self.CC.get_trans_combinations(*pair)
+        loop = self._do_pileups_trans(mids, data, coverage)
+        logging.info(f"{pair[0]}-{pair[1]}: {loop[4]}")
+        ctrl = None
+        if self.control:
+            mids = self.CC.get_trans_combinations(*pair)
+            mids = self.CC.control_regions(self.CC.filter_func_all, mids)
+            ctrl = self._do_pileups_trans(mids, data, coverage)
+        return pair, loop, ctrl
+
+    def combine_pileups(self, results, coverage=True):
+        """Sum up pileups of several chromosomes and normalize them
+
+        Parameters
+        ----------
+        results : list of tuples
+            (pileup, num, cov_start, cov_end, n) for each chromosome, as returned by
+            `pileup_chrom`.
+        coverage : bool, optional
+            Whether to normalize by coverage, if coverage_norm. The default is True.
+
+        Returns
+        -------
+        pileup : 2D array
+            Sum of pileups divided by the number of valid values of each pixel.
+        n : int
+            Total number of windows.
+
+        """
+        pileups, nums, cov_starts, cov_ends, ns = zip(*results)
+        pileup = np.sum(pileups, axis=0)
+        if self.coverage_norm and coverage:
+            pileup = norm_coverage(
+                pileup, np.sum(cov_starts, axis=0), np.sum(cov_ends, axis=0)
+            )
+        return pileup / np.sum(nums, axis=0), np.sum(ns)
+
+    def pileupsTransWithControl(self, nproc=1):
+        """Perform trans pileups across all pairs of chromosomes and apply required
+        normalization
+
+        Pairs of chromosomes are sent to workers starting from the blocks with the
+        most stored pixels, so that the largest blocks don't end up last.
+
+        Parameters
+        ----------
+        nproc : int, optional
+            How many cores to use. Sends a pair of chromosomes per process or thread.
+            The default is 1.
+
+        Returns
+        -------
+        loop : 2D array
+            Normalized pileup.
+        n : int
+            How many windows were piled up.
+
+        """
+        if len(self.chrom_pairs) == 0:
+            return self.make_outmap(), 0
+        if nproc > 1:
+            nnz = self.get_trans_nnz()
+            pairs = sorted(self.chrom_pairs, key=lambda pair: nnz[pair], reverse=True)
+            p = ThreadPool(nproc) if self.executor == "thread" else Pool(nproc)
+            results = p.imap_unordered(self.pileup_trans, pairs)
+        else:
+            results = map(self.pileup_trans, self.chrom_pairs)
+        results = {pair: (loop, ctrl) for pair, loop, ctrl in results}
+        if nproc > 1:
+            p.close()
+        # Sum up in a fixed order to make the result independent of scheduling
+        loops, ctrls = zip(*[results[pair] for pair in self.chrom_pairs])
+        loop, n = self.combine_pileups(loops)
+        logging.info(f"Total number of piled up windows: {n}")
+        if self.control:
+            ctrl, n_ctrl = self.combine_pileups(ctrls)
+            logging.info(f"Total number of piled up control windows: {n_ctrl}")
+            loop /= ctrl
+        loop[~np.isfinite(loop)] = 0
+        return loop, n
+
+    def _split_by_distance(self, chrom):
+        """Split window coordinates of a chromosome into lists by distance band
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+
+        Returns
+        -------
+        parts : dict
+            Keys are tuples of (start, end) of the bands of distance_bins, clipped to
+            mindist and maxdist, values are lists of coordinates of windows in each
+            band. Bands include their start, and the last band also includes its end.
+            Windows outside of all bands are dropped, as are bands outside of
+            mindist and maxdist.
+
+        """
+        bands = []
+        for start, end in zip(self.distance_bins[:-1], self.distance_bins[1:]):
+            # Label bands with the distances that are actually piled up
+            start, end = max(start, self.CC.mindist), min(end, self.CC.maxdist)
+            if start < end:
+                bands.append((int(start), int(end)))
+        parts = {band: [] for band in bands}
+        starts = [start for start, _ in bands]
+        for pos in self.get_mids_stream(chrom):
+            distance = abs(pos[1] - pos[0]) * self.resolution
+            i = bisect.bisect_right(starts, distance) - 1
+            if i < 0:
+                continue
+            # The last band is closed, like maxdist
+            if distance < bands[i][1] or (
+                i == len(bands) - 1 and distance == bands[i][1]
+            ):
+                parts[bands[i]].append(pos)
+        return parts
+
+    def _split_by_group(self, chrom):
+        """Split window coordinates of a chromosome into lists by the groups of
+        their regions
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+
+        Returns
+        -------
+        parts : dict
+            Keys are groups of the windows (for bedpe, local and anchor pileups) or
+            tuples of groups of the left and the bottom side of the windows, values
+            are lists of coordinates of windows.
+
+        """
+        filter_func = self.CC.filter_func_chrom(chrom=chrom)
+        parts = {}
+        for *pos, key in self.CC.pos_stream(filter_func, with_groups=True):
+            parts.setdefault(key, []).append(tuple(pos))
+        return {
+            key: list(self.filter_bad_windows(iter(part), chrom))
+            for key, part in parts.items()
+        }
+
+    def _pileup_chrom_split(self, chrom, split, pool=None, data=None):
+        """Pile up windows of a chromosome separately for each part of a split, with
+        their controls or expected, loading the data only once
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+        split : callable
+            Function that takes the chromosome name and returns a dict of lists of
+            coordinates of windows for each part.
+        pool : ThreadPool, optional
+            If provided, windows are piled up by the threads of the pool.
+            The default is None.
+        data : csr or BandedMatrix, optional
+            Already loaded data for the chromosome. The default is None.
+
+        Returns
+        -------
+        loops : dict
+            (pileup, num, cov_start, cov_end, n) for each part, as returned by
+            `pileup_chrom`.
+        ctrls : dict or None
+            The same for expected or controls, or None if not using either.
+
+        """
+        loop_parts = split(chrom)
+        keys = list(loop_parts.keys())
+        ctrl_parts = None
+        if self.control:
+            # Controls are shifted copies of the windows of each part
+            ctrl_parts = {
+                key: list(
+                    self.filter_bad_windows(
+                        self.CC.control_regions(self.CC.filter_func_all, iter(part)),
+                        chrom,
+                    )
+                )
+                for key, part in loop_parts.items()
+            }
+        if self._use_sweep(False):
+            parts = [loop_parts[key] for key in keys]
+            if self.control:
+                parts += [ctrl_parts[key] for key in keys]
+            results = self._do_pileups_sweep_groups(
+                [iter(part) for part in parts], chrom, data=data, pool=pool
+            )
+            loops = dict(zip(keys, results[: len(keys)]))
+            ctrls = dict(zip(keys, results[len(keys) :])) if self.control else None
+        else:
+            if data is None and len(keys) > 0:
+                data = self.load_data(chrom)
+            loops = {
+                key: self.pileup_chrom(chrom, pool=pool, data=data, mids=iter(part))
+                for key, part in loop_parts.items()
+            }
+            ctrls = None
+            if self.control:
+                ctrls = {
+                    key: self.pileup_chrom(
+                        chrom, ctrl=True, pool=pool, data=data, mids=iter(part)
+                    )
+                    for key, part in ctrl_parts.items()
+                }
+        if self.expected is not False:
+            ctrls = {
+                key: self.pileup_chrom(chrom, expected=True, pool=pool, mids=iter(part))
+                for key, part in loop_parts.items()
+            }
+        return loops, ctrls
+
+    def _pileups_split_with_control(self, split, nproc=1):
+        """Perform pileups across all chromosomes separately for each part of a
+        split, and apply required normalization
+
+        Parameters
+        ----------
+        split : callable
+            Function that splits window coordinates, as used by
+            `_pileup_chrom_split`.
+        nproc : int, optional
+            How many cores to use. Sends a whole chromosome per process, or, with the
+            thread executor, chunks of windows of one chromosome per thread.
+            The default is 1.
+
+        Returns
+        -------
+        pileups : dict
+            Keys are the parts. Values are tuples of (n, pileup)
+            n : int
+            How many windows were piled up.
+            pileup : 2D array
+            Normalized pileup.
+
+        """
+        pool = None
+        if nproc > 1 and self.executor == "thread":
+            p = ThreadPool(nproc)
+            pool = p
+            mymap = map
+        elif nproc > 1:
+            p = Pool(nproc)
+            mymap = p.map
+        else:
+            mymap = map
+        if self.prefetch > 0 and (nproc <= 1 or self.executor == "thread"):
+            datamap = self._map_prefetched
+        else:
+            datamap = mymap
+        f = partial(self._pileup_chrom_split, split=split, pool=pool)
+        results = list(datamap(f, self.chroms))
+        if nproc > 1:
+            p.close()
+        keys = []
+        for loops, _ in results:
+            keys += [key for key in loops.keys() if key not in keys]
+        pileups = {}
+        for key in keys:
+            found = [(loops[key], ctrls) for loops, ctrls in results if key in loops]
+            loop, n = self.combine_pileups([lp for lp, _ in found])
+            if self.expected is not False:
+                exp, _ = self.combine_pileups(
+                    [ctrls[key] for _, ctrls in found], coverage=False
+                )
+                loop /= exp
+            elif self.control:
+                ctrl, _ = self.combine_pileups([ctrls[key] for _, ctrls in found])
+                loop /= ctrl
+            loop[~np.isfinite(loop)] = 0
+            logging.info(f"{key}: {n} windows")
+            pileups[key] = n, loop
+        return pileups
+
+    def pileupsByDistanceWithControl(self, nproc=1):
+        """Perform pileups across all chromosomes separately for each distance band
+        of distance_bins, and apply required normalization
+
+        All bands are piled up from the same loaded data, so the data is read once.
+
+        Parameters
+        ----------
+        nproc : int, optional
+            How many cores to use. Sends a whole chromosome per process, or, with the
+            thread executor, chunks of windows of one chromosome per thread.
+            The default is 1.
+
+        Returns
+        -------
+        pileups : dict
+            Keys are tuples of (start, end) of the distance bands, in bp, clipped to
+            mindist and maxdist.
+            Values are tuples of (n, pileup)
+            n : int
+            How many windows were piled up.
+            pileup : 2D array
+            Normalized pileup.
+
+        """
+        return self._pileups_split_with_control(self._split_by_distance, nproc)
+
+    def pileupsByGroupWithControl(self, nproc=1):
+        """Perform pileups across all chromosomes separately for each group of
+        regions from the group column of the baselist, and apply required
+        normalization
+
+        All groups are piled up from the same loaded data, so the data is read once.
+
+        Parameters
+        ----------
+        nproc : int, optional
+            How many cores to use. Sends a whole chromosome per process, or, with the
+            thread executor, chunks of windows of one chromosome per thread.
             The default is 1.
-        rescale_size : int, optional
-            Final shape of rescaled pileups. E.g. if 99, pileups will be squares of
-            99×99 pixels.
-            The default is 99.
-        ignore_diags : int, optional
-            How many diagonals to ignore to avoid short-distance artefacts.
-            The default is 2.
 
         Returns
         -------
-        Object that generates pileups.
+        pileups : dict
+            Keys are groups (for bedpe, local and anchor pileups) or tuples of groups
+            of the left and the bottom sides of windows.
+            Values are tuples of (n, pileup)
+            n : int
+            How many windows were piled up.
+            pileup : 2D array
+            Normalized pileup.
 
         """
-        self.clr = clr
-        self.resolution = self.clr.binsize
-        self.CC = CC
-        assert self.resolution == self.CC.resolution
-        self.__dict__.update(self.CC.__dict__)
-        self.balance = balance
-        self.expected = expected
-        self.control = control
-        self.pad_bins = self.pad // self.resolution
-        self.coverage_norm = coverage_norm
-        self.rescale = rescale
-        self.rescale_pad = rescale_pad
-        self.rescale_size = rescale_size
-        self.ignore_diags = ignore_diags
-        # self.CoolSnipper = snipping.CoolerSnipper(
-        #     self.clr, cooler_opts=dict(balance=self.balance)
-        # )
-        self.matsizes = np.ceil(self.clr.chromsizes / self.resolution).astype(int)
+        if not self.groups:
+            raise ValueError("Regions have no groups, please create CoordCreator with them")
+        return self._pileups_split_with_control(self._split_by_group, nproc)
 
-        self.chroms = natsorted(
-            list(set(self.CC.final_chroms) & set(self.clr.chromnames))
-        )
-        self.regions = {
-            chrom: cooler.util.parse_region_string(chrom) for chrom in self.chroms
-        }
-        if self.expected is not False:
-            if self.control:
-                warnings.warn(
-                    "Can't do both expected and control shifts; defaulting to expected"
-                )
-                self.control = False
-            assert isinstance(self.expected, pd.DataFrame)
-            self.ExpSnipper = snipping.ExpectedSnipper(self.clr, self.expected)
-            self.expected_selections = {
-                chrom: self.ExpSnipper.select(region, region)
-                for chrom, region in self.regions.items()
-            }
-            self.expected = True
+    def _variant(self, norm):
+        """Get a copy of the PileUpper with another normalization
 
-    # def get_matrix(self, matrix, chrom, left_interval, right_interval):
-    #     lo_left, hi_left = left_interval
-    #     lo_right, hi_right = right_interval
-    #     lo_left *= self.resolution
-    #     hi_left *= self.resolution
-    #     lo_right *= self.resolution
-    #     hi_right *= self.resolution
-    #     matrix = self.CoolSnipper.snip(
-    #         matrix,
-    #         self.regions[chrom],
-    #         self.regions[chrom],
-    #         (lo_left, hi_left, lo_right, hi_right),
-    #     )
-    #     return matrix
+        Parameters
+        ----------
+        norm : str
+            balanced: balanced data
+            unbalanced: raw counts
+            coverage: raw counts with coverage normalization
 
-    def get_expected_matrix(self, chrom, left_interval, right_interval):
-        """Generate expected matrix for a region
+        Returns
+        -------
+        PU : PileUpper
+            Shallow copy with balance and coverage_norm set for the normalization.
+
+        """
+        if norm not in ("balanced", "unbalanced", "coverage"):
+            raise ValueError(
+                f"Unsupported normalization: {norm}, expect balanced, unbalanced or"
+                " coverage"
+            )
+        PU = copy.copy(self)
+        PU.balance = (self.balance or "weight") if norm == "balanced" else False
+        PU.coverage_norm = norm == "coverage"
+        return PU
+
+    def _pileup_chrom_variants(self, chrom, norms, pool=None):
+        """Pile up windows of a chromosome with several normalizations from one
+        fetch of raw data
 
         Parameters
         ----------
         chrom : str
             Chromosome name.
-        left_interval : tuple
-            Tuple of (lo_left, hi_left) bin IDs in the chromosome.
-        right_interval : tuple
-            Tuple of (lo_right, hi_right) bin IDs in the chromosome.
+        norms : list of str
+            Normalizations, as used by `_variant`.
+        pool : ThreadPool, optional
+            If provided, windows are piled up by the threads of the pool.
+            The default is None.
 
         Returns
         -------
-        exp_matrix : array
-            Array of expected values for the selected coordinates.
+        results : dict
+            (loop, ctrl) for each normalization, as returned by
+            `pileup_chrom_with_control`.
 
         """
-        lo_left, hi_left = left_interval
-        lo_right, hi_right = right_interval
-        lo_left *= self.resolution
-        hi_left *= self.resolution
-        lo_right *= self.resolution
-        hi_right *= self.resolution
-        exp_matrix = self.ExpSnipper.snip(
-            self.expected_selections[chrom],
-            self.regions[chrom],
-            self.regions[chrom],
-            (lo_left, hi_left, lo_right, hi_right),
-        )
-        return exp_matrix
+        # Data is loaded as raw counts with weights, which are only applied for
+        # the balanced pileups
+        loader = self._variant("balanced")
+        loader.coverage_norm = "coverage" in norms
+        data = loader.load_data(chrom)
+        results = {}
+        for norm in norms:
+            view = data if norm == "balanced" else getattr(data, "raw", data)
+            results[norm] = self._variant(norm).pileup_chrom_with_control(
+                chrom, pool=pool, data=view
+            )
+        return results
 
-    def make_outmap(self,):
-        """Generate zero-filled array of the right shape
+    def _crop_pileup(self, result, pad):
+        """Crop accumulated pileup, num and coverage of a chromosome to a smaller
+        pad
+
+        Parameters
+        ----------
+        result : tuple
+            (pileup, num, cov_start, cov_end, n), as returned by `pileup_chrom`.
+        pad : int
+            New padding in bp.
 
         Returns
         -------
-        outmap: array
-            Array of zeros of correct shape.
+        result : tuple
+            The same, cropped around the centre.
 
         """
-        if self.rescale:
-            outmap = np.zeros((self.rescale_size, self.rescale_size))
-        else:
-            outmap = np.zeros((2 * self.pad_bins + 1, 2 * self.pad_bins + 1))
-        return outmap
+        pileup, num, cov_start, cov_end, n = result
+        lo = self.pad_bins - pad // self.resolution
+        hi = pileup.shape[0] - lo
+        return (
+            pileup[lo:hi, lo:hi],
+            num[lo:hi, lo:hi],
+            cov_start[lo:hi],
+            cov_end[lo:hi],
+            n,
+        )
 
-    def get_data(self, region):
-        """Get sparse data for a region
+    def pileupsVariantsWithControl(self, pads=None, norms=("balanced",), nproc=1):
+        """Perform pileups with several pads and normalizations in one run, and
+        apply required normalization
+
+        Windows are extracted once at the largest pad, which has to be the pad of the
+        CoordCreator, and pileups with smaller pads are cropped from the
+        accumulated sums before normalization. So all pads use the same windows,
+        selected for the largest pad (e.g. by the automatic mindist). Raw data is
+        fetched once for all normalizations.
 
         Parameters
         ----------
-        region : tuple or str
-            Region for which to load the data. Either tuple of (chr, start, end), or
-            string with chromosome name.
+        pads : list of int, optional
+            Paddings in bp. The default is None, to use only the pad of the
+            CoordCreator.
+        norms : list of str, optional
+            Normalizations, from:
+                balanced: balanced data
+                unbalanced: raw counts
+                coverage: raw counts with coverage normalization
+            The default is ("balanced",).
+        nproc : int, optional
+            How many cores to use. Sends a whole chromosome per process, or, with the
+            thread executor, chunks of windows of one chromosome per thread.
+            The default is 1.
 
         Returns
         -------
-        data : csr
-            Sparse csr matrix for the corresponding region.
+        pileups : dict
+            Keys are tuples of (pad, norm).
+            Values are tuples of (n, pileup)
+            n : int
+            How many windows were piled up.
+            pileup : 2D array
+            Normalized pileup.
 
         """
-        logging.debug("Loading data")
-        data = self.clr.matrix(sparse=True, balance=self.balance).fetch(region)
-        data = sparse.triu(data)
-        return data.tocsr()
+        if pads is None:
+            pads = [self.pad]
+        if max(pads) > self.pad:
+            raise ValueError("Pads can't be larger than the pad of the CoordCreator")
+        if self.rescale:
+            raise ValueError("Can't use several pads with rescaling")
+        norms = list(norms)
+        for norm in norms:
+            self._variant(norm)
+        pool = None
+        if nproc > 1 and self.executor == "thread":
+            p = ThreadPool(nproc)
+            pool = p
+            mymap = map
+        elif nproc > 1:
+            p = Pool(nproc)
+            mymap = p.map
+        else:
+            mymap = map
+        f = partial(self._pileup_chrom_variants, norms=norms, pool=pool)
+        results = list(mymap(f, self.chroms))
+        if nproc > 1:
+            p.close()
+        pileups = {}
+        for norm in norms:
+            PU = self._variant(norm)
+            for pad in pads:
+                loop, n = PU._combine_with_control(
+                    [res[norm] for res in results],
+                    lambda result: self._crop_pileup(result, pad),
+                )
+                logging.info(f"Pad {pad}, {norm}: {n} windows")
+                pileups[(pad, norm)] = n, loop
+        return pileups
 
-    def get_coverage(self, data):
-        """Get total coverage profile for upper triangular data
+    def _combine_with_control(self, results, transform=None):
+        """Sum up pileups of several chromosomes and divide them by their controls
+        or expected
 
         Parameters
         ----------
-        data : array_like
-            2D array with upper triangular data.
+        results : list of tuples
+            (loop, ctrl) for each chromosome, as returned by
+            `pileup_chrom_with_control`.
+        transform : callable, optional
+            Applied to each accumulated pileup of loops and controls before they are
+            summed up. The default is None.
 
         Returns
         -------
-        coverage : array
-            1D array of coverage.
+        loop : 2D array
+            Normalized pileup.
+        n : int
+            Total number of windows.
 
         """
-        coverage = np.nan_to_num(np.ravel(np.sum(data, axis=0))) + np.nan_to_num(
-            np.ravel(np.sum(data, axis=1))
-        )
-        return coverage
-
-    def _do_pileups(
-        self, mids, chrom, expected=False,
-    ):
-        mymap = self.make_outmap()
-        cov_start = np.zeros(mymap.shape[0])
-        cov_end = np.zeros(mymap.shape[1])
-        num = np.zeros_like(mymap)
-        n = 0
-        try:
-            mids_row1 = next(mids)
-        except StopIteration:
-            logging.info(f"Nothing to sum up in chromosome {chrom}")
-            return mymap, mymap, cov_start, cov_end, n
-        else:
-            mids = itertools.chain([mids_row1], mids)
-
-        if expected:
-            data = None
-            logging.debug("Doing expected")
-        else:
-            data = self.get_data(
-                chrom
-            )  # self.CoolSnipper.select(self.regions[chrom], self.regions[chrom])
-        max_right = self.matsizes[chrom]
-
-        if self.coverage_norm:
-            coverage = self.get_coverage(data)
+        loops, ctrls = zip(*results)
+        if transform is not None:
+            loops = [transform(lp) for lp in loops]
+            if self.expected is not False or self.control:
+                ctrls = [transform(ctrl) for ctrl in ctrls]
+        loop, n = self.combine_pileups(loops)
+        if self.expected is not False:
+            exp, _ = self.combine_pileups(ctrls, coverage=False)
+            loop /= exp
+        elif self.control:
+            ctrl, _ = self.combine_pileups(ctrls)
+            loop /= ctrl
+        loop[~np.isfinite(loop)] = 0
+        return loop, n
 
-        for stBin, endBin, stPad, endPad in mids:
-            rot_flip = False
-            rot = False
-            if stBin >= endBin:
-                stBin, stPad, endBin, endPad = endBin, endPad, stBin, stPad
-                if self.anchor is None:
-                    rot_flip = True
-                else:
-                    rot = True
-            if self.rescale:
-                stPad = stPad + int(round(self.rescale_pad * 2 * stPad))
-                endPad = endPad + int(round(self.rescale_pad * 2 * endPad))
-            else:
-                stPad, endPad = self.pad_bins, self.pad_bins
-            lo_left = stBin - stPad
-            hi_left = stBin + stPad + 1
-            lo_right = endBin - endPad
-            hi_right = endBin + endPad + 1
-            if lo_left < 0 or hi_right > max_right:
-                continue
-            diag = hi_left - lo_right
-            if not expected:
-                try:
-                    newmap = data[lo_left:hi_left, lo_right:hi_right].toarray()
-                except (IndexError, ValueError):
-                    continue
-            else:
-                newmap = self.get_expected_matrix(
-                    chrom, (lo_left, hi_left), (lo_right, hi_right)
-                )
-            #                if (
-            #                    newmap.shape != mymap.shape and not self.rescale
-            #                ):  # AFAIK only happens at ends of chroms
-            #                    height, width = newmap.shape
-            #                    h, w = mymap.shape
-            #                    x = w - width
-            #                    y = h - height
-            #                    newmap = np.pad(
-            #                        newmap, [(y, 0), (0, x)], "constant"
-            #                    )  # Padding to adjust to the right shape
-            newmap = newmap.astype(float)
-            if not self.local:
-                ignore_indices = np.tril_indices_from(
-                    newmap, diag - (stPad * 2 + 1) - 1 + self.ignore_diags
-                )
-                newmap[ignore_indices] = np.nan
-            else:
-                newmap = np.triu(newmap, self.ignore_diags)
-                newmap += np.triu(newmap, 1).T
-            if self.rescale:
-                if newmap.size == 0 or np.all(np.isnan(newmap)):
-                    newmap = np.zeros((self.rescale_size, self.rescale_size))
-                else:
-                    newmap = numutils.zoom_array(
-                        newmap, (self.rescale_size, self.rescale_size)
-                    )
-            if rot_flip:
-                newmap = np.rot90(np.flipud(newmap), 1)
-            elif rot:
-                newmap = np.rot90(newmap, -1)
+    def pileupsCoarsenedWithControl(self, factors, pad=None, nproc=1):
+        """Perform pileups at this resolution, and aggregate them to coarser
+        resolutions instead of loading the coarser data
 
-            mymap = np.nansum([mymap, newmap], axis=0)
-            if self.coverage_norm and not expected and (self.balance is False):
-                new_cov_start = coverage[lo_left:hi_left]
-                new_cov_end = coverage[lo_right:hi_right]
-                if self.rescale:
-                    if len(new_cov_start) == 0:
-                        new_cov_start = np.zeros(self.rescale_size)
-                    if len(new_cov_end) == 0:
-                        new_cov_end = np.zeros(self.rescale_size)
-                    new_cov_start = numutils.zoom_array(
-                        new_cov_start, (self.rescale_size,)
-                    )
-                    new_cov_end = numutils.zoom_array(new_cov_end, (self.rescale_size,))
-                else:
-                    l = len(new_cov_start)
-                    r = len(new_cov_end)
-                    new_cov_start = np.pad(
-                        new_cov_start, (mymap.shape[0] - l, 0), "constant"
-                    )
-                    new_cov_end = np.pad(
-                        new_cov_end, (0, mymap.shape[1] - r), "constant"
-                    )
-                cov_start += np.nan_to_num(new_cov_start)
-                cov_end += +np.nan_to_num(new_cov_end)
-            num += np.isfinite(newmap).astype(int)
-            n += 1
-        return mymap, num, cov_start, cov_end, n
+        Parameters
+        ----------
+        factors : list of int
+            Odd ratios of the coarse and this resolution. 1 gives the pileup at this
+            resolution.
+        pad : int, optional
+            Padding of the aggregated pileups in bp. The pad of the CoordCreator has
+            to cover the coarse windows around the central fine bin, i.e. be larger
+            by (factor - 1) / 2 bins. The default is None, then the pad of the
+            CoordCreator is used for factor 1 only.
+        nproc : int, optional
+            How many cores to use. Sends a whole chromosome per process, or, with the
+            thread executor, chunks of windows of one chromosome per thread.
+            The default is 1.
+
+        Returns
+        -------
+        pileups : dict
+            Keys are the factors.
+            Values are tuples of (n, pileup)
+            n : int
+            How many windows were piled up.
+            pileup : 2D array
+            Normalized pileup.
 
-    def pileup_chrom(
-        self, chrom, expected=False, ctrl=False,
-    ):
         """
+        if pad is None:
+            pad = self.pad
+        if self.rescale or self.trans:
+            raise ValueError("Can't aggregate rescaled or trans pileups")
+        pool = None
+        if nproc > 1 and self.executor == "thread":
+            p = ThreadPool(nproc)
+            pool = p
+            mymap = map
+        elif nproc > 1:
+            p = Pool(nproc)
+            mymap = p.map
+        else:
+            mymap = map
+        if self.prefetch > 0 and (nproc <= 1 or self.executor == "thread"):
+            datamap = self._map_prefetched
+        else:
+            datamap = mymap
+        f = partial(self.pileup_chrom_with_control, pool=pool)
+        results = list(datamap(f, self.chroms))
+        if nproc > 1:
+            p.close()
+        pileups = {}
+        for factor in factors:
+            pad_bins = pad // (self.resolution * factor)
+            loop, n = self._combine_with_control(
+                results, lambda result: coarsen_pileup(result, factor, pad_bins)
+            )
+            logging.info(f"{self.resolution * factor} bp: {n} windows")
+            pileups[factor] = n, loop
+        return pileups
+
+    def _pileup_anchor(self, anchor, data=None):
+        """Perform the pileup for one of the anchors
 
         Parameters
         ----------
-        chrom : str
-            Chromosome name.
-        expected : bool, optional
-            Whether to create pileup of expected values. The default is False.
-        ctrl : bool, optional
-            Whether to pileup randomly shifted control regions. The default is False.
-
+        anchor : tuple
+            Anchor as (chr, start, end).
+        data : csr, optional
+            Already loaded data for the chromosome of the anchor.
+            The default is None.
 
         Returns
         -------
-        pileup : 2D array
-            Pileup for the specified chromosome.
         n : int
             How many ROIs were piled up.
-        cov_start : 1D array
-            Accumulated coverage of the left side of the pileup.
-        cov_end : 1D array
-            Accumulated coverage of the bottom side of the pileup.
+        loop : 2D array
+            Normalized pileup.
 
         """
-
-        mymap = self.make_outmap()
-        cov_start = np.zeros(mymap.shape[0])
-        cov_end = np.zeros(mymap.shape[1])
-
-        if self.anchor:
-            assert chrom == self.anchor[0]
-            logging.info(f"Anchor: {chrom}:{self.anchor[1]}-{self.anchor[2]}")
-
-        filter_func = self.CC.filter_func_chrom(chrom=chrom)
-
-        if ctrl:
-            mids = self.CC.control_regions(filter_func)
-        else:
-            mids = self.CC.pos_stream(filter_func)
-        mymap, num, cov_start, cov_end, n = self._do_pileups(
-            mids=mids, chrom=chrom, expected=expected,
-        )
-        logging.info(f"{chrom}: {n}")
-        return mymap, num, cov_start, cov_end, n
-
-    def pileupsWithControl(self, nproc=1):
-        """Perform pileups across all chromosomes and applies required
-        normalization
+        PU = copy.copy(self)
+        PU.CC = copy.copy(self.CC)
+        PU.anchor = PU.CC.anchor = anchor
+        PU.CC.pos_stream = PU.CC.get_combinations
+        PU.chroms = [anchor[0]]
+        PU.snippets_file = None
+        logging.info(f"Anchor: {anchor[0]}:{anchor[1]}-{anchor[2]}")
+        if data is not None:
+            data = {anchor[0]: data}
+        loop, n = PU.pileupsWithControl(data=data)
+        return n, loop
+
+    def pileupsByAnchor(self, nproc=1):
+        """Perform a separate anchor pileup for each of the anchors
+
+        Anchors are grouped by chromosome, and the bands of the matrix used by all
+        anchors of a chromosome are loaded once.
 
         Parameters
         ----------
         nproc : int, optional
-            How many cores to use. Sends a whole chromosome per process.
+            How many cores to use. Sends anchors of one chromosome to different
+            processes, or threads with the thread executor.
             The default is 1.
 
         Returns
         -------
-        loop : 2D array
-            Normalized pileup.
-
+        loops : dict
+            Keys are (chr, start, end) of anchors.
+            Values are tuples of (n, pileup)
+            n : int
+            How many ROIs were piled up.
+            pileup : 2D array
+            Pileup for the anchor
         """
-        if len(self.chroms) == 0:
-            return self.make_outmap(), 0
-
-        if nproc > 1:
+        if nproc > 1 and self.executor == "thread":
+            p = ThreadPool(nproc)
+            mymap = p.map
+        elif nproc > 1:
             p = Pool(nproc)
             mymap = p.map
         else:
             mymap = map
-        # Loops
-        f = partial(self.pileup_chrom, ctrl=False, expected=False,)
-        loops, nums, cov_starts, cov_ends, ns = list(zip(*mymap(f, self.chroms)))
-        loop = np.sum(loops, axis=0)
-        n = np.sum(ns)
-        n_return = n
-        num = np.sum(nums, axis=0)
-        if self.coverage_norm:
-            cov_start = np.sum(cov_starts, axis=0)
-            cov_end = np.sum(cov_ends, axis=0)
-            loop = norm_coverage(loop, cov_start, cov_end)
-        loop /= num
-        logging.info(f"Total number of piled up windows: {n}")
-        # Controls
-        if self.expected is not False:
-            f = partial(self.pileup_chrom, ctrl=False, expected=True,)
-            exps, nums, cov_starts, cov_ends, ns = list(zip(*mymap(f, self.chroms)))
-            exp = np.sum(exps, axis=0)
-            num = np.sum(nums, axis=0)
-            exp /= num
-            loop /= exp
-        elif self.control:
-            f = partial(self.pileup_chrom, ctrl=True, expected=False,)
-            ctrls, nums, cov_starts, cov_ends, ns = list(zip(*mymap(f, self.chroms)))
-            ctrl = np.sum(ctrls, axis=0)
-            num = np.sum(nums, axis=0)
-            n = np.sum(ns)
+        loops = {}
+        for chrom in self.chroms:
+            anchors = [tuple(anchor) for anchor in self.anchors if anchor[0] == chrom]
+            if len(anchors) == 0:
+                continue
             if self.coverage_norm:
-                cov_start = np.sum(cov_starts, axis=0)
-                cov_end = np.sum(cov_ends, axis=0)
-                ctrl = norm_coverage(ctrl, cov_start, cov_end)
-            ctrl /= num
-            logging.info(f"Total number of piled up control windows: {n}")
-            loop /= ctrl
+                data = self.get_data(chrom)
+            else:
+                data = self.get_anchor_data(chrom, anchors)
+            f = partial(self._pileup_anchor, data=data)
+            loops.update(zip(anchors, mymap(f, anchors)))
         if nproc > 1:
             p.close()
-        loop[~np.isfinite(loop)] = 0
-        return loop, n_return
+        return loops
 
     def pileupsByWindow(
-        self, chrom, expected=False, ctrl=False,
+        self, chrom, expected=False, ctrl=False, pool=None, data=None, positions=None,
     ):
         """Creates pileups for each window against the rest for a chromosome
 
@@ -1228,6 +4912,15 @@ class PileUpper:
             Whether to create pileup of expected values. The default is False.
         ctrl : bool, optional
             Whether to pileup randomly shifted control regions. The default is False.
+        pool : ThreadPool, optional
+            If provided, pileups for different windows are created by the threads of
+            the pool. The default is None.
+        data : csr or BandedMatrix, optional
+            Already loaded data for the chromosome. The default is None.
+        positions : 2D array of bool, optional
+            If provided, only these pixels of the pileups are computed, and others
+            are empty. Not used for expected and with rescaling.
+            The default is None.
 
 
         Returns
@@ -1240,18 +4933,53 @@ class PileUpper:
             pileup : 2D array
             Pileup for the region
         """
-        pileups = dict()
-        for (start, end), stream in self.CC.get_combinations_by_window(chrom, ctrl):
-            pileup, nums, cov_starts, cov_ends, ns = self._do_pileups(
-                mids=stream, chrom=chrom, expected=expected,
+        windows = self.CC.get_combinations_by_window(chrom, ctrl)
+        if self._use_sweep(expected):
+            results = self._do_pileups_sweep_by_window(
+                windows, chrom, data=data, pool=pool
             )
-            n = np.sum(ns)
-            num = np.sum(nums, axis=0)
+        else:
+            if expected:
+                data, coverage = None, None
+            else:
+                if data is None:
+                    data = self.load_data(chrom)
+                coverage = None
+                if self.coverage_norm:
+                    coverage = self.get_coverage(data, chrom)
+            if positions is not None and not expected and not self.rescale:
+                f = partial(
+                    self._do_pileups_positions,
+                    chrom=chrom,
+                    data=data,
+                    positions=positions,
+                )
+            else:
+                f = partial(
+                    self._do_pileups,
+                    chrom=chrom,
+                    expected=expected,
+                    data=data,
+                    coverage=coverage,
+                )
+            if pool is None:
+                results = ((pos, f(stream)) for pos, stream in windows)
+            else:
+                # Streams are materialized in order, so random shifts don't depend
+                # on the order in which threads consume them
+                windows = [(pos, list(stream)) for pos, stream in windows]
+                results = zip(
+                    [pos for pos, _ in windows],
+                    pool.imap(lambda window: f(iter(window[1])), windows),
+                )
+        pileups = dict()
+        for (start, end), result in results:
+            pileup, num, cov_start, cov_end, n = result
             if n > 0:
                 pileup = pileup / num
             else:
                 pileup = self.make_outmap()
-            pileups[(start, end)] = n, pileup
+            pileups[(start, end)] = n, pileup.astype(self.dtype)
         n_pileups = len(pileups)
         if expected:
             kind = "expected"
@@ -1262,8 +4990,34 @@ class PileUpper:
         logging.info(f"{chrom}: {n_pileups} {kind} by-window pileups")
         return pileups
 
+    def _pileups_by_window_with_control(
+        self, chrom, pool=None, data=None, positions=None
+    ):
+        """Make by-window pileups of a chromosome and of their controls or expected,
+        loading the data only once
+
+        Returns
+        -------
+        loops, ctrls : dict
+            As returned by `pileupsByWindow`. ctrls is None if not using controls or
+            expected.
+
+        """
+        if self.expected is not False:
+            loops = self.pileupsByWindow(chrom, pool=pool, data=data, positions=positions)
+            return loops, self.pileupsByWindow(chrom, expected=True, pool=pool)
+        if data is None and self.control and not self._use_sweep(False):
+            data = self.load_data(chrom)
+        loops = self.pileupsByWindow(chrom, pool=pool, data=data, positions=positions)
+        ctrls = None
+        if self.control:
+            ctrls = self.pileupsByWindow(
+                chrom, ctrl=True, pool=pool, data=data, positions=positions
+            )
+        return loops, ctrls
+
     def pileupsByWindowWithControl(
-        self, nproc=1,
+        self, nproc=1, stats_only=False,
     ):
         """Perform by-window pileups across all chromosomes and applies required
         normalization
@@ -1271,8 +5025,13 @@ class PileUpper:
         Parameters
         ----------
         nproc : int, optional
-            How many cores to use. Sends a whole chromosome per process.
+            How many cores to use. Sends a whole chromosome per process, or, with the
+            thread executor, windows of one chromosome per thread.
             The default is 1.
+        stats_only : bool, optional
+            Whether to only compute the pixels of the pileups needed to get
+            enrichment and corner CV with `prepare_single`. Other pixels are 0.
+            The default is False.
 
         Returns
         -------
@@ -1284,25 +5043,30 @@ class PileUpper:
             pileup : 2D array
             Pileup for the region
         """
-        if nproc > 1:
+        pool = None
+        if nproc > 1 and self.executor == "thread":
+            p = ThreadPool(nproc)
+            pool = p
+            mymap = map
+        elif nproc > 1:
             p = Pool(nproc)
             mymap = p.map
         else:
             mymap = map
-        # Loops
-        f = partial(self.pileupsByWindow, ctrl=False, expected=False,)
-        loops = {chrom: lps for chrom, lps in zip(self.chroms, mymap(f, self.chroms))}
-        # Controls
-        if self.expected is not False:
-            f = partial(self.pileupsByWindow, ctrl=False, expected=True,)
-            ctrls = {
-                chrom: lps for chrom, lps in zip(self.chroms, mymap(f, self.chroms))
-            }
-        elif self.control:
-            f = partial(self.pileupsByWindow, ctrl=True, expected=False,)
-            ctrls = {
-                chrom: lps for chrom, lps in zip(self.chroms, mymap(f, self.chroms))
-            }
+        if self.prefetch > 0 and (nproc <= 1 or self.executor == "thread"):
+            datamap = self._map_prefetched
+        else:
+            datamap = mymap
+        if stats_only:
+            positions = get_stats_mask(2 * self.pad_bins + 1)
+        else:
+            positions = None
+        # Loops are piled up together with their controls or expected, so that each
+        # chromosome is loaded once
+        f = partial(self._pileups_by_window_with_control, pool=pool, positions=positions)
+        results = list(datamap(f, self.chroms))
+        loops = {chrom: lps for chrom, (lps, _) in zip(self.chroms, results)}
+        ctrls = {chrom: ctrls for chrom, (_, ctrls) in zip(self.chroms, results)}
         if nproc > 1:
             p.close()
 
@@ -1314,3 +5078,451 @@ class PileUpper:
                 loop[~np.isfinite(loop)] = 0
                 finloops[(chrom, pos[0], pos[1])] = lp[0], loop
         return finloops
+
+    def anchorScan(self, chrom):
+        """Get enrichment of each bin of a chromosome used as an anchor against all
+        regions
+
+        For every bin, this is the central pixel of the pileup that would be
+        obtained with this bin as the anchor, normalized by expected computed from
+        the same data. All bins are done in one pass over the pixels of the
+        chromosome: each pixel is added to the observed sums of both its bins if the
+        other one is a region, while expected sums and numbers of regions at allowed
+        distances are convolutions of the indicator vector of regions.
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+
+        Returns
+        -------
+        scan : DataFrame
+            Columns chr, start, end, N (number of regions at allowed distances) and
+            Enrichment (NaN where nothing was piled up) for each bin.
+
+        """
+        n_bins = self.matsizes[chrom]
+        pad = self.pad_bins
+        if self.balance:
+            good = np.isfinite(self.get_weights(chrom))
+        else:
+            good = np.ones(n_bins, dtype=bool)
+        # Anchors and regions need the whole window to fit into the chromosome
+        good[:pad] = False
+        good[n_bins - pad :] = False
+        filter_func = self.CC.filter_func_chrom(chrom=chrom)
+        bins = filter_func(self.CC.mids)["Bin"].values.astype(int)
+        bins = bins[(bins >= 0) & (bins < n_bins)]
+        regions = np.bincount(bins, minlength=n_bins) * good
+        mindiag = max(int(np.ceil(self.mindist / self.resolution)), self.ignore_diags, 0)
+        if np.isfinite(self.maxdist):
+            maxdiag = int(min(self.maxdist // self.resolution, n_bins - 1))
+        else:
+            maxdiag = n_bins - 1
+
+        observed = np.zeros(n_bins)
+        diag_sums = np.zeros(maxdiag + 1)
+        for rows, cols, values in self.get_pixel_chunks(chrom):
+            diags = cols - rows
+            keep = (
+                (diags >= mindiag)
+                & (diags <= maxdiag)
+                & good[rows]
+                & good[cols]
+                & np.isfinite(values)
+            )
+            rows, cols, values, diags = rows[keep], cols[keep], values[keep], diags[keep]
+            observed += np.bincount(rows, values * regions[cols], minlength=n_bins)
+            mirror = diags > 0
+            observed += np.bincount(
+                cols[mirror], values[mirror] * regions[rows[mirror]], minlength=n_bins
+            )
+            diag_sums += np.bincount(diags, values, minlength=maxdiag + 1)
+
+        diag_counts = np.round(signal.fftconvolve(good, good[::-1].astype(float)))
+        diag_counts = diag_counts[n_bins - 1 : n_bins + maxdiag]
+        expected = np.zeros(maxdiag + 1)
+        nonzero = diag_counts > 0
+        expected[nonzero] = diag_sums[nonzero] / diag_counts[nonzero]
+        expected[:mindiag] = 0
+        allowed = (np.arange(maxdiag + 1) >= mindiag).astype(float)
+
+        def convolve(profile):
+            kernel = np.concatenate([profile[:0:-1], profile])
+            return signal.fftconvolve(regions, kernel)[maxdiag : maxdiag + n_bins]
+
+        n = np.round(convolve(allowed)) * good
+        expected_sums = convolve(expected) * good
+        with np.errstate(divide="ignore", invalid="ignore"):
+            enrichment = np.where(n > 0, observed / expected_sums, np.nan)
+        starts = np.arange(n_bins) * self.resolution
+        scan = pd.DataFrame(
+            {
+                "chr": chrom,
+                "start": starts,
+                "end": np.minimum(starts + self.resolution, self.clr.chromsizes[chrom]),
+                "N": n.astype(int),
+                "Enrichment": enrichment,
+            }
+        )
+        logging.info(f"{chrom}: scanned {np.sum(n > 0)} anchors")
+        return scan
+
+    def anchorScanGenome(self, nproc=1):
+        """Get enrichment of each bin used as an anchor against all regions, for all
+        chromosomes
+
+        Parameters
+        ----------
+        nproc : int, optional
+            How many cores to use. Sends a whole chromosome per process or thread.
+            The default is 1.
+
+        Returns
+        -------
+        scan : DataFrame
+            Enrichment of all bins, see `anchorScan`.
+
+        """
+        if nproc > 1 and self.executor == "thread":
+            p = ThreadPool(nproc)
+            mymap = p.map
+        elif nproc > 1:
+            p = Pool(nproc)
+            mymap = p.map
+        else:
+            mymap = map
+        scans = list(mymap(self.anchorScan, self.chroms))
+        if nproc > 1:
+            p.close()
+        if len(scans) == 0:
+            return pd.DataFrame(columns=["chr", "start", "end", "N", "Enrichment"])
+        return pd.concat(scans, ignore_index=True)
+
+
+class PairsPileUpper:
+    def __init__(
+        self, pairs, CC, control=False, coverage_norm=False, ignore_diags=2,
+        chunksize=1000000,
+    ):
+        """Creates pileups directly from a .pairs file, without building a cooler
+
+        All windows of all chromosomes are indexed first, and then the file is read
+        once in chunks, adding each binned contact to the windows that contain it.
+        Memory use depends on the number of windows and chromosome sizes, and not on
+        the size of the file. Only raw counts can be used, optionally with coverage
+        normalization, and only plain pileups with `pileupsWithControl` can be made.
+
+        Parameters
+        ----------
+        pairs : PairsFile
+            The .pairs file, binned at the resolution of CC.
+        CC : CoordCreator
+            CoordCreator object with correct settings.
+        control : bool, optional
+            Whether to use randomly shifted controls.
+            The default is False.
+        coverage_norm : bool, optional
+            Whether to normalize the pileup by accumulated coverage.
+            The default is False.
+        ignore_diags : int, optional
+            How many diagonals to ignore to avoid short-distance artefacts.
+            The default is 2.
+        chunksize : int, optional
+            How many lines of the file to read at once. The default is 1000000.
+
+        Returns
+        -------
+        Object that generates pileups.
+
+        """
+        if CC.trans:
+            raise ValueError("Can't make trans pileups from a .pairs file")
+        self.pairs = pairs
+        self.CC = CC
+        self.chunksize = chunksize
+        # Windows are placed and normalized as by a PileUpper, which never loads
+        # any data here
+        self.PU = PileUpper(
+            pairs,
+            CC,
+            balance=False,
+            control=control,
+            coverage_norm=coverage_norm,
+            ignore_diags=ignore_diags,
+            engine="sweep",
+        )
+
+    def pileupsWithControl(self, nproc=1):
+        """Perform pileups across all chromosomes in one pass over the file, and
+        apply required normalization
+
+        Parameters
+        ----------
+        nproc : int, optional
+            How many threads to use to add chunks of contacts to the windows, while
+            the file is read in the main thread. The default is 1.
+
+        Returns
+        -------
+        loop : 2D array
+            Normalized pileup.
+        n : int
+            Total number of windows.
+
+        """
+        PU = self.PU
+        size = 2 * PU.pad_bins + 1
+        windows = {}
+        indexes = {}
+        for chrom in PU.chroms:
+            mids_list = [PU.get_mids_stream(chrom)]
+            if PU.control:
+                mids_list.append(PU.get_mids_stream(chrom, ctrl=True))
+            arrays = [PU._get_window_arrays(mids, chrom) for mids in mids_list]
+            ns = [len(lo_lefts) for lo_lefts, _, _ in arrays]
+            if sum(ns) == 0:
+                logging.info(f"Nothing to sum up in chromosome {chrom}")
+                continue
+            lo_lefts, lo_rights, flips = map(np.concatenate, zip(*arrays))
+            groups = np.repeat(np.arange(len(ns)), ns)
+            windows[chrom] = lo_lefts, lo_rights, groups, ns
+            indexes[chrom] = WindowIndex(
+                lo_lefts,
+                lo_rights,
+                flips,
+                size,
+                PU.matsizes[chrom],
+                groups=groups,
+                n_groups=len(ns),
+            )
+        if len(indexes) == 0:
+            return PU.make_outmap(), 0
+        coverages = {chrom: np.zeros(PU.matsizes[chrom]) for chrom in indexes}
+
+        def chunks():
+            for chrom, rows, cols, values in self.pairs.pixel_chunks(
+                list(indexes), self.chunksize
+            ):
+                if PU.coverage_norm:
+                    n_bins = PU.matsizes[chrom]
+                    coverages[chrom] += np.bincount(rows, values, minlength=n_bins)
+                    coverages[chrom] += np.bincount(cols, values, minlength=n_bins)
+                yield chrom, rows, cols, values
+
+        def accumulate(chunk):
+            chrom, rows, cols, values = chunk
+            return chrom, indexes[chrom].accumulate(
+                (rows, cols, values), ignore_diags=PU.ignore_diags, local=PU.local
+            )
+
+        if nproc > 1:
+            p = ThreadPool(nproc)
+            mapper = p.imap
+        else:
+            mapper = map
+        outs = {
+            chrom: np.zeros((index.n_groups, size, size))
+            for chrom, index in indexes.items()
+        }
+        nans = {chrom: np.zeros_like(out) for chrom, out in outs.items()}
+        for chrom, (out, chunk_nans) in mapper(accumulate, chunks()):
+            outs[chrom] += out
+            nans[chrom] += chunk_nans
+        if nproc > 1:
+            p.close()
+
+        results = []
+        for chrom, index in indexes.items():
+            lo_lefts, lo_rights, groups, ns = windows[chrom]
+            out = outs[chrom]
+            num = index.count_valid(PU.ignore_diags, PU.local) - nans[chrom]
+            chrom_results = []
+            for group, n in enumerate(ns):
+                selected = groups == group
+                cov_start, cov_end = PU._get_window_coverage(
+                    coverages[chrom], lo_lefts[selected], lo_rights[selected]
+                )
+                chrom_results.append((out[group], num[group], cov_start, cov_end, n))
+                logging.info(f"{chrom}: {n}")
+            if not PU.control:
+                chrom_results.append(None)
+            results.append(tuple(chrom_results))
+        return PU._combine_with_control(results)
+
+
+_cell_worker = {}
+
+
+def _init_cell_worker(scool, CC, coords, kwargs):
+    """Keep what is shared by all cells in the worker, so that only the names of the
+    cells are sent with each task of `pileupsByCell`
+
+    Parameters
+    ----------
+    scool : str
+        Path to the .scool file.
+    CC : CoordCreator
+        CoordCreator shared by all cells.
+    coords : dict
+        Keys are chromosomes, values are lists of coordinates of windows and of
+        their controls, as returned by `get_mids_stream` without filtering.
+    kwargs : dict
+        Arguments for the PileUpper of each cell.
+
+    """
+    _cell_worker.update(scool=scool, CC=CC, coords=coords, kwargs=kwargs)
+
+
+def _pileup_cell(cell):
+    """Pile up windows of all chromosomes in one cell of a .scool file, using the
+    coordinates set up by `_init_cell_worker`
+
+    Parameters
+    ----------
+    cell : str
+        Path of the cell inside the .scool file.
+
+    Returns
+    -------
+    cell : str
+        The same cell.
+    n : int
+        How many windows were piled up.
+    loop : 2D array
+        Pileup, coverage normalized if coverage_norm.
+    ctrl : 2D array or None
+        Pileup of controls, or None without controls.
+
+    """
+    scool = _cell_worker["scool"]
+    coords = _cell_worker["coords"]
+    PU = PileUpper(
+        cooler.Cooler(f"{scool}::{cell}"), _cell_worker["CC"], **_cell_worker["kwargs"]
+    )
+    results = []
+    for chrom in PU.chroms:
+        mids, ctrl_mids = coords[chrom]
+        # Windows with bad bins depend on the weights of each cell
+        mids = PU.filter_bad_windows(iter(mids), chrom)
+        if ctrl_mids is not None:
+            ctrl_mids = PU.filter_bad_windows(iter(ctrl_mids), chrom)
+        results.append(
+            PU.pileup_chrom_with_control(chrom, mids=mids, ctrl_mids=ctrl_mids)
+        )
+    if len(results) == 0:
+        return cell, 0, PU.make_outmap(), None
+    loop, n = PU.combine_pileups([lp for lp, _ in results])
+    ctrl = None
+    if PU.control:
+        ctrl, _ = PU.combine_pileups([ctrl for _, ctrl in results])
+    return cell, n, loop, ctrl
+
+
+def pileupsByCell(
+    scool, CC, cells=None, nproc=1, balance=False, coverage_norm=True, engine="dense",
+    sparse_threshold=0.1, **kwargs,
+):
+    """Perform pileups in each cell of a .scool file with the same coordinates
+
+    Cells are sent to a pool of processes. The coordinates of windows and their
+    controls are generated once for each chromosome and sent to each process only
+    once, together with the CoordCreator. Windows of cells with few stored pixels are
+    accumulated directly from the sparse data, see `sparse_threshold`.
+
+    Parameters
+    ----------
+    scool : str
+        Path to the .scool file.
+    CC : CoordCreator
+        CoordCreator with the coordinates to pile up.
+    cells : list of str, optional
+        Paths of cells inside the .scool file. The default is None, to use all
+        cells.
+    nproc : int, optional
+        How many cores to use. Sends a cell per process. The default is 1.
+    balance : bool or str, optional
+        Balancing weights of the cells to use, False to use raw counts.
+        The default is False.
+    coverage_norm : bool, optional
+        Whether to normalize the pileup of each cell by its own coverage.
+        The default is True.
+    engine : str, optional
+        Engine of the PileUpper of each cell. The default is "dense".
+    sparse_threshold : float, optional
+        Fraction of stored pixels in windows below which only the stored pixels are
+        added to the pileup of each cell, see `PileUpper`. The default is 0.1.
+    **kwargs
+        Other arguments for the PileUpper of each cell, e.g. control. Expected can't
+        be used, since it's different in each cell.
+
+    Returns
+    -------
+    table : DataFrame
+        Cell, N, Enrichment1, Enrichment3, CV3 and CV5 of the pileup of each cell,
+        normalized by its controls if using them.
+    aggregate : tuple
+        (n, pileup) for all cells. The pileup is the mean of pileups of the cells
+        with any windows, divided by the mean of their controls if using them.
+
+    """
+    if kwargs.get("expected", False) is not False:
+        raise ValueError("Can't use one expected for all cells")
+    if cells is None:
+        cells = cooler.fileops.list_scool_cells(scool)
+    if len(cells) == 0:
+        raise ValueError(f"No cells to pile up in {scool}")
+    kwargs.update(
+        balance=balance,
+        coverage_norm=coverage_norm,
+        engine=engine,
+        sparse_threshold=sparse_threshold,
+    )
+    # All cells share the bins, so the chromosomes of the first one are used
+    clr = cooler.Cooler(f"{scool}::{cells[0]}")
+    chroms = natsorted(list(set(CC.final_chroms) & set(clr.chromnames)))
+    coords = {}
+    for chrom in chroms:
+        filter_func = CC.filter_func_chrom(chrom=chrom)
+        mids = list(CC.pos_stream(filter_func))
+        ctrl_mids = None
+        if kwargs.get("control", False):
+            ctrl_mids = list(CC.control_regions(filter_func))
+        coords[chrom] = mids, ctrl_mids
+    initargs = (scool, CC, coords, kwargs)
+    if nproc > 1:
+        p = Pool(nproc, initializer=_init_cell_worker, initargs=initargs)
+        results = p.imap(
+            _pileup_cell, cells, chunksize=max(1, len(cells) // (nproc * 4))
+        )
+    else:
+        _init_cell_worker(*initargs)
+        results = map(_pileup_cell, cells)
+    rows = []
+    total_n = 0
+    ncells = 0
+    loop_sum = ctrl_sum = 0
+    for cell, n, loop, ctrl in results:
+        pileup = loop if ctrl is None else loop / ctrl
+        pileup[~np.isfinite(pileup)] = 0
+        rows.append(prepare_single(((cell,), (n, pileup))))
+        if n > 0:
+            total_n += n
+            ncells += 1
+            loop_sum = loop_sum + np.nan_to_num(loop)
+            if ctrl is not None:
+                ctrl_sum = ctrl_sum + np.nan_to_num(ctrl)
+    if nproc > 1:
+        p.close()
+    table = pd.DataFrame(
+        rows, columns=["Cell", "N", "Enrichment1", "Enrichment3", "CV3", "CV5"]
+    )
+    if ncells == 0:
+        return table, (0, np.zeros_like(pileup))
+    aggregate = loop_sum / ncells
+    if kwargs.get("control", False):
+        aggregate = aggregate / (ctrl_sum / ncells)
+    aggregate[~np.isfinite(aggregate)] = 0
+    logging.info(f"{ncells} cells with {total_n} windows in total")
+    return table, (total_n, aggregate)
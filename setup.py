@@ -30,6 +30,7 @@ setup(
           'console_scripts': ['coolpup.py = coolpuppy.__main__:main',
                               'plotpup.py = coolpuppy.__plotpuppy_main__:main']},
       install_requires=INSTALL_REQUIRES,
+      extras_require={'numba': ['numba']},
       python_requires='>=3.6',
       description='A versatile tool to perform pile-up analysis on Hi-C data in .cool format.',
       long_description=long_description,
@@ -12,6 +12,8 @@ import pandas as pd
 from scipy import sparse
 import cooler
 import pytest
+import itertools
+from multiprocessing.pool import ThreadPool
 import subprocess
 import os
 
@@ -29,6 +31,695 @@ def test_get_enrichment():
     assert np.isclose(get_enrichment(amap, 3), 1.4364442129281982)
 
 
+def test_banded_matrix():
+    mat = np.triu(np.random.random((50, 50)))
+    rows, cols = np.nonzero(mat)
+    banded = BandedMatrix(50, -6, 20)
+    banded.add_pixels(rows, cols, mat[rows, cols])
+    assert np.allclose(banded[10:17, 10:17], mat[10:17, 10:17])
+    assert np.allclose(banded[5:12, 15:22], mat[5:12, 15:22])
+    with pytest.raises(IndexError):
+        banded[0:7, 30:37]
+    full = np.nan_to_num(mat.sum(axis=0)) + np.nan_to_num(mat.sum(axis=1))
+    banded = BandedMatrix(50, 0, 49)
+    banded.add_pixels(rows, cols, mat[rows, cols])
+    assert np.allclose(banded.coverage(), full)
+
+
+def test_accumulate_windows():
+    mat = np.triu(np.random.random((40, 40)))
+    mat[5, 20] = np.nan
+    lo_lefts = np.array([0, 3, 10])
+    lo_rights = np.array([10, 15, 20])
+    flips = np.array([0, 1, 2])
+    out, num = accumulate_windows(
+        sparse.csr_matrix(mat), lo_lefts, lo_rights, flips, 7, ignore_diags=2
+    )
+    windows = [mat[l : l + 7, r : r + 7] for l, r in zip(lo_lefts, lo_rights)]
+    windows[1] = np.rot90(np.flipud(windows[1]), 1)
+    windows[2] = np.rot90(windows[2], -1)
+    assert np.allclose(out, np.nansum(windows, axis=0))
+    assert np.allclose(num, np.sum(np.isfinite(windows), axis=0))
+
+
+def test_window_index():
+    mat = np.triu(np.random.random((40, 40)))
+    mat[5, 20] = np.nan
+    lo_lefts = np.array([0, 3, 10, 3])
+    lo_rights = np.array([10, 15, 20, 5])
+    flips = np.array([0, 1, 2, 0])
+    index = WindowIndex(lo_lefts, lo_rights, flips, 7, 40)
+    rows, cols = np.nonzero(np.triu(np.ones((40, 40))))
+    out, nans = index.accumulate((rows, cols, mat[rows, cols]), ignore_diags=2)
+    num = index.count_valid(ignore_diags=2) - nans
+    expected_out, expected_num = accumulate_windows(
+        sparse.csr_matrix(mat), lo_lefts, lo_rights, flips, 7, ignore_diags=2
+    )
+    assert np.allclose(out[0], expected_out)
+    assert np.allclose(num[0], expected_num)
+
+
+def test_accumulate_windows_sparse():
+    mat = np.triu(np.random.random((40, 40)))
+    mat[mat < 0.9] = 0
+    mat[5, 20] = np.nan
+    lo_lefts = np.array([0, 3, 10, 3])
+    lo_rights = np.array([10, 15, 20, 5])
+    flips = np.array([0, 1, 2, 0])
+    for local in (False, True):
+        if local:
+            lo_rights = lo_lefts
+        out, num = accumulate_windows_sparse(
+            sparse.csr_matrix(mat), lo_lefts, lo_rights, flips, 7,
+            ignore_diags=2, local=local
+        )
+        expected_out, expected_num = accumulate_windows(
+            sparse.csr_matrix(mat), lo_lefts, lo_rights, flips, 7,
+            ignore_diags=2, local=local
+        )
+        assert np.allclose(out, expected_out)
+        assert np.allclose(num, expected_num)
+
+
+def test_get_stats_mask():
+    amap = np.random.random((21, 21))
+    masked = np.where(get_stats_mask(21), amap, 0)
+    assert prepare_single((("chr1", 0, 1), (1, amap))) == prepare_single(
+        (("chr1", 0, 1), (1, masked))
+    )
+
+
+def test_balanced_matrix():
+    mat = np.triu(np.random.randint(0, 3, (30, 30))).astype(float)
+    weights = np.random.random(30)
+    weights[4] = np.nan
+    balanced = BalancedMatrix(sparse.csr_matrix(mat), weights)
+    expected = np.where(mat != 0, mat * np.outer(weights, weights), 0)
+    assert np.allclose(balanced[2:9, 10:17], expected[2:9, 10:17], equal_nan=True)
+    coverage = np.nan_to_num(expected.sum(axis=0)) + np.nan_to_num(expected.sum(axis=1))
+    assert np.allclose(balanced.coverage(), coverage)
+
+
+def test_coarsen_pileup():
+    pileup = np.random.random((17, 17))
+    num = np.ones((17, 17))
+    cov = np.random.random(17)
+    out, outnum, cov_start, cov_end, n = coarsen_pileup(
+        (pileup, num, cov, cov, 5), 3, 2
+    )
+    assert out.shape == (5, 5)
+    assert np.isclose(out[2, 2], pileup[7:10, 7:10].sum())
+    assert np.isclose(out[0, 4], pileup[1:4, 13:16].sum())
+    assert np.allclose(outnum, 1)
+    assert np.isclose(cov_start[1], cov[4:7].sum())
+    assert n == 5
+    with pytest.raises(ValueError):
+        coarsen_pileup((pileup, num, cov, cov, 5), 3, 3)
+
+
+def test_pairs_file(tmp_path):
+    import gzip
+
+    filename = str(tmp_path / "test.pairs.gz")
+    with gzip.open(filename, "wt") as f:
+        f.write("## pairs format v1.0\n")
+        f.write("#chromsize: chr1 3500\n#chromsize: chr2 2000\n")
+        f.write("#columns: readID chrom1 pos1 chrom2 pos2 strand1 strand2\n")
+        f.write("r1\tchr1\t1500\tchr1\t999\t+\t-\n")
+        f.write("r2\tchr1\t1001\tchr1\t1000\t+\t-\n")
+        f.write("r3\tchr1\t3500\tchr1\t2500\t+\t-\n")
+        f.write("r4\tchr1\t100\tchr2\t100\t+\t-\n")
+        f.write("r5\tchr2\t10\tchr2\t1001\t+\t-\n")
+    pairs = PairsFile(filename, 1000)
+    assert pairs.chromnames == ["chr1", "chr2"]
+    pixels = {
+        chrom: set(zip(rows, cols, values))
+        for chrom, rows, cols, values in pairs.pixel_chunks(["chr1"])
+    }
+    assert pixels == {"chr1": {(0, 1, 2.0), (2, 3, 1.0)}}
+
+
+@pytest.fixture(scope="module")
+def small_data(tmp_path_factory):
+    """Small balanced cooler with bed and bedpe files of regions in it"""
+    path = tmp_path_factory.mktemp("small_data")
+    rng = np.random.default_rng(0)
+    resolution = 10000
+    chromsizes = pd.Series({"chr1": 2000000, "chr2": 1500000})
+    bins = cooler.binnify(chromsizes, resolution)
+    pixels = []
+    offset = 0
+    for size in np.ceil(chromsizes.values / resolution).astype(int):
+        rows, cols = np.triu_indices(size)
+        near = cols - rows < 60
+        rows, cols = rows[near], cols[near]
+        counts = rng.poisson(30 / (1 + cols - rows))
+        stored = counts > 0
+        pixels.append(
+            pd.DataFrame(
+                {
+                    "bin1_id": rows[stored] + offset,
+                    "bin2_id": cols[stored] + offset,
+                    "count": counts[stored],
+                }
+            )
+        )
+        offset += size
+    # Sparse trans contacts between the two chromosomes
+    trans = pd.DataFrame(
+        {
+            "bin1_id": rng.integers(0, 200, 5000),
+            "bin2_id": rng.integers(200, 350, 5000),
+            "count": rng.integers(1, 4, 5000),
+        }
+    ).drop_duplicates(["bin1_id", "bin2_id"])
+    pixels = pd.concat(pixels + [trans]).sort_values(["bin1_id", "bin2_id"])
+    # A few empty bins to get NaN weights
+    bad = pixels["bin1_id"].isin([50, 51]) | pixels["bin2_id"].isin([50, 51])
+    pixels = pixels[~bad]
+    coolfile = str(path / "test.cool")
+    cooler.create_cooler(coolfile, bins, pixels)
+    cooler.balance_cooler(
+        cooler.Cooler(coolfile), store=True, cis_only=True, min_nnz=5, mad_max=0
+    )
+    beds = []
+    bedpes = []
+    for chrom, size in chromsizes.items():
+        starts = np.sort(rng.integers(0, size - 50000, 30))
+        beds.append(pd.DataFrame({"chr": chrom, "start": starts, "end": starts + 20000}))
+        starts = rng.integers(0, size - 400000, 30)
+        ends = starts + rng.integers(100000, 350000, 30)
+        bedpes.append(
+            pd.DataFrame(
+                {
+                    "chr1": chrom,
+                    "start1": starts,
+                    "end1": starts + 5000,
+                    "chr2": chrom,
+                    "start2": ends,
+                    "end2": ends + 5000,
+                }
+            )
+        )
+    bedfile = str(path / "test.bed")
+    pd.concat(beds).to_csv(bedfile, sep="\t", header=False, index=False)
+    bedpefile = str(path / "test.bedpe")
+    pd.concat(bedpes).to_csv(bedpefile, sep="\t", header=False, index=False)
+    return {"path": path, "cool": coolfile, "bed": bedfile, "bedpe": bedpefile}
+
+
+@pytest.mark.parametrize(
+    "cc_kwargs, kwargs, options",
+    [
+        pytest.param(
+            {"maxdist": 400000},
+            {"control": True, "coverage_norm": True, "balance": False},
+            {"banded": True},
+            id="banded",
+        ),
+        pytest.param(
+            {"local": True},
+            {"control": True, "coverage_norm": True, "balance": False},
+            {"banded": True},
+            id="banded-local",
+        ),
+        pytest.param({}, {"control": True}, {"executor": "thread"}, id="thread"),
+        pytest.param({}, {"control": True}, {"prefetch": 1}, id="prefetch"),
+        pytest.param(
+            {"subset": 5}, {"control": True}, {"window_query_ratio": 0.5},
+            id="window_query_ratio",
+        ),
+        pytest.param(
+            {"maxdist": 600000}, {"balance": False}, {"engine": "algebraic"},
+            id="algebraic-unbalanced",
+        ),
+        pytest.param(
+            {"maxdist": 600000}, {"control": True}, {"engine": "algebraic"},
+            id="algebraic",
+        ),
+        pytest.param(
+            {"maxdist": 400000}, {"control": True}, {"dtype": np.float32},
+            id="float32",
+        ),
+        pytest.param(
+            {"maxdist": 400000}, {"control": True, "banded": True},
+            {"dtype": np.float32}, id="float32-banded",
+        ),
+        pytest.param(
+            {"maxdist": 600000}, {"control": True}, {"sparse_threshold": 1.1},
+            id="sparse_threshold",
+        ),
+        pytest.param(
+            {"maxdist": 600000}, {"control": True, "engine": "numba"},
+            {"sparse_threshold": 1.1}, id="sparse_threshold-numba",
+        ),
+        pytest.param(
+            {"maxdist": 600000},
+            {"control": True, "coverage_norm": True, "balance": False},
+            {"sparse_threshold": 1.1}, id="sparse_threshold-coverage",
+        ),
+    ],
+)
+def test_pileup_options(small_data, cc_kwargs, kwargs, options):
+    # Options that only change how windows are piled up give the same pileup.
+    # Any windows are sparse enough with a sparse_threshold above 1
+    clr = cooler.Cooler(small_data["cool"])
+    nproc = 2 if options.get("executor") == "thread" else 1
+    results = []
+    for extra in ({}, options):
+        np.random.seed(0)
+        CC = CoordCreator(
+            small_data["bed"], resolution=10000, pad=50000, seed=0, **cc_kwargs
+        )
+        PU = PileUpper(clr, CC, **kwargs, **extra)
+        results.append(PU.pileupsWithControl(nproc=nproc if extra else 1))
+    (expected, expected_n), (loop, n) = results
+    assert n == expected_n > 0
+    rtol = 1e-4 if options.get("dtype") == np.float32 else 1e-5
+    assert np.allclose(loop, expected, rtol=rtol)
+
+
+def test_banded_size_warning(small_data):
+    CC = CoordCreator(small_data["bed"], resolution=10000, pad=50000, maxdist=1500000)
+    PU = PileUpper(cooler.Cooler(small_data["cool"]), CC, banded=True)
+    with pytest.warns(UserWarning, match="larger than its sparse matrix"):
+        PU.get_banded_data("chr1")
+
+
+def test_thread_executor_empty_chunk(small_data):
+    PU = PileUpper(cooler.Cooler(small_data["cool"]), CoordCreator(
+        small_data["bed"], resolution=10000, pad=50000
+    ))
+    with ThreadPool(2) as pool:
+        pileup, num, cov_start, cov_end, n = PU._do_pileups_threaded(
+            iter([]), "chr1", pool
+        )
+    assert pileup.shape == num.shape == (11, 11)
+    assert cov_start.shape == cov_end.shape == (11,)
+    assert n == 0 and not np.any(num) and num is not pileup
+
+
+def test_pileups_by_window_normalization(small_data):
+    CC = CoordCreator(
+        small_data["bed"], resolution=10000, pad=50000, maxdist=600000, seed=0
+    )
+    PU = PileUpper(cooler.Cooler(small_data["cool"]), CC, balance=False, control=True)
+    pileups = PU.pileupsByWindow("chr1")
+    for (start, end), stream in CC.get_combinations_by_window("chr1"):
+        pileup, num, _, _, n = PU._do_pileups(stream, "chr1")
+        assert pileups[(start, end)][0] == n
+        if n > 0:
+            assert np.allclose(pileups[(start, end)][1], pileup / num)
+    full = PU.pileupsByWindowWithControl()
+    stats = PU.pileupsByWindowWithControl(stats_only=True)
+    for window in full:
+        assert prepare_single((window, full[window])) == pytest.approx(
+            prepare_single((window, stats[window])), nan_ok=True
+        )
+
+
+def test_anchor_scan(small_data):
+    clr = cooler.Cooler(small_data["cool"])
+    cc_kwargs = {"pad": 50000, "mindist": 100000, "maxdist": 500000}
+    CC = CoordCreator(small_data["bed"], resolution=10000, **cc_kwargs)
+    scan = PileUpper(clr, CC, balance=False).anchorScan("chr1")
+    # Expected from the same data: mean of each diagonal over bins that fit windows
+    mat = np.triu(clr.matrix(balance=False).fetch("chr1"))
+    good = np.zeros(len(mat), dtype=bool)
+    good[5:-5] = True
+    expected = [
+        np.mean(np.diagonal(mat, d)[good[d:] & good[: len(mat) - d]])
+        for d in range(51)
+    ]
+    regions = CC.mids[CC.mids["chr"] == "chr1"]["Bin"].values
+    regions = regions[good[regions]]
+    anchors = scan.index[scan["N"] > 0][::20]
+    assert len(anchors) > 3
+    for b in anchors:
+        start = b * 10000
+        np.random.seed(0)
+        anchorCC = CoordCreator(
+            small_data["bed"], resolution=10000, anchor=("chr1", start, start + 10000),
+            **cc_kwargs,
+        )
+        loop, n = PileUpper(clr, anchorCC, balance=False).pileupsWithControl()
+        assert scan.loc[b, "N"] == n
+        distances = np.abs(regions - b)
+        distances = distances[(distances >= 10) & (distances <= 50)]
+        observed = loop[5, 5] * n
+        assert np.isclose(
+            scan.loc[b, "Enrichment"], observed / np.sum(np.take(expected, distances))
+        )
+
+
+def test_anchor_data(small_data):
+    CC = CoordCreator(
+        small_data["bed"], resolution=10000, pad=50000, maxdist=300000, seed=0,
+        anchor=("chr1", 1000000, 1010000), minshift=50000, maxshift=150000,
+    )
+    PU = PileUpper(cooler.Cooler(small_data["cool"]), CC, control=True)
+    band = PU.get_anchor_data("chr1")
+    whole = PU.get_data("chr1")
+    assert band.raw.nnz < whole.raw.nnz
+    for ctrl in (False, True):
+        expected = PU.pileup_chrom("chr1", ctrl=ctrl, data=whole)
+        pileup, num, _, _, n = PU.pileup_chrom("chr1", ctrl=ctrl)
+        assert n == expected[4] > 0
+        assert np.allclose(pileup / num, expected[0] / expected[1], equal_nan=True)
+
+
+def test_pileups_by_anchor_threads(small_data):
+    starts = range(300000, 1700000, 100000)
+    anchors = [("chr1", start, start + 10000) for start in starts]
+    results = []
+    for executor, nproc in (("process", 1), ("thread", 4)):
+        CC = CoordCreator(
+            small_data["bed"], resolution=10000, pad=50000, seed=0, anchors=anchors,
+            maxdist=500000,
+        )
+        PU = PileUpper(
+            cooler.Cooler(small_data["cool"]), CC, control=True, executor=executor
+        )
+        results.append(PU.pileupsByAnchor(nproc=nproc))
+    sequential, threaded = results
+    assert sequential.keys() == threaded.keys()
+    for anchor in sequential:
+        assert sequential[anchor][0] == threaded[anchor][0]
+        assert np.allclose(sequential[anchor][1], threaded[anchor][1])
+
+
+def test_max_bad_fraction(small_data):
+    clr = cooler.Cooler(small_data["cool"])
+    CC = CoordCreator(small_data["bed"], resolution=10000, pad=50000, maxdist=600000)
+    PU = PileUpper(clr, CC)
+    bad = ~np.isfinite(clr.bins().fetch("chr1")["weight"].values)
+    kept = []
+    for pos in CC.pos_stream(CC.filter_func_chrom(chrom="chr1")):
+        window = PU._get_window(*pos, PU.matsizes["chr1"])
+        if window is None:
+            continue
+        lo_left, hi_left, lo_right, hi_right = window[:4]
+        good = np.sum(~bad[lo_left:hi_left]) * np.sum(~bad[lo_right:hi_right])
+        if 1 - good / ((hi_left - lo_left) * (hi_right - lo_right)) <= 0.1:
+            kept.append(pos)
+    pileup, num, _, _, n = PU._do_pileups(iter(kept), "chr1")
+    filtered = PileUpper(clr, CC, max_bad_fraction=0.1).pileup_chrom("chr1")
+    assert filtered[4] == n
+    assert n < PU.pileup_chrom("chr1")[4]
+    assert np.allclose(filtered[0] / filtered[1], pileup / num, equal_nan=True)
+
+
+def test_trans_pileups(small_data):
+    clr = cooler.Cooler(small_data["cool"])
+    CC = CoordCreator(small_data["bed"], resolution=10000, pad=50000, trans=True)
+    loop, n = PileUpper(clr, CC).pileupsWithControl()
+    # Windows extracted from the block balanced by cooler, unstored pixels are 0
+    block = clr.matrix(balance=True, sparse=True).fetch("chr1", "chr2").toarray()
+    mids1 = CC.mids[CC.mids["chr"] == "chr1"]["Bin"].values
+    mids2 = CC.mids[CC.mids["chr"] == "chr2"]["Bin"].values
+    windows = [
+        block[b1 - 5 : b1 + 6, b2 - 5 : b2 + 6]
+        for b1 in mids1
+        for b2 in mids2
+        if 5 <= b1 < block.shape[0] - 5 and 5 <= b2 < block.shape[1] - 5
+    ]
+    assert n == len(windows)
+    expected = np.nansum(windows, axis=0) / np.sum(np.isfinite(windows), axis=0)
+    assert np.allclose(loop, expected)
+
+
+def test_pileup_chrom_with_control(small_data):
+    CC = CoordCreator(
+        small_data["bed"], resolution=10000, pad=50000, maxdist=600000, seed=0
+    )
+    clr = cooler.Cooler(small_data["cool"])
+    PU = PileUpper(clr, CC, control=True)
+    separate = PU.pileup_chrom("chr1"), PU.pileup_chrom("chr1", ctrl=True)
+    for kwargs in ({}, {"engine": "sweep"}, {"window_query_ratio": 0.5}):
+        fused = PileUpper(clr, CC, control=True, **kwargs).pileup_chrom_with_control(
+            "chr1"
+        )
+        for (pileup, num, _, _, n), expected in zip(fused, separate):
+            assert n == expected[4]
+            assert np.allclose(pileup / num, expected[0] / expected[1], equal_nan=True)
+
+
+def test_pileups_by_distance_edges(small_data, tmp_path):
+    # Pairs exactly at 200 kb and at the top edge of 400 kb
+    starts = np.array([60, 72, 80, 100, 140]) * 10000
+    bedfile = str(tmp_path / "edges.bed")
+    pd.DataFrame({"chr": "chr1", "start": starts, "end": starts + 10000}).to_csv(
+        bedfile, sep="\t", header=False, index=False
+    )
+    clr = cooler.Cooler(small_data["cool"])
+    CC = CoordCreator(bedfile, resolution=10000, pad=50000, maxdist=400000)
+    PU = PileUpper(clr, CC, distance_bins=[100000, 200000, 400000])
+    bands = PU.pileupsByDistanceWithControl()
+    # The first band starts at the automatic mindist of 120 kb
+    assert list(bands.keys()) == [(120000, 200000), (200000, 400000)]
+    total = PileUpper(clr, CC).pileupsWithControl()
+    topCC = CoordCreator(
+        bedfile, resolution=10000, pad=50000, mindist=200000, maxdist=400000
+    )
+    top = PileUpper(clr, topCC).pileupsWithControl()
+    assert bands[(120000, 200000)][0] + bands[(200000, 400000)][0] == total[1]
+    assert bands[(200000, 400000)][0] == top[1]
+    assert np.allclose(bands[(200000, 400000)][1], top[0])
+
+
+def test_pileups_by_group_shared_bins(small_data, tmp_path):
+    # Regions of different groups in bins 60 and 120
+    regions = pd.DataFrame(
+        {
+            "chr": "chr1",
+            "start": [300000, 600000, 604000, 900000, 1200000, 1204000, 1500000],
+            "group": ["A", "A", "B", "B", "A", "B", "A"],
+        }
+    )
+    regions["end"] = regions["start"] + 2000
+    # The first row is written twice, as the first line of a file is skipped
+    regions = regions.iloc[[0] + list(range(len(regions)))]
+    clr = cooler.Cooler(small_data["cool"])
+
+    def write_bed(name, df, columns=("chr", "start", "end", "group")):
+        bedfile = str(tmp_path / name)
+        df[list(columns)].to_csv(
+            bedfile, sep="\t", header=False, index=False
+        )
+        return bedfile
+
+    bedfile = write_bed("groups.bed", regions)
+    CC = CoordCreator(bedfile, resolution=10000, pad=50000, groups=True)
+    pairs = PileUpper(clr, CC).pileupsByGroupWithControl()
+    regions = regions.iloc[1:]
+    bins = (regions["start"] + 1000) // 10000
+    expected = {}
+    for (b1, g1), (b2, g2) in itertools.combinations(zip(bins, regions["group"]), 2):
+        if b2 - b1 >= 12:
+            expected[(g1, g2)] = expected.get((g1, g2), 0) + 1
+    assert {key: n for key, (n, _) in pairs.items()} == expected
+    CC = CoordCreator(bedfile, resolution=10000, pad=50000, groups=True, local=True)
+    local = PileUpper(clr, CC).pileupsByGroupWithControl()
+    assert local.keys() == {"A", "B"}
+    for group in ("A", "B"):
+        part = regions[regions["group"] == group]
+        part = part.iloc[[0] + list(range(len(part)))]
+        groupfile = write_bed(f"{group}.bed", part, columns=("chr", "start", "end"))
+        CC = CoordCreator(groupfile, resolution=10000, pad=50000, local=True)
+        loop, n = PileUpper(clr, CC).pileupsWithControl()
+        assert local[group][0] == n == len(part) - 1
+        assert np.allclose(local[group][1], loop)
+
+
+def test_pileups_variants(small_data):
+    clr = cooler.Cooler(small_data["cool"])
+    cc_kwargs = {"mindist": 250000, "maxdist": 600000, "seed": 0}
+    norms = {
+        "balanced": {"balance": "weight"},
+        "unbalanced": {"balance": False},
+        "coverage": {"balance": False, "coverage_norm": True},
+    }
+    # Controls that fit only with smaller pads are skipped for all pads, so they
+    # are compared with a separate run at the largest pad only
+    for control, pads in ((False, [50000, 100000]), (True, [100000])):
+        CC = CoordCreator(small_data["bed"], resolution=10000, pad=100000, **cc_kwargs)
+        variants = PileUpper(clr, CC, control=control).pileupsVariantsWithControl(
+            pads=pads, norms=list(norms)
+        )
+        for pad in pads:
+            CC = CoordCreator(small_data["bed"], resolution=10000, pad=pad, **cc_kwargs)
+            for norm, kwargs in norms.items():
+                PU = PileUpper(clr, CC, control=control, **kwargs)
+                loop, n = PU.pileupsWithControl()
+                assert variants[(pad, norm)][0] == n
+                assert np.allclose(variants[(pad, norm)][1], loop)
+
+
+def test_pileups_coarsened(small_data):
+    clr = cooler.Cooler(small_data["cool"])
+    coarse_cool = str(small_data["path"] / "test.30000.cool")
+    cooler.coarsen_cooler(small_data["cool"], coarse_cool, 3, 10 ** 6)
+    # Anchors in the central 10 kb bin of 30 kb bins, so that coarse windows
+    # are centred on the same bins
+    rng = np.random.default_rng(0)
+    starts = np.sort(rng.integers(3, 50, 30)) * 30000 + 14000
+    ends = starts + rng.integers(4, 12, 30) * 30000
+    pairs = pd.DataFrame(
+        {"chr1": "chr1", "start1": starts, "end1": starts + 2000,
+         "chr2": "chr1", "start2": ends, "end2": ends + 2000}
+    )
+    bedpe = str(small_data["path"] / "aligned.bedpe")
+    # The first row is written twice, as the first line of a file is skipped
+    pd.concat([pairs.iloc[:1], pairs]).to_csv(
+        bedpe, sep="\t", header=False, index=False
+    )
+    # The fine pad covers the coarse pad around the central fine bin
+    CC = CoordCreator(bedpe, resolution=10000, pad=70000, mindist=150000)
+    PU = PileUpper(clr, CC, balance=False, ignore_diags=0)
+    coarsened = PU.pileupsCoarsenedWithControl([3], pad=60000)
+    CC = CoordCreator(bedpe, resolution=30000, pad=60000, mindist=150000)
+    PU = PileUpper(cooler.Cooler(coarse_cool), CC, balance=False, ignore_diags=0)
+    loop, n = PU.pileupsWithControl()
+    assert coarsened[3][0] == n == np.sum(ends - starts >= 150000)
+    assert coarsened[3][1].shape == loop.shape == (5, 5)
+    assert np.allclose(coarsened[3][1], loop)
+
+
+def test_rescale_resolutions(small_data):
+    mcool = str(small_data["path"] / "test.mcool")
+    cooler.zoomify_cooler(small_data["cool"], mcool, [10000, 20000, 40000], 10 ** 6)
+    rng = np.random.default_rng(0)
+    starts = np.sort(rng.integers(0, 1000000, 20)) // 10000 * 10000
+    ends = starts + rng.integers(20, 40, 20) * 10000
+    domains = pd.DataFrame({"chr": "chr1", "start": starts, "end": ends})
+    bedfile = str(small_data["path"] / "domains.bed")
+    domains.to_csv(bedfile, sep="\t", header=False, index=False)
+    CC = CoordCreator(bedfile, resolution=10000, local=True)
+    kwargs = {"balance": False, "rescale": True, "rescale_size": 15}
+    clr = cooler.Cooler(f"{mcool}::resolutions/10000")
+    fine = PileUpper(clr, CC, **kwargs).pileupsWithControl()
+    coarse = PileUpper(
+        clr, CC, rescale_resolutions=[20000, 40000], **kwargs
+    ).pileupsWithControl()
+    assert fine[1] == coarse[1] > 0
+    # Coarse pixels are averages of the same counts on a slightly different grid
+    assert np.corrcoef(fine[0].ravel(), coarse[0].ravel())[0, 1] > 0.95
+    # Except near the diagonal of the domains, where ignore_diags removes whole
+    # coarse diagonals
+    rows, cols = np.indices(fine[0].shape)
+    off_diagonal = np.abs(rows + cols - (len(rows) - 1)) > 2
+    assert np.allclose(
+        fine[0][off_diagonal], coarse[0][off_diagonal], rtol=0.25, atol=0.1
+    )
+
+
+def test_pileups_by_cell(small_data):
+    # Cells with sparse contacts subsampled from the small cooler
+    clr = cooler.Cooler(small_data["cool"])
+    bins = clr.bins()[:][["chrom", "start", "end"]]
+    pixels = clr.pixels()[:]
+    rng = np.random.default_rng(0)
+    cells = {}
+    for i in range(3):
+        counts = rng.binomial(pixels["count"], 0.1)
+        cell = pixels.assign(count=counts)
+        cells[f"cell{i}"] = cell[counts > 0].reset_index(drop=True)
+    scool = str(small_data["path"] / "test.scool")
+    cooler.create_scool(scool, {name: bins for name in cells}, cells)
+    CC = CoordCreator(small_data["bed"], resolution=10000, pad=50000, seed=0)
+    table, (n, aggregate) = pileupsByCell(scool, CC, control=True)
+    assert n == table["N"].sum() > 0
+    for cell, row in zip(cooler.fileops.list_scool_cells(scool), table.itertuples()):
+        PU = PileUpper(
+            cooler.Cooler(f"{scool}::{cell}"), CC, balance=False, coverage_norm=True,
+            control=True,
+        )
+        loop, cell_n = PU.pileupsWithControl()
+        assert row.Cell == cell
+        assert row.N == cell_n
+        assert np.isclose(row.Enrichment1, get_enrichment(loop, 1))
+    # Workers of the pool get the coordinates once from the initializer
+    parallel_table, (parallel_n, parallel) = pileupsByCell(
+        scool, CC, control=True, nproc=2
+    )
+    assert parallel_n == n
+    assert parallel_table.equals(table)
+    assert np.allclose(parallel, aggregate)
+
+
+def test_snippets(small_data, tmp_path):
+    clr = cooler.Cooler(small_data["cool"])
+    mat = np.triu(clr.matrix(balance=False).fetch("chr1"))
+    CC = CoordCreator(
+        small_data["bed"], resolution=10000, pad=50000, maxdist=600000,
+        chroms=["chr1"],
+    )
+    # Data of a narrower band, so that windows far from the diagonal are skipped
+    band = PileUpper(
+        clr, CoordCreator(small_data["bed"], resolution=10000, pad=50000,
+                          maxdist=300000),
+        balance=False, banded=True,
+    ).get_banded_data("chr1")
+    for executor, data in (("process", None), ("thread", None), ("process", band)):
+        snippets = str(tmp_path / f"{executor}_{data is None}.npy")
+        PU = PileUpper(
+            clr, CC, balance=False, snippets_file=snippets, executor=executor,
+            ignore_diags=0,
+        )
+        loop, n = PU.pileupsWithControl(
+            nproc=2 if executor == "thread" else 1,
+            data=None if data is None else {"chr1": data},
+        )
+        stack = np.load(snippets, mmap_mode="r")
+        index = pd.read_csv(snippets[:-4] + ".tsv", sep="\t")
+        assert len(stack) == len(index) >= n > 0
+        skipped = 0
+        for snippet, row in zip(stack, index.itertuples()):
+            window = mat[
+                row.start1 // 10000 : row.end1 // 10000,
+                row.start2 // 10000 : row.end2 // 10000,
+            ]
+            if row.flipped:
+                window = np.rot90(np.flipud(window), 1)
+            if np.all(np.isnan(snippet)):
+                skipped += 1
+            else:
+                assert np.allclose(snippet, window)
+        assert skipped == len(stack) - n
+        assert (skipped > 0) == (data is not None)
+        assert np.allclose(np.nansum(stack, axis=0) / n, loop)
+
+
+def test_pairs_pileups(small_data, tmp_path):
+    import gzip
+
+    clr = cooler.Cooler(small_data["cool"])
+    pixels = clr.pixels(join=True)[:]
+    pixels = pixels[pixels["chrom1"] == pixels["chrom2"]]
+    filename = str(tmp_path / "small.pairs.gz")
+    with gzip.open(filename, "wt") as f:
+        f.write("## pairs format v1.0\n")
+        for chrom, size in clr.chromsizes.items():
+            f.write(f"#chromsize: {chrom} {size}\n")
+        f.write("#columns: readID chrom1 pos1 chrom2 pos2 strand1 strand2\n")
+        for pixel in pixels.itertuples():
+            line = f"r\t{pixel.chrom1}\t{pixel.start1 + 1}\t"
+            line += f"{pixel.chrom2}\t{pixel.start2 + 1}\t+\t-\n"
+            f.write(line * pixel.count)
+    pairs = PairsFile(filename, 10000)
+    for kwargs in ({}, {"control": True, "coverage_norm": True}):
+        CC = CoordCreator(
+            small_data["bed"], resolution=10000, pad=50000, maxdist=600000, seed=0
+        )
+        loop, n = PairsPileUpper(pairs, CC, **kwargs).pileupsWithControl()
+        expected, expected_n = PileUpper(
+            clr, CC, balance=False, **kwargs
+        ).pileupsWithControl()
+        assert n == expected_n > 0
+        assert np.allclose(loop, expected)
+    assert not hasattr(PairsPileUpper(pairs, CC), "get_data")
+
+
 bed = pd.read_csv("tests/test.bed", sep="\t", names=["chr", "start", "end"])
 
 # def test_filter_bed():